@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+دفتر أرصدة الحسابات
+
+يتم تحديث Account.balance و debit_balance و credit_balance تدريجياً مع كل سطر
+قيد مرحل بعملية UPDATE ذرية باستخدام F()، بدلاً من إعادة حساب الأرصدة من جميع
+القيود عند كل عملية أو عند فتح شجرة الحسابات.
+
+- إنشاء سطر في قيد مرحل: إضافة مدين/دائن السطر لرصيد الحساب
+- تعديل أو حذف سطر في قيد مرحل: عكس القيمة القديمة ثم إضافة الجديدة
+- ترحيل قيد موجود (is_posted من False إلى True): إضافة جميع أسطره، والعكس عند إلغاء الترحيل
+
+الحركة الشهرية لكل حساب (AccountPeriodBalance) تتحدث مع نفس العمليات بتاريخ
+إنشاء القيد، لتقارير أي تاريخ سابق (core.period_balances).
+
+المطابقة الكاملة تتم بأمر: python manage.py rebuild_balances
+"""
+from decimal import Decimal
+
+from django.db.models import Case, When, Value, F, Sum, DecimalField
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from .database_router import get_current_db_alias
+from .period_balances import AccountPeriodLedger
+
+# الحسابات ذات الطبيعة المدينة، باقي الأنواع طبيعتها دائنة
+DEBIT_NATURE_TYPES = ('asset', 'expense')
+
+BALANCE_FIELDS = ['balance', 'debit_balance', 'credit_balance']
+
+_ZERO = Decimal('0')
+_CENTS = Decimal('0.01')
+
+
+def _balance_field():
+    return DecimalField(max_digits=15, decimal_places=2)
+
+
+class AccountBalanceLedger:
+    """تحديث أرصدة الحسابات من أسطر القيود المرحلة"""
+
+    @staticmethod
+    def signed_balance(account_type, debit, credit):
+        """الرصيد حسب طبيعة الحساب"""
+        if account_type in DEBIT_NATURE_TYPES:
+            return debit - credit
+        return credit - debit
+
+    @staticmethod
+    def apply_delta(account_id, debit, credit, using=None, moment=None):
+        """
+        إضافة مدين/دائن إلى رصيد حساب بعملية UPDATE واحدة
+
+        إشارة الرصيد تحسب داخل قاعدة البيانات حسب نوع الحساب، فلا حاجة لقراءة
+        الحساب أولاً ولا يضيع أي تحديث متزامن. moment تاريخ القيد لرصيد الشهر.
+        """
+        from .models import Account
+
+        debit = Decimal(debit or 0)
+        credit = Decimal(credit or 0)
+        if not debit and not credit:
+            return 0
+
+        AccountPeriodLedger.apply_totals({account_id: (debit, credit)}, moment, using=using)
+        return Account.objects.using(using or get_current_db_alias()).filter(pk=account_id).update(
+            balance=F('balance') + Case(
+                When(account_type__in=DEBIT_NATURE_TYPES, then=Value(debit - credit)),
+                default=Value(credit - debit),
+                output_field=_balance_field()
+            ),
+            debit_balance=F('debit_balance') + Value(debit, output_field=_balance_field()),
+            credit_balance=F('credit_balance') + Value(credit, output_field=_balance_field())
+        )
+
+    @classmethod
+    def apply_totals(cls, totals, sign=1, using=None, batch_size=500, moment=None):
+        """
+        تطبيق مجاميع {account_id: (debit, credit)} على الحسابات
+
+        عملية UPDATE واحدة لكل batch_size حساب:
+        SET balance = balance + CASE id WHEN ... END (والإشارة حسب نوع الحساب داخل SQL)
+        """
+        from .models import Account
+
+        deltas = []
+        for account_id, (debit, credit) in totals.items():
+            debit = sign * Decimal(debit or 0)
+            credit = sign * Decimal(credit or 0)
+            if debit or credit:
+                deltas.append((account_id, debit, credit))
+        if len(deltas) == 1:
+            return cls.apply_delta(*deltas[0], using=using, moment=moment)
+
+        AccountPeriodLedger.apply_totals(
+            {account_id: (debit, credit) for account_id, debit, credit in deltas}, moment,
+            using=using, batch_size=batch_size
+        )
+        accounts = Account.objects.using(using or get_current_db_alias())
+        updated = 0
+        for start in range(0, len(deltas), batch_size):
+            chunk = deltas[start:start + batch_size]
+
+            def case(value_of):
+                return Case(
+                    *[When(pk=account_id, then=Value(value_of(debit, credit), output_field=_balance_field()))
+                      for account_id, debit, credit in chunk],
+                    default=Value(_ZERO),
+                    output_field=_balance_field()
+                )
+
+            updated += accounts.filter(pk__in=[account_id for account_id, _, _ in chunk]).update(
+                balance=F('balance') + Case(
+                    When(account_type__in=DEBIT_NATURE_TYPES, then=case(lambda debit, credit: debit - credit)),
+                    default=case(lambda debit, credit: credit - debit),
+                    output_field=_balance_field()
+                ),
+                debit_balance=F('debit_balance') + case(lambda debit, credit: debit),
+                credit_balance=F('credit_balance') + case(lambda debit, credit: credit)
+            )
+        return updated
+
+    @classmethod
+    def apply_entry(cls, entry, sign=1, using=None):
+        """تطبيق جميع أسطر قيد باستعلام واحد مجمع حسب الحساب"""
+        from .models import JournalEntryLine
+
+        db = using or entry._state.db or get_current_db_alias()
+        rows = (
+            JournalEntryLine._base_manager.using(db)
+            .filter(journal_entry_id=entry.pk)
+            .values('account')
+            .annotate(debit_sum=Sum('debit'), credit_sum=Sum('credit'))
+            .order_by()
+        )
+        cls.apply_totals(
+            {row['account']: (row['debit_sum'], row['credit_sum']) for row in rows}, sign,
+            using=db, moment=entry.created_at
+        )
+
+    @classmethod
+    def compute(cls, account_ids=None, using=None):
+        """
+        حساب الأرصدة الصحيحة من القيود المرحلة
+
+        يرجع {account_id: (balance, debit, credit)} لجميع الحسابات باستعلام
+        تجميع واحد على أسطر القيود واستعلام واحد على الحسابات.
+        """
+        from .models import Account, JournalEntryLine
+
+        db = using or get_current_db_alias()
+        lines = JournalEntryLine._base_manager.using(db).filter(journal_entry__is_posted=True)
+        accounts = Account.objects.using(db)
+        if account_ids is not None:
+            lines = lines.filter(account_id__in=account_ids)
+            accounts = accounts.filter(pk__in=account_ids)
+
+        totals = {
+            row['account']: (row['debit_sum'] or _ZERO, row['credit_sum'] or _ZERO)
+            for row in lines.values('account').annotate(
+                debit_sum=Sum('debit'), credit_sum=Sum('credit')
+            ).order_by()
+        }
+
+        expected = {}
+        for account_id, account_type, opening_balance in accounts.values_list('id', 'account_type', 'opening_balance'):
+            debit, credit = totals.get(account_id, (_ZERO, _ZERO))
+            balance = (opening_balance or _ZERO) + cls.signed_balance(account_type, debit, credit)
+            expected[account_id] = (
+                balance.quantize(_CENTS),
+                Decimal(debit).quantize(_CENTS),
+                Decimal(credit).quantize(_CENTS),
+            )
+        return expected
+
+    @classmethod
+    def rebuild(cls, account_ids=None, using=None, batch_size=500, dry_run=False):
+        """
+        مطابقة كاملة للأرصدة مع القيود المرحلة
+
+        يتم تحديث الحسابات المختلفة فقط بـ bulk_update على دفعات، ويرجع تقرير
+        الانحراف: قائمة بالحسابات التي كان رصيدها المخزن مختلفاً عن القيود.
+        """
+        from .models import Account
+
+        db = using or get_current_db_alias()
+        expected = cls.compute(account_ids, using=db)
+
+        changed = []
+        drift = []
+        accounts = Account.objects.using(db).filter(pk__in=list(expected.keys())).only('id', 'account_code', *BALANCE_FIELDS)
+        for account in accounts.iterator():
+            balance, debit, credit = expected[account.id]
+            if (account.balance, account.debit_balance, account.credit_balance) != (balance, debit, credit):
+                drift.append({
+                    'account_id': account.id,
+                    'account_code': account.account_code,
+                    'stored_balance': account.balance,
+                    'expected_balance': balance,
+                    'difference': balance - (account.balance or _ZERO),
+                })
+                account.balance = balance
+                account.debit_balance = debit
+                account.credit_balance = credit
+                changed.append(account)
+
+        if changed and not dry_run:
+            for start in range(0, len(changed), batch_size):
+                Account.objects.using(db).bulk_update(changed[start:start + batch_size], BALANCE_FIELDS)
+        return drift
+
+
+def _line_state(line):
+    return (line.account_id, line.debit or _ZERO, line.credit or _ZERO)
+
+
+def _entry_is_posted(line):
+    try:
+        return bool(line.journal_entry.is_posted)
+    except Exception:
+        return False
+
+
+def _entry_moment(line):
+    """تاريخ القيد لرصيد الشهر (القيد محمل من _entry_is_posted)"""
+    try:
+        return line.journal_entry.created_at
+    except Exception:
+        return None
+
+
+@receiver(post_init, sender='core.JournalEntry')
+def remember_entry_posted(sender, instance, **kwargs):
+    """حفظ حالة الترحيل عند التحميل لاكتشاف الترحيل لاحقاً"""
+    instance._ledger_posted = bool(instance.__dict__.get('is_posted'))
+
+
+@receiver(post_save, sender='core.JournalEntry')
+def journal_entry_posted(sender, instance, created, raw=False, **kwargs):
+    """إضافة أو عكس أسطر القيد عند تغيير حالة الترحيل"""
+    posted = bool(instance.is_posted)
+    was_posted = getattr(instance, '_ledger_posted', posted)
+    instance._ledger_posted = posted
+    if raw or created or posted == was_posted:
+        return
+    AccountBalanceLedger.apply_entry(instance, 1 if posted else -1, using=kwargs.get('using'))
+
+
+@receiver(post_init, sender='core.JournalEntryLine')
+def remember_line_state(sender, instance, **kwargs):
+    """حفظ الحساب والمبالغ عند التحميل لعكسها عند التعديل"""
+    values = instance.__dict__
+    if instance.pk and all(name in values for name in ('account_id', 'debit', 'credit')):
+        instance._ledger_state = _line_state(instance)
+
+
+@receiver(post_save, sender='core.JournalEntryLine')
+def journal_line_saved(sender, instance, created, raw=False, **kwargs):
+    """تحديث رصيد الحساب عند إضافة أو تعديل سطر في قيد مرحل"""
+    new_state = _line_state(instance)
+    old_state = getattr(instance, '_ledger_state', None)
+    instance._ledger_state = new_state
+    if raw or not _entry_is_posted(instance):
+        return
+
+    using = kwargs.get('using')
+    if not created and old_state is not None:
+        if old_state == new_state:
+            return
+        account_id, debit, credit = old_state
+        AccountBalanceLedger.apply_delta(account_id, -debit, -credit, using=using, moment=_entry_moment(instance))
+
+    account_id, debit, credit = new_state
+    AccountBalanceLedger.apply_delta(account_id, debit, credit, using=using, moment=_entry_moment(instance))
+
+
+@receiver(post_delete, sender='core.JournalEntryLine')
+def journal_line_deleted(sender, instance, **kwargs):
+    """عكس السطر المحذوف من رصيد الحساب"""
+    if not _entry_is_posted(instance):
+        return
+    account_id, debit, credit = getattr(instance, '_ledger_state', None) or _line_state(instance)
+    AccountBalanceLedger.apply_delta(
+        account_id, -debit, -credit, using=kwargs.get('using'), moment=_entry_moment(instance)
+    )
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+شجرة الحسابات بالمسار الكامل (materialized path)
+
+كل حساب يحفظ مساره من الجذر بأرقام الحسابات: /1/12/1201/ ومستواه في الشجرة.
+- الترتيب حسب tree_path يعطي الشجرة كاملة بالترتيب (الأب ثم فروعه)
+- فروع أي حساب: tree_path يبدأ بمسار الحساب (استعلام واحد على فهرس)
+- المسار يحسب عند الحفظ، وعند تغيير الأب أو رقم الحساب يتم تحديث مسارات
+  جميع الفروع بعملية UPDATE واحدة
+
+المجاميع لكل مستوى (rollup) تحسب بمرور واحد في الذاكرة على الحسابات المرتبة.
+بناء المسارات للبيانات الموجودة: python manage.py rebuild_account_tree
+"""
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db.models import F, Value
+from django.db.models.functions import Concat, Substr
+from django.db.models.signals import post_init, pre_save, post_save
+from django.dispatch import receiver
+
+from .database_router import get_current_db_alias
+
+SEPARATOR = '/'
+
+_ZERO = Decimal('0')
+
+
+def _accounts(using=None):
+    from .models import Account
+    return Account._base_manager.using(using or get_current_db_alias())
+
+
+class AccountTree:
+    """مسارات شجرة الحسابات والمجاميع المتراكمة"""
+
+    @staticmethod
+    def build_path(parent_path, account_code):
+        return f"{parent_path or SEPARATOR}{account_code}{SEPARATOR}"
+
+    @classmethod
+    def parent_path(cls, parent_id, using=None):
+        """(مسار الأب، مستواه) من الحساب المحفوظ، أو بالصعود للجذر إذا لم يبنى بعد"""
+        accounts = _accounts(using)
+        row = accounts.filter(pk=parent_id).values_list('tree_path', 'tree_depth').first()
+        if row is None:
+            return SEPARATOR, -1
+        if row[0]:
+            return row
+
+        codes = []
+        seen = set()
+        current = parent_id
+        while current is not None and current not in seen:
+            seen.add(current)
+            account = accounts.filter(pk=current).values_list('account_code', 'parent_account_id').first()
+            if account is None:
+                break
+            codes.append(account[0])
+            current = account[1]
+        path = SEPARATOR + ''.join(f"{code}{SEPARATOR}" for code in reversed(codes))
+        return path, len(codes) - 1
+
+    @staticmethod
+    def subtree(root, using=None):
+        """الحساب root وجميع فروعه في نفس الشركة"""
+        return _accounts(using).filter(company_id=root.company_id, tree_path__startswith=root.tree_path)
+
+    @classmethod
+    def find(cls, account_code, company_id=None, using=None):
+        """الحساب برقمه (للفلترة: جميع الحسابات تحت 12)"""
+        accounts = _accounts(using).filter(account_code=account_code)
+        if company_id:
+            accounts = accounts.filter(company_id=company_id)
+        return accounts.first()
+
+    @classmethod
+    def ensure_paths(cls, using=None):
+        """بناء المسارات إذا وجدت حسابات بدون مسار (بيانات قبل إضافة الشجرة)"""
+        if _accounts(using).filter(tree_path='').exists():
+            cls.rebuild(using=using)
+
+    @classmethod
+    def rollup(cls, root=None, company_id=None, using=None):
+        """
+        الشجرة مرتبة مع مجموع كل حساب وفروعه
+
+        استعلام واحد مرتب بالمسار ثم مرور واحد بمكدس: عند الخروج من فرع يضاف
+        مجموعه لأبيه. يرجع قائمة الحسابات (الأب قبل فروعه) وفي كل حساب subtotal
+        و children_count و is_leaf.
+        """
+        cls.ensure_paths(using)
+        accounts = _accounts(using)
+        if root is not None:
+            accounts = cls.subtree(root, using)
+        elif company_id:
+            accounts = accounts.filter(company_id=company_id)
+        nodes = list(accounts.order_by('company_id', 'tree_path'))
+
+        stack = []
+
+        def close_until(node):
+            while stack and not (
+                node is not None
+                and node.company_id == stack[-1].company_id
+                and node.tree_path.startswith(stack[-1].tree_path)
+            ):
+                done = stack.pop()
+                done.is_leaf = done.children_count == 0
+                if stack:
+                    stack[-1].subtotal += done.subtotal
+
+        for node in nodes:
+            node.subtotal = node.balance or _ZERO
+            node.children_count = 0
+            close_until(node)
+            if stack:
+                stack[-1].children_count += 1
+            stack.append(node)
+        close_until(None)
+        return nodes
+
+    @staticmethod
+    def as_dict(node):
+        return {
+            'id': node.id,
+            'code': node.account_code,
+            'name': node.name,
+            'type': node.account_type,
+            'parent_id': node.parent_account_id,
+            'depth': node.tree_depth,
+            'path': node.tree_path,
+            'balance': float(node.balance or 0),
+            'subtotal': float(node.subtotal),
+            'children_count': node.children_count,
+            'is_leaf': node.is_leaf,
+        }
+
+    @classmethod
+    def rebuild(cls, using=None, batch_size=500, dry_run=False):
+        """
+        حساب مسارات جميع الحسابات من parent_account باستعلام واحد
+
+        يرجع قائمة الحسابات التي تغير مسارها. الحلقات (حساب أب لأحد أجداده)
+        تقطع ويصبح الحساب جذراً.
+        """
+        from .models import Account
+
+        db = using or get_current_db_alias()
+        rows = {
+            row[0]: row for row in _accounts(db).values_list(
+                'id', 'account_code', 'parent_account_id', 'tree_path', 'tree_depth'
+            )
+        }
+        paths = {}
+
+        def resolve(account_id, visiting):
+            if account_id in paths:
+                return paths[account_id]
+            _, code, parent_id, _, _ = rows[account_id]
+            if parent_id in rows and parent_id not in visiting:
+                visiting.add(account_id)
+                parent_path, parent_depth = resolve(parent_id, visiting)
+                visiting.discard(account_id)
+            else:
+                parent_path, parent_depth = SEPARATOR, -1
+            paths[account_id] = (cls.build_path(parent_path, code), parent_depth + 1)
+            return paths[account_id]
+
+        changed = []
+        for account_id, (_, _, _, tree_path, tree_depth) in rows.items():
+            path, depth = resolve(account_id, set())
+            if (tree_path, tree_depth) != (path, depth):
+                changed.append(Account(pk=account_id, tree_path=path, tree_depth=depth))
+
+        if not dry_run:
+            for start in range(0, len(changed), batch_size):
+                _accounts(db).bulk_update(changed[start:start + batch_size], ['tree_path', 'tree_depth'])
+        return changed
+
+
+@receiver(post_init, sender='core.Account')
+def remember_account_path(sender, instance, **kwargs):
+    """حفظ المسار عند التحميل لتحديث الفروع إذا تغير"""
+    instance._tree_state = (instance.__dict__.get('tree_path'), instance.__dict__.get('tree_depth'))
+
+
+@receiver(pre_save, sender='core.Account')
+def compute_account_path(sender, instance, raw=False, **kwargs):
+    """حساب مسار الحساب من مسار أبيه"""
+    if raw:
+        return
+    using = kwargs.get('using')
+    if instance.parent_account_id:
+        parent_path, parent_depth = AccountTree.parent_path(instance.parent_account_id, using)
+    else:
+        parent_path, parent_depth = SEPARATOR, -1
+
+    old_path = (getattr(instance, '_tree_state', None) or (None, None))[0]
+    if instance.pk and old_path and parent_path.startswith(old_path):
+        raise ValidationError('لا يمكن جعل الحساب فرعاً من نفسه أو من أحد فروعه')
+
+    instance.tree_path = AccountTree.build_path(parent_path, instance.account_code)
+    instance.tree_depth = parent_depth + 1
+
+
+@receiver(post_save, sender='core.Account')
+def move_account_subtree(sender, instance, created, raw=False, **kwargs):
+    """تحديث مسارات الفروع بعملية واحدة عند تغيير الأب أو رقم الحساب"""
+    old_path, old_depth = getattr(instance, '_tree_state', None) or (None, None)
+    instance._tree_state = (instance.tree_path, instance.tree_depth)
+    if raw or created or not old_path or old_path == instance.tree_path:
+        return
+
+    # يشمل الحساب نفسه إذا تم الحفظ بـ update_fields بدون tree_path
+    _accounts(kwargs.get('using')).filter(
+        company_id=instance.company_id, tree_path__startswith=old_path
+    ).update(
+        tree_path=Concat(Value(instance.tree_path), Substr('tree_path', len(old_path) + 1)),
+        tree_depth=F('tree_depth') + (instance.tree_depth - (old_depth or 0))
+    )
@@ -72,53 +72,19 @@ def accounts_list_view(request):
 @subscription_required
 @permission_required('accounts', 'view')
 def customer_statement_view(request, customer_id):
-    """كشف حساب العميل"""
-    customer = get_object_or_404(Customer, id=customer_id)
+    """كشف حساب العميل (صفحات بـ ?cursor= من الأحدث)"""
+    from .statements import PartyStatement, statement_page
     
-    # جلب الفواتير والدفعات
-    sales = Sale.objects.filter(customer=customer, status='confirmed').order_by('-created_at')
-    try:
-        payments = CustomerPayment.objects.filter(customer=customer).order_by('-created_at')
-    except:
-        payments = []
-    
-    # دمج المعاملات
-    transactions = []
-    
-    # إضافة الفواتير
-    for sale in sales:
-        transactions.append({
-            'date': sale.created_at.date(),
-            'description': f'فاتورة بيع #{sale.invoice_number}',
-            'debit': sale.total_amount,
-            'credit': 0,
-            'type': 'sale'
-        })
-    
-    # إضافة الدفعات
-    for payment in payments:
-        transactions.append({
-            'date': payment.payment_date,
-            'description': f'دفعة #{payment.payment_number}',
-            'debit': 0,
-            'credit': payment.amount,
-            'type': 'payment'
-        })
-    
-    # ترتيب المعاملات حسب التاريخ
-    transactions.sort(key=lambda x: x['date'], reverse=True)
-    
-    # حساب الرصيد التراكمي
-    running_balance = customer.opening_balance
-    for transaction in reversed(transactions):
-        running_balance += transaction['debit'] - transaction['credit']
-        transaction['balance'] = running_balance
+    customer = get_object_or_404(Customer, id=customer_id)
+    statement = statement_page(request, PartyStatement.for_customer(customer))
     
     context = {
         'customer': customer,
-        'transactions': transactions,
-        'opening_balance': customer.opening_balance,
-        'final_balance': running_balance,
+        'transactions': statement['transactions'],
+        'opening_balance': statement['opening_balance'],
+        'final_balance': statement['final_balance'],
+        'next_cursor': statement['next_cursor'],
+        'has_more': statement['has_more'],
         'currency_symbol': 'د.ك',
     }
     return render(request, 'accounting/customer_statement.html', context)
@@ -127,53 +93,19 @@ def customer_statement_view(request, customer_id):
 @subscription_required
 @permission_required('accounts', 'view')
 def supplier_statement_view(request, supplier_id):
-    """كشف حساب المورد"""
-    supplier = get_object_or_404(Supplier, id=supplier_id)
+    """كشف حساب المورد (صفحات بـ ?cursor= من الأحدث)"""
+    from .statements import PartyStatement, statement_page
     
-    # جلب المشتريات والدفعات
-    purchases = Purchase.objects.filter(supplier=supplier, status='confirmed').order_by('-created_at')
-    try:
-        payments = SupplierPayment.objects.filter(supplier=supplier).order_by('-created_at')
-    except:
-        payments = []
-    
-    # دمج المعاملات
-    transactions = []
-    
-    # إضافة المشتريات
-    for purchase in purchases:
-        transactions.append({
-            'date': purchase.created_at.date(),
-            'description': f'فاتورة شراء #{purchase.invoice_number}',
-            'debit': 0,
-            'credit': purchase.total_amount,
-            'type': 'purchase'
-        })
-    
-    # إضافة الدفعات
-    for payment in payments:
-        transactions.append({
-            'date': payment.payment_date,
-            'description': f'دفعة #{payment.payment_number}',
-            'debit': payment.amount,
-            'credit': 0,
-            'type': 'payment'
-        })
-    
-    # ترتيب المعاملات حسب التاريخ
-    transactions.sort(key=lambda x: x['date'], reverse=True)
-    
-    # حساب الرصيد التراكمي
-    running_balance = supplier.opening_balance
-    for transaction in reversed(transactions):
-        running_balance += transaction['credit'] - transaction['debit']
-        transaction['balance'] = running_balance
+    supplier = get_object_or_404(Supplier, id=supplier_id)
+    statement = statement_page(request, PartyStatement.for_supplier(supplier))
     
     context = {
         'supplier': supplier,
-        'transactions': transactions,
-        'opening_balance': supplier.opening_balance,
-        'final_balance': running_balance,
+        'transactions': statement['transactions'],
+        'opening_balance': statement['opening_balance'],
+        'final_balance': statement['final_balance'],
+        'next_cursor': statement['next_cursor'],
+        'has_more': statement['has_more'],
         'currency_symbol': 'د.ك',
     }
     return render(request, 'accounting/supplier_statement.html', context)
@@ -182,34 +114,44 @@ def supplier_statement_view(request, supplier_id):
 @subscription_required
 @permission_required('accounts', 'view')
 def trial_balance_view(request):
-    """ميزان المراجعة"""
+    """ميزان المراجعة (الحالي، أو بتاريخ سابق بـ ?date_from=&date_to=)"""
+    from .period_balances import period_account_balances
+    
+    date_from, date_to, period_balances = period_account_balances(request.GET)
     accounts = Account.objects.all().order_by('account_code')
     total_debits = 0
     total_credits = 0
     
     account_balances = []
     for account in accounts:
+        period = period_balances.get(account.id) if period_balances is not None else None
+        balance = period['closing'] if period else account.balance
         if account.account_type in ['asset', 'expense']:
-            debit_balance = account.balance if account.balance > 0 else 0
+            debit_balance = balance if balance > 0 else 0
             credit_balance = 0
         else:
             debit_balance = 0
-            credit_balance = account.balance if account.balance > 0 else 0
+            credit_balance = balance if balance > 0 else 0
         
         total_debits += debit_balance
         total_credits += credit_balance
         
-        account_balances.append({
+        row = {
             'account': account,
             'debit': debit_balance,
             'credit': credit_balance
-        })
+        }
+        if period:
+            row.update({'opening': period['opening'], 'period_debit': period['debit'], 'period_credit': period['credit']})
+        account_balances.append(row)
     
     context = {
         'account_balances': account_balances,
         'total_debits': total_debits,
         'total_credits': total_credits,
         'is_balanced': total_debits == total_credits,
+        'date_from': date_from,
+        'date_to': date_to,
         'currency_symbol': 'د.ك',
     }
     return render(request, 'accounting/trial_balance.html', context)
@@ -218,14 +160,29 @@ def trial_balance_view(request):
 @subscription_required
 @permission_required('accounts', 'view')
 def income_statement_view(request):
-    """قائمة الدخل"""
+    """قائمة الدخل (الحالية، أو لفترة بـ ?date_from=&date_to=)"""
+    from .period_balances import period_account_balances
+    
+    date_from, date_to, period_balances = period_account_balances(request.GET)
+    
     # حساب الإيرادات
     revenue_accounts = Account.objects.filter(account_type='revenue')
-    total_revenue = revenue_accounts.aggregate(Sum('balance'))['balance__sum'] or 0
-    
     # حساب المصروفات
     expense_accounts = Account.objects.filter(account_type='expense')
-    total_expenses = expense_accounts.aggregate(Sum('balance'))['balance__sum'] or 0
+    
+    if period_balances is None:
+        total_revenue = revenue_accounts.aggregate(Sum('balance'))['balance__sum'] or 0
+        total_expenses = expense_accounts.aggregate(Sum('balance'))['balance__sum'] or 0
+    else:
+        # حركة الفترة فقط: الإيراد دائن - مدين والمصروف مدين - دائن (الرصيد للعرض فقط بدون حفظ)
+        revenue_accounts = list(revenue_accounts)
+        expense_accounts = list(expense_accounts)
+        for account in revenue_accounts + expense_accounts:
+            period = period_balances.get(account.id)
+            movement = (period['debit'] - period['credit']) if period else 0
+            account.balance = movement if account.account_type == 'expense' else -movement
+        total_revenue = sum(account.balance for account in revenue_accounts)
+        total_expenses = sum(account.balance for account in expense_accounts)
     
     # صافي الدخل
     net_income = total_revenue - total_expenses
@@ -236,6 +193,8 @@ def income_statement_view(request):
         'total_revenue': total_revenue,
         'total_expenses': total_expenses,
         'net_income': net_income,
+        'date_from': date_from,
+        'date_to': date_to,
         'currency_symbol': 'د.ك',
     }
     return render(request, 'income_statement.html', context)
@@ -271,74 +230,52 @@ def balance_sheet_view(request):
 
 @login_required
 def search_accounts_api(request):
-    """API البحث في الحسابات"""
+    """API البحث في الحسابات (بالاسم أو رقم الحساب من فهرس البحث السريع)"""
+    from .typeahead import Typeahead
+    
     query = request.GET.get('q', '').strip()
     
     if not query:
         return JsonResponse({'accounts': []})
     
-    accounts = Account.objects.filter(
-        Q(name__icontains=query) |
-        Q(account_code__icontains=query)
-    )[:10]
+    accounts_data = Typeahead.search('account', query, limit=10)
     
-    accounts_data = []
-    for account in accounts:
-        accounts_data.append({
-            'id': account.id,
-            'name': account.name,
-            'code': account.account_code,
-            'type': account.get_account_type_display(),
-            'balance': float(account.balance)
-        })
+    # الرصيد يتغير مع كل ترحيل فيقرأ بالمفتاح الأساسي للنتائج فقط
+    balances = dict(
+        Account._base_manager.filter(id__in=[account['id'] for account in accounts_data]).values_list('id', 'balance')
+    )
+    accounts_data = [
+        {**account, 'balance': float(balances.get(account['id']) or 0)}
+        for account in accounts_data
+    ]
     
     return JsonResponse({'accounts': accounts_data})
 
 @login_required
 def search_customers_api(request):
-    """API البحث في العملاء"""
+    """API البحث في العملاء (بالاسم أو جزء من رقم الهاتف بأي صيغة)"""
+    from .typeahead import Typeahead
+    
     query = request.GET.get('q', '').strip()
     
     if not query:
         return JsonResponse({'customers': []})
     
-    customers = Customer.objects.filter(
-        Q(name__icontains=query) |
-        Q(phone__icontains=query)
-    )[:10]
-    
-    customers_data = []
-    for customer in customers:
-        customers_data.append({
-            'id': customer.id,
-            'name': customer.name,
-            'phone': customer.phone,
-            'balance': float(customer.opening_balance)
-        })
+    customers_data = Typeahead.search('customer', query, limit=10)
     
     return JsonResponse({'customers': customers_data})
 
 @login_required
 def search_suppliers_api(request):
-    """API البحث في الموردين"""
+    """API البحث في الموردين (بالاسم أو جزء من رقم الهاتف بأي صيغة)"""
+    from .typeahead import Typeahead
+    
     query = request.GET.get('q', '').strip()
     
     if not query:
         return JsonResponse({'suppliers': []})
     
-    suppliers = Supplier.objects.filter(
-        Q(name__icontains=query) |
-        Q(phone__icontains=query)
-    )[:10]
-    
-    suppliers_data = []
-    for supplier in suppliers:
-        suppliers_data.append({
-            'id': supplier.id,
-            'name': supplier.name,
-            'phone': supplier.phone,
-            'balance': float(supplier.opening_balance)
-        })
+    suppliers_data = Typeahead.search('supplier', query, limit=10)
     
     return JsonResponse({'suppliers': suppliers_data})
 
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+أعمار ديون العملاء والموردين
+
+تقرير الأعمار لدفتر كامل (جميع العملاء أو جميع الموردين) استعلام واحد بتجميع
+شرطي على UNION ALL من الفواتير والمرتجعات والدفعات والأرصدة الافتتاحية:
+- المتبقي من كل فاتورة مؤكدة (total_amount - paid_amount) يدخل شريحة العمر حسب
+  due_date (أو تاريخ الفاتورة إذا لم يحدد): 0-30 / 31-60 / 61-90 / أكثر من 90
+- الرصيد الافتتاحي المدين يعتبر أقدم دين (أكثر من 90)
+- الدفعات والمرتجعات المؤكدة تسدد الأقدم أولاً (FIFO) بعد الاستعلام
+
+النتيجة محفوظة في الكاش بإصدار خاص بالدفتر في قاعدة بيانات الشركة يزيد مع أي
+تعديل على الفواتير أو المرتجعات أو الدفعات أو الأرصدة الافتتاحية، وبتاريخ اليوم
+لأن الأعمار تتغير يومياً بدون أي تعديل.
+"""
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .database_router import get_current_db_alias
+from .settings_cache import currency_quantum, to_money
+from .versioned_cache import LRUCache, get_versions, bump_version
+
+CACHE_TIMEOUT = 3600
+
+BUCKETS = ('days_0_30', 'days_31_60', 'days_61_90', 'days_over_90')
+
+# نوع الحركة في الاستعلام
+_INVOICE, _RETURN, _PAYMENT, _OPENING = 0, 1, 2, 3
+
+_ZERO = Decimal('0')
+
+_local = LRUCache(
+    maxsize=getattr(settings, 'AGING_LOCAL_CACHE_SIZE', 64),
+    ttl=getattr(settings, 'AGING_LOCAL_CACHE_TTL', 60)
+)
+
+
+def aging_version_key(alias, ledger):
+    return f"aging_version:{alias}:{ledger}"
+
+
+def invalidate_aging(ledger, alias=None):
+    """إبطال تقرير أعمار الدفتر (customer أو supplier) في جميع العمليات"""
+    bump_version(aging_version_key(alias or get_current_db_alias(), ledger))
+
+
+class AgingReport:
+    """تقرير أعمار الديون لدفتر العملاء أو الموردين"""
+
+    LEDGERS = {
+        'customer': ('Customer', 'Sale', 'SaleReturn', 'CustomerPayment'),
+        'supplier': ('Supplier', 'Purchase', 'PurchaseReturn', 'SupplierPayment'),
+    }
+
+    @classmethod
+    def _sql(cls, ledger, connection):
+        from django.apps import apps
+
+        qn = connection.ops.quote_name
+        party_model, invoice_model, return_model, payment_model = (
+            apps.get_model('core', name) for name in cls.LEDGERS[ledger]
+        )
+        party = qn(f'{ledger}_id')
+        table = lambda model: qn(model._meta.db_table)
+
+        union = (
+            f"SELECT {party} AS party_id, {_INVOICE} AS kind, total_amount AS amount, paid_amount AS paid, "
+            f"COALESCE(due_date, DATE(created_at)) AS due, "
+            f"CASE WHEN status = 'confirmed' THEN 1 ELSE 0 END AS is_open, NULL AS name "
+            f"FROM {table(invoice_model)} "
+            f"UNION ALL "
+            f"SELECT {party}, {_RETURN}, total_amount, 0, NULL, 1, NULL "
+            f"FROM {table(return_model)} WHERE status = 'confirmed' "
+            f"UNION ALL "
+            f"SELECT {party}, {_PAYMENT}, amount, 0, NULL, 1, NULL FROM {table(payment_model)} "
+            f"UNION ALL "
+            f"SELECT id, {_OPENING}, opening_balance, 0, NULL, 1, name FROM {table(party_model)}"
+        )
+        outstanding = f"CASE WHEN kind = {_INVOICE} AND is_open = 1 AND %s THEN amount - paid ELSE 0 END"
+        return (
+            f"SELECT party_id, MAX(name), "
+            f"SUM({outstanding % 'due >= %s'}), "
+            f"SUM({outstanding % '(due >= %s AND due < %s)'}), "
+            f"SUM({outstanding % '(due >= %s AND due < %s)'}), "
+            f"SUM({outstanding % 'due < %s'}), "
+            f"COUNT(CASE WHEN kind = {_INVOICE} THEN 1 END), "
+            f"SUM(CASE WHEN kind = {_INVOICE} AND is_open = 1 THEN amount ELSE 0 END), "
+            f"SUM(CASE WHEN kind = {_INVOICE} AND is_open = 1 THEN paid ELSE 0 END), "
+            f"SUM(CASE WHEN kind = {_RETURN} THEN amount ELSE 0 END), "
+            f"SUM(CASE WHEN kind = {_PAYMENT} THEN amount ELSE 0 END), "
+            f"SUM(CASE WHEN kind = {_OPENING} THEN amount ELSE 0 END) "
+            f"FROM ({union}) tx GROUP BY party_id"
+        )
+
+    @staticmethod
+    def _row(party_id, name, buckets, invoices_count, total, paid, returns, payments, opening, quantum):
+        """صف العميل/المورد بعد تسديد الدفعات والمرتجعات من الأقدم"""
+        buckets = [to_money(value, quantum) for value in buckets]
+        total, paid, returns, payments, opening = (
+            to_money(value, quantum) for value in (total, paid, returns, payments, opening)
+        )
+
+        credit = returns + payments
+        if opening > 0:
+            buckets[-1] += opening
+        else:
+            credit -= opening
+        for index in range(len(buckets) - 1, -1, -1):
+            applied = min(credit, buckets[index]) if buckets[index] > 0 else _ZERO
+            buckets[index] -= applied
+            credit -= applied
+
+        row = {
+            'id': party_id,
+            'name': name,
+            'invoices_count': invoices_count or 0,
+            'total_invoiced': total,
+            'paid_amount': paid,
+            'total_returns': returns,
+            'total_payments': payments,
+            'opening_balance': opening,
+            'unapplied_credit': credit,
+            'balance': opening + total - paid - returns - payments,
+        }
+        row.update(zip(BUCKETS, buckets))
+        return row
+
+    @classmethod
+    def empty_row(cls, party_id, name, opening_balance=0, using=None):
+        """صف عميل أو مورد بدون حركات (أضيف بعد حفظ التقرير)"""
+        quantum = currency_quantum(alias=using)
+        return cls._row(party_id, name, [0] * len(BUCKETS), 0, 0, 0, 0, 0, opening_balance, quantum)
+
+    @classmethod
+    def compute(cls, ledger, today=None, using=None):
+        """تقرير الدفتر من قاعدة البيانات: {party_id: row} باستعلام واحد"""
+        db = using or get_current_db_alias()
+        today = today or date.today()
+        day_30, day_60, day_90 = (today - timedelta(days=days) for days in (30, 60, 90))
+
+        connection = connections[db]
+        with connection.cursor() as cursor:
+            cursor.execute(cls._sql(ledger, connection), [day_30, day_60, day_30, day_90, day_60, day_90])
+            rows = cursor.fetchall()
+        quantum = currency_quantum(alias=db)
+        return {
+            row[0]: cls._row(row[0], row[1], row[2:6], *row[6:], quantum)
+            for row in rows
+        }
+
+    @classmethod
+    def book(cls, ledger='customer', today=None, using=None):
+        """تقرير الدفتر من الذاكرة أو الكاش أو قاعدة البيانات"""
+        db = using or get_current_db_alias()
+        today = today or date.today()
+        version = get_versions([aging_version_key(db, ledger)])[0]
+        if version is None:
+            return cls.compute(ledger, today, db)
+
+        key = f"aging:{db}:{ledger}:{today.isoformat()}:v{version}"
+        entry = _local.get(key)
+        if entry is None:
+            entry = cache.get(key)
+            if entry is None:
+                entry = (cls.compute(ledger, today, db),)
+                cache.set(key, entry, CACHE_TIMEOUT)
+            _local.set(key, entry)
+        return entry[0]
+
+    @classmethod
+    def party(cls, ledger, party_id, using=None):
+        """صف عميل أو مورد واحد من تقرير الدفتر المحفوظ"""
+        return cls.book(ledger, using=using).get(party_id)
+
+    @staticmethod
+    def totals(rows):
+        """مجموع الشرائح والأرصدة لقائمة صفوف"""
+        fields = BUCKETS + ('balance', 'unapplied_credit')
+        return {field: sum((row[field] for row in rows), _ZERO) for field in fields}
+
+
+@receiver(post_save, sender='core.Customer')
+@receiver(post_delete, sender='core.Customer')
+@receiver(post_save, sender='core.Sale')
+@receiver(post_delete, sender='core.Sale')
+@receiver(post_save, sender='core.SaleReturn')
+@receiver(post_delete, sender='core.SaleReturn')
+@receiver(post_save, sender='core.CustomerPayment')
+@receiver(post_delete, sender='core.CustomerPayment')
+def customer_ledger_changed(sender, instance, **kwargs):
+    invalidate_aging('customer', kwargs.get('using'))
+
+
+@receiver(post_save, sender='core.Supplier')
+@receiver(post_delete, sender='core.Supplier')
+@receiver(post_save, sender='core.Purchase')
+@receiver(post_delete, sender='core.Purchase')
+@receiver(post_save, sender='core.PurchaseReturn')
+@receiver(post_delete, sender='core.PurchaseReturn')
+@receiver(post_save, sender='core.SupplierPayment')
+@receiver(post_delete, sender='core.SupplierPayment')
+def supplier_ledger_changed(sender, instance, **kwargs):
+    invalidate_aging('supplier', kwargs.get('using'))
@@ -5,4 +5,17 @@ class CoreConfig(AppConfig):
     name = 'core'
     
     def ready(self):
-        import core.signals
\ No newline at end of file
+        import core.signals
+        import core.account_ledger
+        import core.stock_ledger
+        import core.settings_cache
+        import core.permission_cache
+        import core.tenant_cache
+        import core.pos_session_totals
+        import core.statements
+        import core.aging
+        import core.account_tree
+        import core.product_search
+        import core.barcode_map
+        import core.pos_catalog
+        import core.typeahead
@@ -1,7 +1,5 @@
-from django.db import transaction
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from django.utils import timezone
 from .models import *
 from decimal import Decimal
 
@@ -10,53 +8,40 @@ class AutoAccountingEngine:
     
     @staticmethod
     def create_journal_entry(entry_type, description, amount, lines_data, user, reference_id=None, reference_type=None):
-        """إنشاء قيد محاسبي عام"""
-        with transaction.atomic():
-            try:
-                entry = JournalEntry.objects.create(
-                    entry_type=entry_type,
-                    description=description,
-                    reference_id=reference_id,
-                    reference_type=reference_type,
-                    total_amount=amount,
-                    created_by=user,
-                    is_posted=True,
-                    posted_at=timezone.now(),
-                    posted_by=user
-                )
-                
-                for line_data in lines_data:
-                    JournalEntryLine.objects.create(
-                        journal_entry=entry,
-                        account=line_data['account'],
-                        debit=line_data.get('debit', 0),
-                        credit=line_data.get('credit', 0),
-                        description=line_data['description']
-                    )
-                
-                # تحديث أرصدة الحسابات
-                AutoAccountingEngine.update_account_balances(entry)
-                return entry
-            except Exception as e:
-                print(f"خطأ في إنشاء القيد: {e}")
-                return None
+        """إنشاء قيد محاسبي عام (القيود المرتبطة بحدث تمر بمسار الترحيل الموحد)"""
+        entries = AutoAccountingEngine.create_journal_entries([{
+            'entry_type': entry_type,
+            'description': description,
+            'lines': lines_data,
+            'reference_id': reference_id,
+            'reference_type': reference_type,
+        }], user)
+        return entries[0] if entries else None
     
     @staticmethod
-    def update_account_balances(entry):
-        """تحديث أرصدة الحسابات"""
-        for line in entry.lines.all():
-            account = line.account
-            if line.debit > 0:
-                if account.account_type in ['asset', 'expense']:
-                    account.balance += line.debit
-                else:
-                    account.balance -= line.debit
-            if line.credit > 0:
-                if account.account_type in ['liability', 'equity', 'revenue']:
-                    account.balance += line.credit
-                else:
-                    account.balance -= line.credit
-            account.save()
+    def create_journal_entries(entries_data, user):
+        """
+        إنشاء عدة قيود دفعة واحدة (مسير رواتب، قيود الإقفال...)
+        
+        كل عنصر {'entry_type', 'description', 'lines', 'reference_type', 'reference_id'}.
+        جميع الأسطر تدرج بـ bulk_create وأرصدة الحسابات تتحدث بعملية UPDATE
+        واحدة، ويرجع قائمة القيود أو قائمة فارغة عند الخطأ.
+        """
+        from .posting import PostingPipeline
+        
+        events = [
+            PostingPipeline.event(
+                data.get('reference_type'), data.get('reference_id'),
+                data['entry_type'], data['description'], data['lines'],
+                user=data.get('user', user), company=data.get('company')
+            )
+            for data in entries_data
+        ]
+        try:
+            return PostingPipeline.post_many(events)
+        except Exception as e:
+            print(f"خطأ في إنشاء القيد: {e}")
+            return []
     
     @staticmethod
     def get_or_create_account(code, name, account_type):
@@ -75,352 +60,28 @@ class AutoAccountingEngine:
 # إشارات Django للتسجيل التلقائي
 @receiver(post_save, sender=Sale)
 def auto_sale_accounting(sender, instance, created, **kwargs):
-    """تسجيل قيد البيع تلقائياً"""
+    """تسجيل قيد البيع تلقائياً (مباشرة أو في الخلفية حسب BACKGROUND_JOBS_ASYNC)"""
     if instance.status == 'confirmed' and not getattr(instance, 'journal_processed', False):
+        from .job_queue import JobQueue
         try:
-            # حسابات البيع
-            customer_account = AutoAccountingEngine.get_or_create_account(
-                f'1201{instance.customer.id:03d}',
-                f'العميل - {instance.customer.name}',
-                'asset'
-            )
-            sales_account = AutoAccountingEngine.get_or_create_account('4001', 'مبيعات', 'revenue')
-            cost_account = AutoAccountingEngine.get_or_create_account('5101', 'تكلفة البضاعة المباعة', 'expense')
-            inventory_account = AutoAccountingEngine.get_or_create_account('1301', 'مخزون البضاعة', 'asset')
-            
-            # قيد البيع
-            lines_data = [
-                {
-                    'account': customer_account,
-                    'debit': instance.total_amount,
-                    'credit': 0,
-                    'description': f'فاتورة بيع #{instance.invoice_number}'
-                },
-                {
-                    'account': sales_account,
-                    'debit': 0,
-                    'credit': instance.total_amount,
-                    'description': f'إيرادات بيع #{instance.invoice_number}'
-                }
-            ]
-            
-            # حساب تكلفة البضاعة المباعة
-            total_cost = 0
-            for item in instance.items.all():
-                cost_price = getattr(item.product, 'cost_price', 0) or 0
-                item_cost = float(item.quantity) * float(cost_price)
-                total_cost += item_cost
-            
-            if total_cost > 0:
-                lines_data.extend([
-                    {
-                        'account': cost_account,
-                        'debit': total_cost,
-                        'credit': 0,
-                        'description': f'تكلفة البضاعة المباعة #{instance.invoice_number}'
-                    },
-                    {
-                        'account': inventory_account,
-                        'debit': 0,
-                        'credit': total_cost,
-                        'description': f'تخفيض المخزون #{instance.invoice_number}'
-                    }
-                ])
-            
-            AutoAccountingEngine.create_journal_entry(
-                'sale',
-                f'فاتورة بيع #{instance.invoice_number} - {instance.customer.name}',
-                instance.total_amount + total_cost,
-                lines_data,
-                instance.created_by,
-                instance.id,
-                'sale'
-            )
-            
-            # تحديث رصيد العميل
-            instance.customer.opening_balance += instance.total_amount
-            instance.customer.save()
-            
-            # تعليم الفاتورة كمعالجة محاسبياً
-            Sale.objects.filter(id=instance.id).update(journal_processed=True)
-            
+            JobQueue.dispatch(sale_accounting_job, instance=instance, sale_id=instance.id)
         except Exception as e:
+            # التنفيذ المباشر: لا يتم تعطيل حفظ الفاتورة
             print(f"خطأ في معالجة قيد البيع: {e}")
 
-@receiver(post_save, sender=Purchase)
-def auto_purchase_accounting(sender, instance, created, **kwargs):
-    """تسجيل قيد الشراء تلقائياً"""
+def sale_accounting_job(sale_id, instance=None):
+    """قيد البيع المؤكد (الخطأ لا يتم تجاهله ليعيد الطابور المحاولة ثم يعلم المهمة كفاشلة)"""
+    instance = instance or Sale.objects.get(pk=sale_id)
     if instance.status == 'confirmed' and not getattr(instance, 'journal_processed', False):
-        try:
-            supplier_account = AutoAccountingEngine.get_or_create_account(
-                f'2101{instance.supplier.id:03d}',
-                f'المورد - {instance.supplier.name}',
-                'liability'
-            )
-            inventory_account = AutoAccountingEngine.get_or_create_account('1301', 'مخزون البضاعة', 'asset')
-            
-            lines_data = [
-                {
-                    'account': inventory_account,
-                    'debit': instance.total_amount,
-                    'credit': 0,
-                    'description': f'شراء بضاعة #{instance.invoice_number}'
-                },
-                {
-                    'account': supplier_account,
-                    'debit': 0,
-                    'credit': instance.total_amount,
-                    'description': f'شراء من {instance.supplier.name} #{instance.invoice_number}'
-                }
-            ]
-            
-            AutoAccountingEngine.create_journal_entry(
-                'purchase',
-                f'فاتورة شراء #{instance.invoice_number} - {instance.supplier.name}',
-                instance.total_amount,
-                lines_data,
-                instance.created_by,
-                instance.id,
-                'purchase'
-            )
-            
-            # تحديث رصيد المورد
-            instance.supplier.opening_balance += instance.total_amount
-            instance.supplier.save()
-            
-            Purchase.objects.filter(id=instance.id).update(journal_processed=True)
-            
-        except Exception as e:
-            print(f"خطأ في معالجة قيد الشراء: {e}")
-
-@receiver(post_save, sender=Salary)
-def auto_salary_accounting(sender, instance, created, **kwargs):
-    """تسجيل قيد الراتب تلقائياً"""
-    if instance.status == 'confirmed':
-        try:
-            salary_account = AutoAccountingEngine.get_or_create_account('5201', 'رواتب الموظفين', 'expense')
-            cash_account = AutoAccountingEngine.get_or_create_account('1001', 'النقدية', 'asset')
-            
-            lines_data = [
-                {
-                    'account': salary_account,
-                    'debit': instance.net_salary,
-                    'credit': 0,
-                    'description': f'راتب {instance.employee.get_full_name()} - {instance.month}/{instance.year}'
-                },
-                {
-                    'account': cash_account,
-                    'debit': 0,
-                    'credit': instance.net_salary,
-                    'description': f'صرف راتب {instance.employee.get_full_name()}'
-                }
-            ]
-            
-            AutoAccountingEngine.create_journal_entry(
-                'salary',
-                f'راتب {instance.employee.get_full_name()} - {instance.month}/{instance.year}',
-                instance.net_salary,
-                lines_data,
-                instance.created_by,
-                instance.id,
-                'salary'
-            )
-            
-        except Exception as e:
-            print(f"خطأ في معالجة قيد الراتب: {e}")
-
-@receiver(post_save, sender=CustomerPayment)
-def auto_customer_payment_accounting(sender, instance, created, **kwargs):
-    """تسجيل قيد دفعة العميل تلقائياً"""
-    if created:
-        try:
-            cash_account = AutoAccountingEngine.get_or_create_account('1001', 'النقدية', 'asset')
-            customer_account = AutoAccountingEngine.get_or_create_account(
-                f'1201{instance.customer.id:03d}',
-                f'العميل - {instance.customer.name}',
-                'asset'
-            )
-            
-            lines_data = [
-                {
-                    'account': cash_account,
-                    'debit': instance.amount,
-                    'credit': 0,
-                    'description': f'دفعة من {instance.customer.name} #{instance.payment_number}'
-                },
-                {
-                    'account': customer_account,
-                    'debit': 0,
-                    'credit': instance.amount,
-                    'description': f'تحصيل من {instance.customer.name}'
-                }
-            ]
-            
-            AutoAccountingEngine.create_journal_entry(
-                'voucher',
-                f'دفعة من العميل {instance.customer.name} - #{instance.payment_number}',
-                instance.amount,
-                lines_data,
-                instance.created_by,
-                instance.id,
-                'customer_payment'
-            )
-            
-            # تحديث رصيد العميل
-            instance.customer.opening_balance -= instance.amount
-            instance.customer.save()
-            
-        except Exception as e:
-            print(f"خطأ في معالجة قيد دفعة العميل: {e}")
-
-@receiver(post_save, sender=SupplierPayment)
-def auto_supplier_payment_accounting(sender, instance, created, **kwargs):
-    """تسجيل قيد دفعة المورد تلقائياً"""
-    if created:
-        try:
-            cash_account = AutoAccountingEngine.get_or_create_account('1001', 'النقدية', 'asset')
-            supplier_account = AutoAccountingEngine.get_or_create_account(
-                f'2101{instance.supplier.id:03d}',
-                f'المورد - {instance.supplier.name}',
-                'liability'
-            )
-            
-            lines_data = [
-                {
-                    'account': supplier_account,
-                    'debit': instance.amount,
-                    'credit': 0,
-                    'description': f'دفع للمورد {instance.supplier.name}'
-                },
-                {
-                    'account': cash_account,
-                    'debit': 0,
-                    'credit': instance.amount,
-                    'description': f'دفعة للمورد {instance.supplier.name} #{instance.payment_number}'
-                }
-            ]
-            
-            AutoAccountingEngine.create_journal_entry(
-                'voucher',
-                f'دفعة للمورد {instance.supplier.name} - #{instance.payment_number}',
-                instance.amount,
-                lines_data,
-                instance.created_by,
-                instance.id,
-                'supplier_payment'
-            )
-            
-            # تحديث رصيد المورد
-            instance.supplier.opening_balance -= instance.amount
-            instance.supplier.save()
-            
-        except Exception as e:
-            print(f"خطأ في معالجة قيد دفعة المورد: {e}")
-
-@receiver(post_save, sender=SaleReturn)
-def auto_sale_return_accounting(sender, instance, created, **kwargs):
-    """تسجيل قيد مرتجع البيع تلقائياً"""
-    if instance.status == 'confirmed':
-        try:
-            customer_account = AutoAccountingEngine.get_or_create_account(
-                f'1201{instance.customer.id:03d}',
-                f'العميل - {instance.customer.name}',
-                'asset'
-            )
-            sales_return_account = AutoAccountingEngine.get_or_create_account('4002', 'مرتجعات مبيعات', 'revenue')
-            inventory_account = AutoAccountingEngine.get_or_create_account('1301', 'مخزون البضاعة', 'asset')
-            cost_account = AutoAccountingEngine.get_or_create_account('5101', 'تكلفة البضاعة المباعة', 'expense')
-            
-            lines_data = [
-                {
-                    'account': sales_return_account,
-                    'debit': instance.total_amount,
-                    'credit': 0,
-                    'description': f'مرتجع بيع #{instance.return_number}'
-                },
-                {
-                    'account': customer_account,
-                    'debit': 0,
-                    'credit': instance.total_amount,
-                    'description': f'مرتجع من {instance.customer.name}'
-                }
-            ]
-            
-            # إضافة قيد إرجاع البضاعة للمخزون
-            total_cost = 0
-            for item in instance.items.all():
-                cost_price = getattr(item.product, 'cost_price', 0) or 0
-                item_cost = float(item.quantity) * float(cost_price)
-                total_cost += item_cost
-            
-            if total_cost > 0:
-                lines_data.extend([
-                    {
-                        'account': inventory_account,
-                        'debit': total_cost,
-                        'credit': 0,
-                        'description': f'إرجاع بضاعة للمخزون #{instance.return_number}'
-                    },
-                    {
-                        'account': cost_account,
-                        'debit': 0,
-                        'credit': total_cost,
-                        'description': f'عكس تكلفة البضاعة المباعة #{instance.return_number}'
-                    }
-                ])
-            
-            AutoAccountingEngine.create_journal_entry(
-                'return',
-                f'مرتجع بيع #{instance.return_number} - {instance.customer.name}',
-                instance.total_amount + total_cost,
-                lines_data,
-                instance.created_by,
-                instance.id,
-                'sale_return'
-            )
-            
-        except Exception as e:
-            print(f"خطأ في معالجة قيد مرتجع البيع: {e}")
+        # قيد واحد للفاتورة مهما تكرر الاستدعاء (رصيد العميل يتحدث مع ترحيل القيد)
+        from .posting import PostingPipeline
+        PostingPipeline.post_sale(instance)
+        
+        # تعليم الفاتورة كمعالجة محاسبياً
+        Sale.objects.filter(id=instance.id).update(journal_processed=True)
 
-@receiver(post_save, sender=PurchaseReturn)
-def auto_purchase_return_accounting(sender, instance, created, **kwargs):
-    """تسجيل قيد مرتجع الشراء تلقائياً"""
-    if instance.status == 'confirmed':
-        try:
-            supplier_account = AutoAccountingEngine.get_or_create_account(
-                f'2101{instance.supplier.id:03d}',
-                f'المورد - {instance.supplier.name}',
-                'liability'
-            )
-            inventory_account = AutoAccountingEngine.get_or_create_account('1301', 'مخزون البضاعة', 'asset')
-            
-            lines_data = [
-                {
-                    'account': supplier_account,
-                    'debit': instance.total_amount,
-                    'credit': 0,
-                    'description': f'مرتجع شراء #{instance.return_number}'
-                },
-                {
-                    'account': inventory_account,
-                    'debit': 0,
-                    'credit': instance.total_amount,
-                    'description': f'مرتجع بضاعة للمورد {instance.supplier.name}'
-                }
-            ]
-            
-            AutoAccountingEngine.create_journal_entry(
-                'return',
-                f'مرتجع شراء #{instance.return_number} - {instance.supplier.name}',
-                instance.total_amount,
-                lines_data,
-                instance.created_by,
-                instance.id,
-                'purchase_return'
-            )
-            
-        except Exception as e:
-            print(f"خطأ في معالجة قيد مرتجع الشراء: {e}")
+# باقي الأحداث (الشراء، المرتجعات، الدفعات، الرواتب) لها قيد واحد من مسار الترحيل
+# الموحد (core.posting) عند التأكيد أو الإنشاء، فلا تسجل هنا مرة أخرى
 
 # دالة إعداد الحسابات الأساسية
 def setup_basic_accounts():
@@ -9,23 +9,42 @@ from .decorators import subscription_required, permission_required
 @subscription_required
 @permission_required('accounts', 'view')
 def balance_sheet(request):
-    """عرض الميزانية العمومية"""
+    """عرض الميزانية العمومية (الحالية، أو بتاريخ سابق بـ ?as_of=YYYY-MM-DD)"""
+    from .period_balances import period_account_balances
+    
+    _, report_date, period_balances = period_account_balances(request.GET)
     
     # جلب الأصول
     assets = Account.objects.filter(account_type='asset').order_by('account_code')
-    total_assets = assets.aggregate(Sum('balance'))['balance__sum'] or 0
-    
     # جلب الخصوم
     liabilities = Account.objects.filter(account_type='liability').order_by('account_code')
-    total_liabilities = liabilities.aggregate(Sum('balance'))['balance__sum'] or 0
-    
     # جلب حقوق الملكية
     equity_accounts = Account.objects.filter(account_type='equity').order_by('account_code')
-    total_equity_accounts = equity_accounts.aggregate(Sum('balance'))['balance__sum'] or 0
     
-    # حساب صافي الربح/الخسارة
-    total_revenue = Account.objects.filter(account_type='revenue').aggregate(Sum('balance'))['balance__sum'] or 0
-    total_expenses = Account.objects.filter(account_type='expense').aggregate(Sum('balance'))['balance__sum'] or 0
+    if period_balances is None:
+        total_assets = assets.aggregate(Sum('balance'))['balance__sum'] or 0
+        total_liabilities = liabilities.aggregate(Sum('balance'))['balance__sum'] or 0
+        total_equity_accounts = equity_accounts.aggregate(Sum('balance'))['balance__sum'] or 0
+        
+        # حساب صافي الربح/الخسارة
+        total_revenue = Account.objects.filter(account_type='revenue').aggregate(Sum('balance'))['balance__sum'] or 0
+        total_expenses = Account.objects.filter(account_type='expense').aggregate(Sum('balance'))['balance__sum'] or 0
+    else:
+        # أرصدة نهاية report_date من الأرصدة الشهرية (للعرض فقط بدون حفظ)
+        def closing(accounts):
+            accounts = list(accounts)
+            for account in accounts:
+                period = period_balances.get(account.id)
+                account.balance = period['closing'] if period else 0
+            return accounts, sum(account.balance for account in accounts)
+        
+        assets, total_assets = closing(assets)
+        liabilities, total_liabilities = closing(liabilities)
+        equity_accounts, total_equity_accounts = closing(equity_accounts)
+        
+        # حساب صافي الربح/الخسارة
+        total_revenue = closing(Account.objects.filter(account_type='revenue'))[1]
+        total_expenses = closing(Account.objects.filter(account_type='expense'))[1]
     net_income = total_revenue - total_expenses
     
     # إجمالي حقوق الملكية (بما في ذلك صافي الربح)
@@ -57,7 +76,7 @@ def balance_sheet(request):
         'is_balanced': is_balanced,
         'balance_difference': float(balance_difference),
         'total_accounts': total_accounts,
-        'report_date': date.today(),
+        'report_date': report_date or date.today(),
         'currency_symbol': currency_symbol,
     }
     
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+خريطة الباركود لقارئ الباركود في نقطة البيع
+
+لكل قاعدة بيانات شركة خريطتان في ذاكرة العملية:
+- الكتالوج: الباركود ← (رقم المنتج، الاسم، السعر)
+- المخزون: رقم المنتج ← المخزون (مجموع المخازن)
+تبنيان عند أول مسح ثم كل مسح قراءة من dict بدون أي استعلام.
+
+كل خريطة مرتبطة بإصدار في الكاش المشترك: إصدار الكتالوج يزيد مع حفظ أو حذف
+منتج أو سعر، وإصدار المخزون يزيد مع أي تعديل للمخزون (بما فيها عمليات UPDATE
+في StockLedger و POSCheckoutService). تعديل المخزون بعد كل بيع يعيد بناء خريطة
+المخزون فقط باستعلام تجميع واحد. الباركود غير الموجود في الخريطة يبحث عنه
+باستعلام مساواة على عمود مفهرس (وليس LIKE).
+"""
+import threading
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db.models import Sum
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .database_router import get_current_db_alias
+from .versioned_cache import get_versions, bump_version
+
+BarcodeEntry = namedtuple('BarcodeEntry', ['id', 'name', 'price', 'stock'])
+
+# {(alias, 'catalog' | 'stock'): (version, dict)}
+_maps = {}
+_lock = threading.Lock()
+
+_DIGITS = str.maketrans({
+    **{chr(0x0660 + digit): str(digit) for digit in range(10)},
+    **{chr(0x06f0 + digit): str(digit) for digit in range(10)},
+})
+
+
+def barcode_version_key(alias):
+    return f"barcode_map_version:{alias}"
+
+
+def barcode_stock_version_key(alias):
+    return f"barcode_stock_version:{alias}"
+
+
+def invalidate_barcodes(alias=None):
+    """إبطال خريطة الباركود (الكتالوج والمخزون) في جميع العمليات"""
+    bump_version(barcode_version_key(alias or get_current_db_alias()))
+
+
+def invalidate_barcode_stock(alias=None):
+    """إبطال خريطة المخزون فقط (بعد البيع أو حركات المخزون)"""
+    bump_version(barcode_stock_version_key(alias or get_current_db_alias()))
+
+
+def normalize_barcode(code):
+    """إزالة المسافات وتحويل الأرقام العربية (لوحات المفاتيح العربية مع القارئ)"""
+    return str(code or '').strip().translate(_DIGITS)
+
+
+class BarcodeMap:
+    """البحث عن المنتج بالباركود الكامل"""
+
+    @staticmethod
+    def _prices(using):
+        """سعر البيع لكل منتج: أول سعر نشط (كما في شاشة تفاصيل المنتج)"""
+        from .models import ProductPrice
+
+        prices = {}
+        rows = ProductPrice._base_manager.using(using).filter(is_active=True).order_by(
+            'product_id', '-id'
+        ).values_list('product_id', 'selling_price')
+        for product_id, selling_price in rows:
+            prices[product_id] = selling_price
+        return prices
+
+    @classmethod
+    def build_catalog(cls, using=None):
+        """{barcode: (id, name, price)} للمنتجات النشطة"""
+        from .models import Product
+
+        db = using or get_current_db_alias()
+        prices = cls._prices(db)
+        barcodes = {}
+        products = Product._base_manager.using(db).filter(is_active=True).exclude(barcode='').values_list(
+            'id', 'barcode', 'name', 'price'
+        )
+        for product_id, barcode, name, price in products:
+            barcodes[normalize_barcode(barcode)] = (product_id, name, Decimal(prices.get(product_id) or price or 0))
+        return barcodes
+
+    @staticmethod
+    def build_stock(using=None):
+        """{product_id: stock}: مجموع ProductStock أو Product.stock إذا لم توجد صفوف مخزون"""
+        from .models import Product
+
+        db = using or get_current_db_alias()
+        rows = Product._base_manager.using(db).filter(is_active=True).annotate(
+            total=Sum('productstock__current_stock')
+        ).values_list('id', 'stock', 'total')
+        return {
+            product_id: Decimal(stock if total is None else total)
+            for product_id, stock, total in rows
+        }
+
+    @staticmethod
+    def _cached(db, name, version, build):
+        current = _maps.get((db, name))
+        if current is not None and current[0] == version:
+            return current[1]
+        with _lock:
+            current = _maps.get((db, name))
+            if current is None or current[0] != version:
+                current = (version, build(db))
+                _maps[(db, name)] = current
+        return current[1]
+
+    @classmethod
+    def lookup(cls, code, using=None):
+        """المنتج بالباركود الكامل: BarcodeEntry أو None"""
+        db = using or get_current_db_alias()
+        code = normalize_barcode(code)
+        if not code:
+            return None
+
+        catalog_version, stock_version = get_versions([barcode_version_key(db), barcode_stock_version_key(db)])
+        if catalog_version is not None and stock_version is not None:
+            catalog = cls._cached(db, 'catalog', catalog_version, cls.build_catalog)
+            item = catalog.get(code)
+            if item is not None:
+                stocks = cls._cached(db, 'stock', stock_version, cls.build_stock)
+                return BarcodeEntry(*item, stocks.get(item[0], Decimal('0')))
+        return cls.fetch(code, db)
+
+    @classmethod
+    def fetch(cls, code, using=None):
+        """باركود غير موجود في الخريطة: استعلام مساواة على الفهرس"""
+        from .models import Product, ProductPrice
+
+        db = using or get_current_db_alias()
+        product = Product._base_manager.using(db).filter(barcode=code, is_active=True).annotate(
+            total=Sum('productstock__current_stock')
+        ).values_list('id', 'name', 'price', 'stock', 'total').first()
+        if product is None:
+            return None
+
+        product_id, name, price, stock, total = product
+        price_row = ProductPrice._base_manager.using(db).filter(
+            product_id=product_id, is_active=True
+        ).order_by('id').values_list('selling_price', flat=True).first()
+        return BarcodeEntry(
+            product_id, name, Decimal(price_row or price or 0), Decimal(stock if total is None else total)
+        )
+
+
+@receiver(post_save, sender='core.Product')
+@receiver(post_delete, sender='core.Product')
+@receiver(post_save, sender='core.ProductPrice')
+@receiver(post_delete, sender='core.ProductPrice')
+def catalog_changed(sender, instance, **kwargs):
+    invalidate_barcodes(kwargs.get('using'))
+    invalidate_barcode_stock(kwargs.get('using'))
+
+
+@receiver(post_save, sender='core.ProductStock')
+@receiver(post_delete, sender='core.ProductStock')
+def stock_changed(sender, instance, **kwargs):
+    invalidate_barcode_stock(kwargs.get('using'))
@@ -9,11 +9,15 @@ from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate, login
 from .database_manager import DatabaseManager
+from .database_router import (
+    invalidate_database_validation, register_company_database, use_company_database, company_db_alias
+)
 from .models import Company, Branch, Warehouse, UserProfile
 from datetime import date, timedelta
 import os
 import sqlite3
 from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
 
 def setup_company(request):
     """صفحة إعداد شركة جديدة"""
@@ -104,61 +108,54 @@ def create_new_company_database(company_code, company_name, admin_data):
         
         # نسخ قاعدة البيانات الرئيسية بدلاً من إنشاء قاعدة فارغة
         main_db_path = os.path.join(settings.BASE_DIR, 'db.sqlite3')
-        if os.path.exists(main_db_path):
+        copied = os.path.exists(main_db_path)
+        if copied:
             import shutil
             shutil.copy2(main_db_path, db_path)
         else:
             # إنشاء قاعدة البيانات الفارغة كحل احتياطي
             conn = sqlite3.connect(db_path)
             conn.close()
-            
-            # حفظ إعدادات قاعدة البيانات الحالية
-            original_db_name = settings.DATABASES['default']['NAME']
-            
-            # تبديل إلى قاعدة البيانات الجديدة
-            settings.DATABASES['default']['NAME'] = db_path
-            
-            # تشغيل migrations لإنشاء جميع الجداول
-            from django.core.management import call_command
-            call_command('migrate', verbosity=0, interactive=False)
         
-        # حفظ إعدادات قاعدة البيانات الحالية
-        original_db_name = settings.DATABASES['default']['NAME']
+        # اتصال مستقل لقاعدة البيانات الجديدة بدلاً من تعديل settings.DATABASES['default']
+        alias = register_company_database(company_code, db_path)
         
-        # تبديل إلى قاعدة البيانات الجديدة
-        settings.DATABASES['default']['NAME'] = db_path
-        
-        # إنشاء البيانات الأساسية
-        company = Company.objects.create(
-            code=company_code,
-            name=company_name,
-            database_name=db_name,
-            is_active=True,
-            subscription_end=date.today() + timedelta(days=365)
-        )
+        if not copied:
+            # تشغيل migrations لإنشاء جميع الجداول
+            from django.core.management import call_command
+            call_command('migrate', database=alias, verbosity=0, interactive=False)
         
-        # إنشاء المستخدم المدير في قاعدة البيانات الجديدة
-        try:
-            admin_user = User.objects.create_user(
-                username=admin_data['username'],
-                password=admin_data['password'],
-                first_name=admin_data['first_name'],
-                last_name=admin_data['last_name'],
-                email=admin_data['email'],
+        # إنشاء البيانات الأساسية في قاعدة البيانات الجديدة
+        with use_company_database(company_code):
+            company = Company.objects.create(
+                code=company_code,
+                name=company_name,
+                database_name=db_name,
                 is_active=True,
-                is_staff=True,
-                is_superuser=True
+                subscription_end=date.today() + timedelta(days=365)
             )
-        except Exception as e:
-            if 'UNIQUE constraint failed' in str(e):
-                raise Exception(f'اسم المستخدم "{admin_data["username"]}" موجود بالفعل')
-            else:
-                raise e
+            
+            # إنشاء المستخدم المدير في قاعدة البيانات الجديدة
+            try:
+                admin_user = User.objects.create_user(
+                    username=admin_data['username'],
+                    password=admin_data['password'],
+                    first_name=admin_data['first_name'],
+                    last_name=admin_data['last_name'],
+                    email=admin_data['email'],
+                    is_active=True,
+                    is_staff=True,
+                    is_superuser=True
+                )
+            except Exception as e:
+                if 'UNIQUE constraint failed' in str(e):
+                    raise Exception(f'اسم المستخدم "{admin_data["username"]}" موجود بالفعل')
+                else:
+                    raise e
         
         # إضافة المستخدم إلى قاعدة البيانات الرئيسية أيضاً
-        settings.DATABASES['default']['NAME'] = original_db_name
         try:
-            main_user, created = User.objects.get_or_create(
+            main_user, created = User.objects.using(DEFAULT_DB_ALIAS).get_or_create(
                 username=admin_data['username'],
                 defaults={
                     'password': admin_user.password,
@@ -171,7 +168,7 @@ def create_new_company_database(company_code, company_name, admin_data):
                 }
             )
             # ربط المستخدم بالشركة في قاعدة البيانات الرئيسية
-            UserProfile.objects.get_or_create(
+            UserProfile.objects.using(DEFAULT_DB_ALIAS).get_or_create(
                 user=main_user,
                 defaults={
                     'company': company,
@@ -182,72 +179,67 @@ def create_new_company_database(company_code, company_name, admin_data):
             pass
         
         # العودة إلى قاعدة البيانات الجديدة
-        settings.DATABASES['default']['NAME'] = db_path
-        
-        # إنشاء الفرع الرئيسي
-        main_branch = Branch.objects.create(
-            company=company,
-            name='الفرع الرئيسي',
-            code='MAIN',
-            address=admin_data.get('address', ''),
-            manager=admin_user,
-            is_active=True
-        )
-        
-        # إنشاء المخزن الرئيسي
-        main_warehouse = Warehouse.objects.create(
-            company=company,
-            branch=main_branch,
-            name='المخزن الرئيسي',
-            code='MAIN_WH',
-            is_active=True
-        )
-        
-        # إنشاء ملف المستخدم
-        UserProfile.objects.get_or_create(
-            user=admin_user,
-            defaults={
-                'company': company,
-                'default_branch': main_branch,
-                'default_warehouse': main_warehouse,
-                'is_active': True
-            }
-        )
-        
-        # إعطاء صلاحيات المدير العام للمستخدم الرئيسي
-        try:
-            from .models import Permission
-            screens = [
-                'dashboard', 'products', 'customers', 'suppliers', 'sales_reps', 'sales', 'purchases',
-                'stock', 'accounts', 'reports', 'settings', 'users', 'permissions',
-                'companies', 'branches', 'warehouses', 'pos', 'manufacturing',
-                'attendance', 'salaries', 'employees'
-            ]
+        with use_company_database(company_code):
+            # إنشاء الفرع الرئيسي
+            main_branch = Branch.objects.create(
+                company=company,
+                name='الفرع الرئيسي',
+                code='MAIN',
+                address=admin_data.get('address', ''),
+                manager=admin_user,
+                is_active=True
+            )
             
-            for screen in screens:
-                Permission.objects.get_or_create(
-                    user=admin_user,
-                    screen=screen,
-                    company=company,
-                    defaults={
-                        'can_view': True,
-                        'can_add': True,
-                        'can_edit': True,
-                        'can_delete': True,
-                        'can_confirm': True,
-                        'can_print': True,
-                        'can_export': True,
-                        'created_by': admin_user
-                    }
-                )
-        except Exception as e:
-            pass  # تجاهل أخطاء الصلاحيات
+            # إنشاء المخزن الرئيسي
+            main_warehouse = Warehouse.objects.create(
+                company=company,
+                branch=main_branch,
+                name='المخزن الرئيسي',
+                code='MAIN_WH',
+                is_active=True
+            )
+            
+            # إنشاء ملف المستخدم
+            UserProfile.objects.get_or_create(
+                user=admin_user,
+                defaults={
+                    'company': company,
+                    'default_branch': main_branch,
+                    'default_warehouse': main_warehouse,
+                    'is_active': True
+                }
+            )
+            
+            # إعطاء صلاحيات المدير العام للمستخدم الرئيسي
+            try:
+                from .models import Permission
+                screens = [
+                    'dashboard', 'products', 'customers', 'suppliers', 'sales_reps', 'sales', 'purchases',
+                    'stock', 'accounts', 'reports', 'settings', 'users', 'permissions',
+                    'companies', 'branches', 'warehouses', 'pos', 'manufacturing',
+                    'attendance', 'salaries', 'employees'
+                ]
+                
+                for screen in screens:
+                    Permission.objects.get_or_create(
+                        user=admin_user,
+                        screen=screen,
+                        company=company,
+                        defaults={
+                            'can_view': True,
+                            'can_add': True,
+                            'can_edit': True,
+                            'can_delete': True,
+                            'can_confirm': True,
+                            'can_print': True,
+                            'can_export': True,
+                            'created_by': admin_user
+                        }
+                    )
+            except Exception as e:
+                pass  # تجاهل أخطاء الصلاحيات
         
-        # إرجاع إعدادات قاعدة البيانات الأصلية
-        try:
-            settings.DATABASES['default']['NAME'] = original_db_name
-        except:
-            settings.DATABASES['default']['NAME'] = os.path.join(settings.BASE_DIR, 'db.sqlite3')
+        invalidate_database_validation(db_path)
         
         return {
             'success': True,
@@ -257,9 +249,9 @@ def create_new_company_database(company_code, company_name, admin_data):
         }
         
     except Exception as e:
-        # إرجاع إعدادات قاعدة البيانات الأصلية في حالة الخطأ
+        # إغلاق اتصال قاعدة البيانات الجديدة قبل حذفها
         try:
-            settings.DATABASES['default']['NAME'] = original_db_name
+            connections[company_db_alias(company_code)].close()
         except:
             pass
         
@@ -269,6 +261,7 @@ def create_new_company_database(company_code, company_name, admin_data):
                 os.remove(db_path)
         except:
             pass
+        invalidate_database_validation(db_path)
         
         return {
             'success': False,
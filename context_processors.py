@@ -1,4 +1,6 @@
-from .models import Company, Setting
+from .models import Company
+from .settings_cache import get_request_settings
+from .permission_cache import get_request_permissions
 
 def global_settings(request):
     """إضافة الإعدادات العامة لجميع القوالب"""
@@ -27,49 +29,20 @@ def global_settings(request):
     # جلب صلاحيات المستخدم
     if hasattr(request, 'user') and request.user.is_authenticated:
         try:
-            from .models import Permission
             company = getattr(request, 'company', None)
             if company:
-                permissions = Permission.objects.filter(
-                    user=request.user,
-                    company=company
-                )
-                
-                for permission in permissions:
-                    if permission.screen not in user_permissions:
-                        user_permissions[permission.screen] = []
-                    
-                    actions = []
-                    if permission.can_view: actions.append('view')
-                    if permission.can_add: actions.append('add')
-                    if permission.can_edit: actions.append('edit')
-                    if permission.can_delete: actions.append('delete')
-                    if permission.can_confirm: actions.append('confirm')
-                    if permission.can_print: actions.append('print')
-                    if permission.can_export: actions.append('export')
-                    
-                    user_permissions[permission.screen] = actions
+                user_permissions = get_request_permissions(request).as_dict()
         except:
             pass
     
-    # الإعدادات العامة (مفلترة حسب الشركة)
+    # الإعدادات العامة (لقطة إعدادات الشركة المشتركة مع الطلب)
     try:
-        settings_dict = {}
-        company = getattr(request, 'company', None)
-        
-        if company:
-            # الحصول على إعدادات الشركة الحالية
-            for setting in Setting.objects.filter(company=company):
-                settings_dict[setting.key] = setting.get_value()
-        else:
-            # الإعدادات العامة
-            for setting in Setting.objects.filter(is_global=True):
-                settings_dict[setting.key] = setting.get_value()
+        snapshot = get_request_settings(request)
         
         context.update({
-            'currency_symbol': settings_dict.get('currency_symbol', 'د.ك'),
-            'theme_color': settings_dict.get('theme_color', 'blue'),
-            'system_settings': settings_dict,
+            'currency_symbol': snapshot.get_typed('currency_symbol', 'د.ك'),
+            'theme_color': snapshot.get_typed('theme_color', 'blue'),
+            'system_settings': snapshot.typed,
         })
     except:
         context.update({
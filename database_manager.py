@@ -5,10 +5,13 @@
 import os
 import sqlite3
 from django.conf import settings
-from django.core.management import execute_from_command_line
-from django.db import connection
+from django.core.management import call_command
 from django.contrib.auth.models import User
 from .models import Company, Branch, Warehouse, UserProfile
+from .database_router import (
+    register_company_database, set_current_company, use_company_database,
+    invalidate_database_validation
+)
 
 class DatabaseManager:
     """مدير قواعد البيانات المتعددة"""
@@ -28,18 +31,14 @@ class DatabaseManager:
             conn = sqlite3.connect(db_path)
             conn.close()
             
-            # تحديث إعدادات Django مؤقتاً
-            original_db = settings.DATABASES['default']['NAME']
-            settings.DATABASES['default']['NAME'] = db_path
-            
-            # تشغيل migrations على قاعدة البيانات الجديدة
-            os.system(f'python manage.py migrate --database=default')
+            # تسجيل اتصال الشركة وتشغيل migrations عليه
+            alias = register_company_database(company_code, db_path)
+            call_command('migrate', database=alias, verbosity=0, interactive=False)
+            invalidate_database_validation(db_path)
             
             # إنشاء الشركة والبيانات الأساسية
-            DatabaseManager._create_company_data(company_code, company_name, admin_data)
-            
-            # إرجاع إعدادات قاعدة البيانات الأصلية
-            settings.DATABASES['default']['NAME'] = original_db
+            with use_company_database(company_code):
+                DatabaseManager._create_company_data(company_code, company_name, admin_data)
             
             return {
                 'success': True,
@@ -115,16 +114,9 @@ class DatabaseManager:
     
     @staticmethod
     def switch_database(company_code):
-        """تبديل قاعدة البيانات"""
+        """تبديل قاعدة البيانات للطلب الحالي"""
         try:
-            db_name = f"erp_{company_code.lower()}.db"
-            db_path = os.path.join(settings.BASE_DIR, 'databases', db_name)
-            
-            if os.path.exists(db_path):
-                settings.DATABASES['default']['NAME'] = db_path
-                connection.close()
-                return True
-            return False
+            return set_current_company(company_code) is not None
         except:
             return False
     
@@ -141,12 +133,10 @@ class DatabaseManager:
                 if file.startswith('erp_') and file.endswith('.db'):
                     company_code = file.replace('erp_', '').replace('.db', '').upper()
                     
-                    # تبديل قاعدة البيانات مؤقتاً للحصول على اسم الشركة
-                    original_db = settings.DATABASES['default']['NAME']
-                    settings.DATABASES['default']['NAME'] = os.path.join(databases_dir, file)
-                    
+                    # قراءة اسم الشركة من اتصالها الخاص بدون تبديل قاعدة البيانات الحالية
                     try:
-                        company = Company.objects.filter(code=company_code).first()
+                        alias = register_company_database(company_code, os.path.join(databases_dir, file))
+                        company = Company.objects.using(alias).filter(code=company_code).first()
                         if company:
                             companies.append({
                                 'code': company.code,
@@ -155,8 +145,6 @@ class DatabaseManager:
                             })
                     except:
                         pass
-                    finally:
-                        settings.DATABASES['default']['NAME'] = original_db
             
             return companies
         except:
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+موجه قواعد البيانات للشركات المتعددة
+
+كل شركة لها ملف SQLite مستقل (databases/erp_<code>.db) يتم تسجيله كاتصال
+مستقل في Django باسم company_<code> عند أول استخدام. يتم تحديد قاعدة البيانات
+الحالية عن طريق ContextVar بدلاً من تعديل settings.DATABASES['default']،
+لذلك تبديل الشركة بين الطلبات لا يغلق أي اتصال وآمن بين الخيوط.
+
+التفعيل في settings.py:
+    DATABASE_ROUTERS = ['core.database_router.CompanyDatabaseRouter']
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+ALIAS_PREFIX = 'company_'
+
+# قاعدة البيانات الحالية للطلب (أو المهمة) الجارية
+_current_db_alias = ContextVar('current_db_alias', default=None)
+
+# قفل لحماية تسجيل الاتصالات الجديدة
+_register_lock = threading.Lock()
+
+# قواعد البيانات التي تم التحقق من جداولها: المسار -> (st_dev, st_ino)
+_validated_databases = {}
+
+
+def company_db_name(company_code):
+    """اسم ملف قاعدة بيانات الشركة"""
+    return f"erp_{company_code.lower()}.db"
+
+
+def company_db_path(company_code):
+    """المسار الكامل لقاعدة بيانات الشركة"""
+    return os.path.join(settings.BASE_DIR, 'databases', company_db_name(company_code))
+
+
+def company_db_alias(company_code):
+    """اسم الاتصال في Django لقاعدة بيانات الشركة"""
+    return f"{ALIAS_PREFIX}{company_code.lower()}"
+
+
+def available_company_codes():
+    """رموز الشركات التي لها ملف قاعدة بيانات في مجلد databases"""
+    databases_dir = os.path.join(settings.BASE_DIR, 'databases')
+    if not os.path.isdir(databases_dir):
+        return []
+    return sorted(
+        name[len('erp_'):-len('.db')].upper()
+        for name in os.listdir(databases_dir)
+        if name.startswith('erp_') and name.endswith('.db')
+    )
+
+
+def _databases_config():
+    """إعدادات الاتصالات المسجلة في ConnectionHandler"""
+    # Django >= 3.2 يستخدم connections.settings، والإصدارات الأقدم connections.databases
+    return getattr(connections, 'settings', None) or connections.databases
+
+
+def register_company_database(company_code, db_path=None):
+    """
+    تسجيل اتصال الشركة مرة واحدة لكل عملية
+
+    الاتصال ينسخ إعدادات default مع تغيير NAME، ويكون دائماً (CONN_MAX_AGE=None)
+    بحيث يحتفظ كل خيط باتصاله المفتوح ويعيد استخدامه بين الطلبات.
+    """
+    alias = company_db_alias(company_code)
+    databases = _databases_config()
+    if alias in databases:
+        return alias
+
+    with _register_lock:
+        if alias in databases:
+            return alias
+
+        config = dict(databases[DEFAULT_DB_ALIAS])
+        config['NAME'] = db_path or company_db_path(company_code)
+        config['CONN_MAX_AGE'] = None
+        config.setdefault('TEST', {})
+        databases[alias] = config
+        settings.DATABASES[alias] = config
+
+    return alias
+
+
+def _file_identity(db_path):
+    """هوية ملف قاعدة البيانات على القرص، أو None إذا لم يوجد"""
+    try:
+        stat = os.stat(db_path)
+    except OSError:
+        return None
+    return (stat.st_dev, stat.st_ino)
+
+
+def _check_database_schema(db_path):
+    """فحص وجود الجداول الأساسية في قاعدة البيانات"""
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            cursor = conn.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name IN ('auth_user', 'core_company')"
+            )
+            return cursor.fetchone()[0] == 2
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+
+
+def is_database_valid(db_path):
+    """
+    فحص صحة قاعدة بيانات الشركة مع حفظ النتيجة على مستوى العملية
+
+    يتم فحص الجداول مرة واحدة لكل ملف. المفتاح هو المسار والقيمة هي رقم inode،
+    فإذا حُذف الملف أو استُبدل بملف آخر يعاد الفحص تلقائياً. لا يستخدم mtime
+    لأن SQLite يغيره مع كل عملية كتابة. النسخ فوق ملف موجود يحتفظ بنفس inode
+    لذلك يجب استدعاء invalidate_database_validation بعد أي إصلاح أو إنشاء.
+    """
+    identity = _file_identity(db_path)
+    if identity is None:
+        return False
+    if _validated_databases.get(db_path) == identity:
+        return True
+
+    valid = _check_database_schema(db_path)
+    if valid:
+        _validated_databases[db_path] = identity
+    return valid
+
+
+def invalidate_database_validation(db_path=None):
+    """مسح نتيجة الفحص لقاعدة بيانات محددة أو لجميع القواعد"""
+    if db_path is None:
+        _validated_databases.clear()
+    else:
+        _validated_databases.pop(db_path, None)
+
+
+def get_current_db_alias():
+    """اسم الاتصال الحالي (default إذا لم تحدد شركة)"""
+    return _current_db_alias.get() or DEFAULT_DB_ALIAS
+
+
+def set_current_company(company_code):
+    """
+    تحديد قاعدة بيانات الشركة الحالية
+
+    يرجع token يجب تمريره إلى reset_current_company بعد انتهاء الطلب،
+    أو None إذا لم توجد قاعدة بيانات للشركة.
+    """
+    db_path = company_db_path(company_code)
+    if not os.path.exists(db_path):
+        return None
+    alias = register_company_database(company_code, db_path)
+    return _current_db_alias.set(alias)
+
+
+def clear_current_company():
+    """
+    بدء سياق بدون شركة (قاعدة البيانات الافتراضية)
+
+    تستخدمه الـ middleware في بداية كل طلب، ثم reset_current_company(token)
+    في نهايته لإلغاء أي تبديل تم أثناء الطلب حتى لا ينتقل للطلب التالي على نفس الخيط.
+    """
+    return _current_db_alias.set(None)
+
+
+def reset_current_company(token):
+    """إرجاع قاعدة البيانات السابقة"""
+    if token is not None:
+        _current_db_alias.reset(token)
+
+
+@contextmanager
+def use_company_database(company_code):
+    """تنفيذ كتلة من الكود على قاعدة بيانات شركة محددة"""
+    alias = register_company_database(company_code)
+    token = _current_db_alias.set(alias)
+    try:
+        yield alias
+    finally:
+        _current_db_alias.reset(token)
+
+
+def company_atomic(savepoint=True):
+    """transaction.atomic على قاعدة بيانات الشركة الحالية"""
+    return transaction.atomic(using=get_current_db_alias(), savepoint=savepoint)
+
+
+class CompanyDatabaseRouter:
+    """توجيه القراءة والكتابة إلى قاعدة بيانات الشركة الحالية"""
+
+    def db_for_read(self, model, **hints):
+        return _current_db_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return _current_db_alias.get()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._state.db == obj2._state.db:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return True
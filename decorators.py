@@ -7,8 +7,8 @@ class PermissionManager:
     """مدير الصلاحيات المتقدم"""
     
     @staticmethod
-    def has_permission(user, screen, action='view', branch=None, warehouse=None):
-        """فحص صلاحية المستخدم"""
+    def has_permission(user, screen, action='view', branch=None, warehouse=None, permissions=None):
+        """فحص صلاحية المستخدم (في الذاكرة من الصلاحيات المجمعة)"""
         # التحقق من حالة المستخدم
         if not user.is_active:
             return False
@@ -17,40 +17,25 @@ class PermissionManager:
         if user.is_superuser:
             return True
         
-        # فحص الصلاحيات من قاعدة البيانات
         try:
-            from .models import Permission, UserProfile
+            from .permission_cache import get_compiled_permissions
+            if permissions is None:
+                permissions = get_compiled_permissions(user)
             
             # التحقق من وجود ملف المستخدم وأنه نشط
-            profile = UserProfile.objects.filter(user=user, is_active=True).first()
-            if not profile:
+            if not permissions.profile_active:
                 return False
             
-            # فحص الصلاحية المحددة
-            permission = Permission.objects.filter(user=user, screen=screen).first()
-            
-            if permission:
-                # فحص العملية المطلوبة
-                action_field = f'can_{action}'
-                if hasattr(permission, action_field):
-                    has_action_permission = getattr(permission, action_field, False)
-                    if not has_action_permission:
-                        return False
-                
-                # فحص صلاحية الفرع
-                if branch and permission.branch_access.exists():
-                    if not permission.branch_access.filter(id=branch.id).exists():
-                        return False
-                
-                # فحص صلاحية المخزن
-                if warehouse and permission.warehouse_access.exists():
-                    if not permission.warehouse_access.filter(id=warehouse.id).exists():
-                        return False
-                
-                return True
-            else:
+            allowed = permissions.allows(
+                screen,
+                action,
+                branch.id if branch else None,
+                warehouse.id if warehouse else None
+            )
+            if allowed is None:
                 # إذا لم توجد صلاحية محددة، اعط صلاحية العرض فقط
                 return action == 'view' and screen in ['dashboard']
+            return allowed
                 
         except Exception as e:
             # في حالة حدوث خطأ، اعط صلاحية محدودة
@@ -65,9 +50,9 @@ class PermissionManager:
             return ['dashboard', 'products', 'sales', 'purchases', 'customers', 'suppliers', 'stock', 'accounts', 'reports', 'settings', 'users', 'permissions']
         
         try:
-            from .models import Permission
-            permissions = Permission.objects.filter(user=user, can_view=True)
-            return [perm.screen for perm in permissions]
+            from .permission_cache import get_compiled_permissions
+            permissions = get_compiled_permissions(user)
+            return [screen for screen in permissions.masks if permissions.allows(screen, 'view')]
         except:
             return ['dashboard']
 
@@ -78,16 +63,16 @@ def permission_required(screen, action='view'):
         @login_required
         @company_required
         def _wrapped_view(request, *args, **kwargs):
+            from .permission_cache import get_request_permissions
+            permissions = get_request_permissions(request)
+            
             # التحقق من وجود ملف المستخدم
-            try:
-                from .models import UserProfile
-                profile = UserProfile.objects.get(user=request.user, company=request.company)
-                if not profile.is_active:
-                    messages.error(request, 'حسابك غير نشط')
-                    return redirect('login')
-            except UserProfile.DoesNotExist:
+            if permissions.profile_company_id != request.company.id:
                 messages.error(request, 'ملف المستخدم غير موجود في هذه الشركة')
                 return redirect('login')
+            if not permissions.profile_active:
+                messages.error(request, 'حسابك غير نشط')
+                return redirect('login')
             
             # فحص الصلاحية
             if not PermissionManager.has_permission(
@@ -95,7 +80,8 @@ def permission_required(screen, action='view'):
                 screen, 
                 action, 
                 getattr(request, 'current_branch', None),
-                getattr(request, 'current_warehouse', None)
+                getattr(request, 'current_warehouse', None),
+                permissions=permissions
             ):
                 # تسجيل محاولة الوصول غير المصرح بها
                 log_unauthorized_access(request.user, screen, action, request)
@@ -113,11 +99,13 @@ def subscription_required(view_func):
     @login_required
     def _wrapped_view(request, *args, **kwargs):
         try:
-            from .models import UserProfile
-            profile = UserProfile.objects.get(user=request.user)
+            from .tenant_cache import get_request_tenant
+            tenant = get_request_tenant(request)
+            if tenant is None:
+                raise LookupError('user profile not found')
             
-            if profile.company and not profile.company.is_subscription_active:
-                messages.error(request, f'انتهى اشتراك شركة {profile.company.name}، يرجى التجديد')
+            if not tenant.is_subscription_active():
+                messages.error(request, f'انتهى اشتراك شركة {tenant.name}، يرجى التجديد')
                 return redirect('login')
         except Exception:
             messages.error(request, 'خطأ في التحقق من الاشتراك')
@@ -155,8 +143,10 @@ def company_required(view_func):
             messages.error(request, 'يجب ربط المستخدم بشركة')
             return redirect('login')
         
-        # فحص صحة الاشتراك
-        if not request.company.is_subscription_active:
+        # فحص صحة الاشتراك (من حالة الشركة المحفوظة وليس من الكائن المحمل مع الطلب)
+        from .tenant_cache import get_company_status
+        tenant = get_company_status(request.company.id)
+        if tenant is None or not tenant.is_subscription_active():
             messages.error(request, f'انتهى اشتراك شركة {request.company.name}، يرجى التجديد')
             return redirect('login')
         
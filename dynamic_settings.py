@@ -1,8 +1,10 @@
 """
 نظام الإعدادات الديناميكي - إدارة الإعدادات مع التطبيق الفوري
+
+القراءة تتم من محرك الإعدادات الموحد (settings_cache.SettingsEngine)، وأي
+تعديل يزيد إصدار الإعدادات فيصل التغيير لجميع العمليات.
 """
 
-from django.core.cache import cache
 from django.db import models
 from django.utils import timezone
 from decimal import Decimal
@@ -15,17 +17,9 @@ class DynamicSettingsManager:
     مدير الإعدادات الديناميكي - يدير الإعدادات مع الكاش والتطبيق الفوري
     """
     
-    CACHE_PREFIX = 'dynamic_setting_'
-    CACHE_TIMEOUT = 3600  # ساعة واحدة
-    
-    # قفل للحماية من التداخل في العمليات المتزامنة
+    # قفل للحماية من التداخل في عمليات الكتابة المتزامنة
     _lock = threading.Lock()
     
-    @classmethod
-    def get_cache_key(cls, key: str, branch_id: Optional[int] = None) -> str:
-        """إنشاء مفتاح الكاش للإعداد"""
-        return f"{cls.CACHE_PREFIX}{branch_id or 'global'}_{key}"
-    
     @classmethod
     def get(cls, key: str, branch=None, default: Any = None) -> Any:
         """
@@ -39,33 +33,12 @@ class DynamicSettingsManager:
         Returns:
             قيمة الإعداد أو القيمة الافتراضية
         """
-        cache_key = cls.get_cache_key(key, branch.id if branch else None)
-        
-        # محاولة الحصول على القيمة من الكاش أولاً
-        value = cache.get(cache_key)
-        if value is not None:
-            return value
+        from .settings_cache import SettingsEngine
         
-        # إذا لم توجد في الكاش، جلبها من قاعدة البيانات
-        with cls._lock:
-            try:
-                from .models import Setting
-                
-                # البحث عن الإعداد حسب الفرع أو الإعداد العام
-                setting = Setting.objects.filter(
-                    key=key
-                ).filter(
-                    models.Q(branch=branch) | models.Q(is_global=True)
-                ).first()
-                
-                if setting:
-                    value = setting.get_value()
-                    # حفظ في الكاش
-                    cache.set(cache_key, value, cls.CACHE_TIMEOUT)
-                    return value
-                    
-            except Exception as e:
-                print(f"خطأ في جلب الإعداد {key}: {str(e)}")
+        try:
+            return SettingsEngine.get(key, branch=branch, default=default)
+        except Exception as e:
+            print(f"خطأ في جلب الإعداد {key}: {str(e)}")
         
         return default
     
@@ -104,14 +77,10 @@ class DynamicSettingsManager:
                     }
                 )
                 
-                # تحديث الكاش فوراً
-                cache_key = cls.get_cache_key(key, branch.id if branch else None)
-                
                 # تحويل القيمة حسب النوع
                 processed_value = cls._process_value(value, setting_type)
-                cache.set(cache_key, processed_value, cls.CACHE_TIMEOUT)
                 
-                # إرسال إشارة التحديث للنظام
+                # إرسال إشارة التحديث للنظام (يبطل الكاش في جميع العمليات)
                 cls._broadcast_setting_change(key, processed_value, branch)
                 
                 return True
@@ -133,13 +102,9 @@ class DynamicSettingsManager:
         Returns:
             قاموس بالإعدادات وقيمها
         """
-        defaults = defaults or {}
-        result = {}
-        
-        for key in keys:
-            result[key] = cls.get(key, branch, defaults.get(key))
+        from .settings_cache import SettingsEngine
         
-        return result
+        return SettingsEngine.get_multiple(keys, branch=branch, defaults=defaults)
     
     @classmethod
     def set_multiple(cls, settings: Dict[str, Any], branch=None, 
@@ -180,16 +145,10 @@ class DynamicSettingsManager:
             key: مفتاح إعداد محدد (اختياري)
             branch: الفرع (اختياري)
         """
-        if key:
-            # مسح إعداد محدد
-            cache_key = cls.get_cache_key(key, branch.id if branch else None)
-            cache.delete(cache_key)
-        else:
-            # مسح جميع إعدادات الفرع أو الإعدادات العامة
-            pattern = f"{cls.CACHE_PREFIX}{branch.id if branch else 'global'}_*"
-            # Django cache لا يدعم wildcard delete مباشرة
-            # لذا نحتاج لمسح الكاش كاملاً أو استخدام Redis
-            cache.clear()
+        from .settings_cache import SettingsEngine
+        
+        # المفاتيح تحتوي على الإصدار، فزيادته تبطل جميع إعدادات النطاق دون مسح الكاش كاملاً
+        SettingsEngine.invalidate(branch=branch)
     
     @classmethod
     def get_all_settings(cls, branch=None, category: Optional[str] = None) -> Dict[str, Any]:
@@ -395,18 +354,11 @@ class DynamicSettingsManager:
     def _broadcast_setting_change(cls, key: str, value: Any, branch=None, deleted: bool = False):
         """إرسال إشارة تغيير الإعداد للنظام"""
         try:
-            # يمكن إضافة نظام إشارات Django هنا
-            # أو استخدام WebSocket للتحديث اللحظي
-            from django.dispatch import Signal
+            # زيادة الإصدار في الكاش المشترك تصل لجميع العمليات، والإشارة
+            # settings_cache.setting_changed للمستمعين داخل العملية
+            from .settings_cache import SettingsEngine
             
-            setting_changed = Signal()
-            setting_changed.send(
-                sender=cls,
-                key=key,
-                value=value,
-                branch=branch,
-                deleted=deleted
-            )
+            SettingsEngine.broadcast(key, value, branch=branch, deleted=deleted)
             
         except Exception as e:
             print(f"خطأ في إرسال إشارة تغيير الإعداد: {str(e)}")
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+طابور المهام الخلفية
+
+المهام تحفظ في جدول BackgroundJob داخل قاعدة بيانات الشركة بعد نجاح معاملة
+الطلب (transaction.on_commit)، فلا تنفذ مهمة لبيانات تم التراجع عنها، ولا يدخل
+ترحيل القيود في زمن الاستجابة.
+
+التنفيذ بأمر: python manage.py run_workers --processes 4
+- كل شركة يعالجها عامل واحد فقط، والمهام تنفذ بترتيب الإضافة (id)
+- المهمة الفاشلة يعاد تنفيذها بعد مدة تتضاعف مع كل محاولة، والمهام التالية
+  لنفس الشركة تنتظرها حتى لا يتغير الترتيب، وبعد max_attempts تعلم كفاشلة
+
+المهمة دالة على مستوى الوحدة تستقبل معاملات JSON فقط. الإشارات تستخدم
+JobQueue.dispatch الذي ينفذ المهمة مباشرة (السلوك الافتراضي) أو يضيفها للطابور
+إذا تم تفعيلها في الإعدادات:
+
+    BACKGROUND_JOBS_ASYNC = True                             # جميع المهام
+    BACKGROUND_JOBS_ASYNC = ['process_sale_item_job', ...]   # مهام محددة
+"""
+import os
+import socket
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .database_router import get_current_db_alias
+
+DEFAULT_MAX_ATTEMPTS = 5
+
+
+class JobQueue:
+    """إضافة المهام للطابور أو تنفيذها مباشرة"""
+
+    @staticmethod
+    def task_path(func):
+        return f"{func.__module__}.{func.__name__}"
+
+    @staticmethod
+    def is_async(func):
+        """هل تم تفعيل التنفيذ الخلفي لهذه المهمة"""
+        option = getattr(settings, 'BACKGROUND_JOBS_ASYNC', False)
+        if isinstance(option, bool):
+            return option
+        return func.__name__ in option or JobQueue.task_path(func) in option
+
+    @classmethod
+    def enqueue(cls, func, company_id=None, max_attempts=DEFAULT_MAX_ATTEMPTS, delay=None, **kwargs):
+        """إضافة مهمة بعد نجاح المعاملة الحالية على قاعدة بيانات الشركة"""
+        from .models import BackgroundJob
+
+        alias = get_current_db_alias()
+        values = {
+            'company_id': company_id,
+            'task': cls.task_path(func),
+            'kwargs': kwargs,
+            'max_attempts': max_attempts,
+        }
+
+        def create_job():
+            run_after = timezone.now() + delay if delay else timezone.now()
+            BackgroundJob._base_manager.using(alias).create(run_after=run_after, **values)
+
+        transaction.on_commit(create_job, using=alias)
+
+    @classmethod
+    def dispatch(cls, func, instance=None, company_id=None, **kwargs):
+        """
+        تنفيذ المهمة مباشرة أو إضافتها للطابور حسب الإعدادات
+
+        instance يمرر للمهمة فقط عند التنفيذ المباشر لتجنب إعادة تحميل الكائن.
+        """
+        if cls.is_async(func):
+            if company_id is None and instance is not None:
+                company_id = getattr(instance, 'company_id', None)
+            cls.enqueue(func, company_id=company_id, **kwargs)
+            return None
+        return func(instance=instance, **kwargs)
+
+
+class JobWorker:
+    """تنفيذ مهام قاعدة بيانات شركة واحدة بالترتيب"""
+
+    def __init__(self, name=None, retry_delay=30, stale_after=600):
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.retry_delay = retry_delay
+        self.stale_after = stale_after
+
+    def reset_stale(self, alias=None):
+        """إرجاع المهام المتوقفة (عامل توقف أثناء التنفيذ) للانتظار"""
+        from .models import BackgroundJob
+
+        alias = alias or get_current_db_alias()
+        cutoff = timezone.now() - timedelta(seconds=self.stale_after)
+        return BackgroundJob._base_manager.using(alias).filter(
+            status='running', locked_at__lt=cutoff
+        ).update(status='pending', locked_by='', locked_at=None)
+
+    def _claim_next(self, alias):
+        """حجز أقدم مهمة غير منتهية إذا حان وقتها (بدون تخطي الترتيب)"""
+        from .models import BackgroundJob
+
+        jobs = BackgroundJob._base_manager.using(alias)
+        job = jobs.filter(status__in=('pending', 'running')).order_by('id').first()
+        if job is None or job.status == 'running' or job.run_after > timezone.now():
+            return None
+
+        now = timezone.now()
+        claimed = jobs.filter(pk=job.pk, status='pending').update(
+            status='running', locked_by=self.name, locked_at=now, attempts=job.attempts + 1
+        )
+        if not claimed:
+            return None
+        job.status = 'running'
+        job.attempts += 1
+        return job
+
+    def execute(self, job, alias):
+        """تنفيذ مهمة واحدة داخل معاملة وتسجيل النتيجة"""
+        from .models import BackgroundJob
+
+        jobs = BackgroundJob._base_manager.using(alias).filter(pk=job.pk)
+        try:
+            func = import_string(job.task)
+            with transaction.atomic(using=alias):
+                func(**job.kwargs)
+        except Exception:
+            error = traceback.format_exc()
+            if job.attempts >= job.max_attempts:
+                jobs.update(status='failed', last_error=error, finished_at=timezone.now(), locked_by='', locked_at=None)
+            else:
+                delay = self.retry_delay * (2 ** (job.attempts - 1))
+                jobs.update(
+                    status='pending', last_error=error, locked_by='', locked_at=None,
+                    run_after=timezone.now() + timedelta(seconds=delay)
+                )
+            return False
+
+        jobs.update(status='done', finished_at=timezone.now(), locked_by='', locked_at=None)
+        return True
+
+    def run_pending(self, alias=None, limit=100):
+        """تنفيذ حتى limit مهمة جاهزة وإرجاع عدد المهام المنفذة"""
+        alias = alias or get_current_db_alias()
+        processed = 0
+        while processed < limit:
+            job = self._claim_next(alias)
+            if job is None:
+                break
+            self.execute(job, alias)
+            processed += 1
+        return processed
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+مطابقة أرصدة الحسابات مع القيود المرحلة
+
+    python manage.py rebuild_balances                 # قاعدة البيانات الافتراضية
+    python manage.py rebuild_balances --company ABC   # شركة محددة
+    python manage.py rebuild_balances --all-companies # جميع الشركات
+"""
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand
+
+from core.account_ledger import AccountBalanceLedger
+from core.database_router import available_company_codes, use_company_database, company_atomic
+
+
+class Command(BaseCommand):
+    help = 'إعادة حساب أرصدة الحسابات من القيود المرحلة باستعلام تجميع واحد'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', action='append', default=[], help='رمز الشركة (يمكن تكراره)')
+        parser.add_argument('--all-companies', action='store_true', help='تنفيذ على جميع قواعد بيانات الشركات')
+        parser.add_argument('--dry-run', action='store_true', help='عرض الحسابات المختلفة بدون حفظ')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        codes = available_company_codes() if options['all_companies'] else options['company']
+        targets = codes or [None]
+
+        for code in targets:
+            with (use_company_database(code) if code else nullcontext()):
+                with company_atomic():
+                    drift = AccountBalanceLedger.rebuild(
+                        batch_size=options['batch_size'],
+                        dry_run=options['dry_run']
+                    )
+            label = code or 'default'
+            self.stdout.write(f'{label}: {len(drift)} حساب مختلف' + (' (بدون حفظ)' if options['dry_run'] else ' تم تصحيحه'))
+            if options['verbosity'] > 1:
+                for item in drift:
+                    self.stdout.write(
+                        f"  {item['account_code']}: المخزن {item['stored_balance']} "
+                        f"الصحيح {item['expected_balance']} الفرق {item['difference']}"
+                    )
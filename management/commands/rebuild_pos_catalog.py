@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+إعادة بناء كتالوج نقطة البيع (منتج × مخزن) من المنتجات والأسعار والمخزون
+
+    python manage.py rebuild_pos_catalog                 # قاعدة البيانات الافتراضية
+    python manage.py rebuild_pos_catalog --company ABC   # شركة محددة
+    python manage.py rebuild_pos_catalog --all-companies # جميع الشركات
+"""
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand
+
+from core.database_router import available_company_codes, use_company_database, company_atomic
+from core.pos_catalog import POSCatalog
+
+
+class Command(BaseCommand):
+    help = 'إعادة بناء POSCatalogItem لجميع المنتجات والمخازن'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', action='append', default=[], help='رمز الشركة (يمكن تكراره)')
+        parser.add_argument('--all-companies', action='store_true', help='تنفيذ على جميع قواعد بيانات الشركات')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        codes = available_company_codes() if options['all_companies'] else options['company']
+        targets = codes or [None]
+
+        for code in targets:
+            with (use_company_database(code) if code else nullcontext()):
+                with company_atomic():
+                    count = POSCatalog.refresh(batch_size=options['batch_size'])
+            label = code or 'default'
+            self.stdout.write(f'{label}: {count} صف في الكتالوج')
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+مطابقة عدادات جلسات نقاط البيع مع مبيعاتها
+
+    python manage.py rebuild_pos_sessions --dry-run          # تقرير الفروقات فقط
+    python manage.py rebuild_pos_sessions --company ABC      # شركة محددة
+    python manage.py rebuild_pos_sessions --all-companies    # جميع الشركات
+"""
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand
+
+from core.pos_session_totals import POSSessionTotals
+from core.database_router import available_company_codes, use_company_database, company_atomic
+
+
+class Command(BaseCommand):
+    help = 'إعادة حساب عدادات جلسات نقاط البيع من المبيعات باستعلام تجميع واحد'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', action='append', default=[], help='رمز الشركة (يمكن تكراره)')
+        parser.add_argument('--all-companies', action='store_true', help='تنفيذ على جميع قواعد بيانات الشركات')
+        parser.add_argument('--dry-run', action='store_true', help='عرض الفروقات بدون حفظ')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        codes = available_company_codes() if options['all_companies'] else options['company']
+        targets = codes or [None]
+
+        for code in targets:
+            with (use_company_database(code) if code else nullcontext()):
+                with company_atomic():
+                    drift = POSSessionTotals.rebuild(
+                        batch_size=options['batch_size'],
+                        dry_run=options['dry_run']
+                    )
+            label = code or 'default'
+            self.stdout.write(f'{label}: {len(drift)} جلسة مختلفة' + (' (بدون حفظ)' if options['dry_run'] else ' تم تصحيحها'))
+            if options['verbosity'] > 1:
+                for item in drift:
+                    self.stdout.write(
+                        f"  جلسة {item['session_number']}: المخزن {item['stored']} الصحيح {item['expected']}"
+                    )
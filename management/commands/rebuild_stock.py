@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+التحقق من دفتر المخزون وإعادة بنائه من حركات المخزون
+
+    python manage.py rebuild_stock --dry-run          # تقرير الفروقات فقط
+    python manage.py rebuild_stock --company ABC      # شركة محددة
+    python manage.py rebuild_stock --all-companies    # جميع الشركات
+    python manage.py rebuild_stock --reset-unmatched  # تصفير الأرصدة التي ليس لها حركات
+"""
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand
+
+from core.stock_ledger import StockLedger
+from core.database_router import available_company_codes, use_company_database, company_atomic
+
+
+class Command(BaseCommand):
+    help = 'إعادة بناء ProductStock.current_stock من حركات المخزون باستعلام تجميع واحد'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', action='append', default=[], help='رمز الشركة (يمكن تكراره)')
+        parser.add_argument('--all-companies', action='store_true', help='تنفيذ على جميع قواعد بيانات الشركات')
+        parser.add_argument('--dry-run', action='store_true', help='عرض الفروقات بدون حفظ')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--reset-unmatched', action='store_true',
+            help='تصفير أرصدة ProductStock التي ليس لها أي حركة مخزون (تبقى كما هي بدونه)'
+        )
+
+    def handle(self, *args, **options):
+        codes = available_company_codes() if options['all_companies'] else options['company']
+        targets = codes or [None]
+
+        for code in targets:
+            with (use_company_database(code) if code else nullcontext()):
+                with company_atomic():
+                    drift = StockLedger.rebuild(
+                        batch_size=options['batch_size'],
+                        dry_run=options['dry_run'],
+                        reset_unmatched=options['reset_unmatched']
+                    )
+            label = code or 'default'
+            unmatched = [item for item in drift if item['unmatched']]
+            self.stdout.write(f'{label}: {len(drift)} رصيد مختلف' + (' (بدون حفظ)' if options['dry_run'] else ' تم تصحيحه'))
+            if unmatched:
+                action = 'تم تصفيرها' if options['reset_unmatched'] and not options['dry_run'] else 'لم تتغير'
+                self.stdout.write(f'{label}: {len(unmatched)} رصيد بدون حركات مخزون ({action})')
+            if options['verbosity'] > 1 or (options['dry_run'] and unmatched):
+                for item in drift if options['verbosity'] > 1 else unmatched:
+                    self.stdout.write(
+                        f"  منتج {item['product_id']} مخزن {item['warehouse_id']}: "
+                        f"المخزن {item['stored_stock']} الصحيح {item['expected_stock']}"
+                        + (' (بدون حركات)' if item['unmatched'] else '')
+                    )
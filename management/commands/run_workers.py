@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+تنفيذ المهام الخلفية (core.job_queue)
+
+    python manage.py run_workers                       # عامل واحد لجميع الشركات
+    python manage.py run_workers --processes 4         # 4 عمليات
+    python manage.py run_workers --company ABC --once  # تنفيذ المهام الجاهزة ثم الخروج
+
+كل شركة تعالجها عملية واحدة فقط، لذلك تنفذ مهام الشركة بترتيب إضافتها.
+"""
+import multiprocessing
+import time
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand
+from django.db import connections, DatabaseError
+
+from core.database_router import available_company_codes, use_company_database
+from core.job_queue import JobWorker
+
+
+def _work(index, processes, targets, options):
+    """حلقة عملية واحدة: الشركات التي يكون ترتيبها % processes == index"""
+    worker = JobWorker(retry_delay=options['retry_delay'], stale_after=options['stale_after'])
+    assigned = [target for position, target in enumerate(targets) if position % processes == index]
+
+    for code in assigned:
+        with (use_company_database(code) if code else nullcontext()):
+            try:
+                worker.reset_stale()
+            except DatabaseError:
+                pass
+
+    while True:
+        processed = 0
+        for code in assigned:
+            with (use_company_database(code) if code else nullcontext()):
+                try:
+                    processed += worker.run_pending(limit=options['batch_size'])
+                except DatabaseError as e:
+                    # قاعدة بيانات بدون جدول المهام
+                    print(f"خطأ في تنفيذ مهام {code or 'default'}: {e}")
+        if not processed:
+            if options['once']:
+                return
+            time.sleep(options['poll_interval'])
+
+
+class Command(BaseCommand):
+    help = 'تنفيذ المهام الخلفية المحفوظة في قواعد بيانات الشركات'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', action='append', default=[], help='رمز الشركة (يمكن تكراره)')
+        parser.add_argument('--processes', type=int, default=1, help='عدد العمليات')
+        parser.add_argument('--batch-size', type=int, default=100, help='عدد المهام لكل شركة في كل دورة')
+        parser.add_argument('--poll-interval', type=float, default=2.0, help='الانتظار بالثواني عند عدم وجود مهام')
+        parser.add_argument('--retry-delay', type=int, default=30, help='مدة الانتظار قبل أول إعادة محاولة')
+        parser.add_argument('--stale-after', type=int, default=600, help='إعادة المهام المتوقفة بعد هذه المدة بالثواني')
+        parser.add_argument('--once', action='store_true', help='تنفيذ المهام الجاهزة ثم الخروج')
+
+    def handle(self, *args, **options):
+        targets = options['company'] or [None] + available_company_codes()
+        processes = max(1, min(options['processes'], len(targets)))
+        self.stdout.write(f'تشغيل {processes} عملية لـ {len(targets)} قاعدة بيانات')
+
+        if processes == 1:
+            _work(0, 1, targets, options)
+            return
+
+        # الاتصالات لا تنتقل بين العمليات
+        connections.close_all()
+        workers = [
+            multiprocessing.Process(target=_work, args=(index, processes, targets, options))
+            for index in range(processes)
+        ]
+        for process in workers:
+            process.start()
+        try:
+            for process in workers:
+                process.join()
+        except KeyboardInterrupt:
+            for process in workers:
+                process.terminate()
@@ -1,10 +1,10 @@
 # نظام إدارة صاحب البرنامج الشامل
 from django.core.management.base import BaseCommand
 from django.contrib.auth.models import User
-from django.db import transaction
 from datetime import date, timedelta
 import os
 
+from .database_router import company_atomic
 from .models import Company, UserProfile
 from .master_admin_models import (
     MasterAdmin, CompanySubscription, CompanyPayment, SystemSettings,
@@ -18,7 +18,7 @@ class MasterAdminManager:
     def create_master_admin(username, password, full_name, email, phone):
         """إنشاء صاحب البرنامج الرئيسي"""
         try:
-            with transaction.atomic():
+            with company_atomic():
                 # إنشاء المستخدم
                 user = User.objects.create_superuser(
                     username=username,
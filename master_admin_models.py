@@ -80,6 +80,11 @@ class CompanySubscription(models.Model):
             self.end_date = date.today() + timedelta(days=30 * months)
         else:
             self.end_date += timedelta(days=30 * months)
+        # تحديث تاريخ انتهاء الشركة قبل الحفظ، فحفظ الاشتراك يبطل حالة الشركة المحفوظة
+        from .models import Company
+        Company._base_manager.filter(
+            pk=self.company_id, subscription_end__lt=self.end_date
+        ).update(subscription_end=self.end_date)
         self.save()
 
 class CompanyPayment(models.Model):
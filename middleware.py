@@ -4,9 +4,12 @@ Middleware لإدارة قواعد البيانات المتعددة
 """
 import os
 from django.conf import settings
-from django.db import connection
 from django.shortcuts import redirect
 from django.urls import reverse
+from .database_router import (
+    company_db_path, set_current_company, clear_current_company, reset_current_company,
+    is_database_valid, invalidate_database_validation
+)
 
 class MultiDatabaseMiddleware:
     """Middleware لتبديل قواعد البيانات حسب الشركة"""
@@ -16,26 +19,23 @@ class MultiDatabaseMiddleware:
     
     def __call__(self, request):
         # تبديل قاعدة البيانات حسب الشركة في الجلسة
+        token = clear_current_company()
         if request.user.is_authenticated and 'company_code' in request.session:
             company_code = request.session['company_code']
             self.switch_database(company_code)
         
-        response = self.get_response(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            reset_current_company(token)
         return response
     
     def switch_database(self, company_code):
-        """تبديل قاعدة البيانات"""
+        """تبديل قاعدة البيانات للطلب الحالي فقط"""
         try:
-            db_name = f"erp_{company_code.lower()}.db"
-            db_path = os.path.join(settings.BASE_DIR, 'databases', db_name)
-            
-            if os.path.exists(db_path):
-                current_db = settings.DATABASES['default']['NAME']
-                if current_db != db_path:
-                    settings.DATABASES['default']['NAME'] = db_path
-                    connection.close()
+            return set_current_company(company_code)
         except Exception as e:
-            pass
+            return None
 
 
 class CompanyMiddleware:
@@ -46,6 +46,7 @@ class CompanyMiddleware:
     
     def __call__(self, request):
         # تبديل قاعدة البيانات حسب الشركة
+        token = clear_current_company()
         try:
             # إذا كان المستخدم مسجل دخول ولا يوجد company_code في الجلسة
             if (hasattr(request, 'user') and request.user.is_authenticated and 
@@ -71,15 +72,11 @@ class CompanyMiddleware:
             
             if hasattr(request, 'session') and 'company_code' in request.session:
                 company_code = request.session['company_code']
-                db_name = f"erp_{company_code.lower()}.db"
-                db_path = os.path.join(settings.BASE_DIR, 'databases', db_name)
+                db_path = company_db_path(company_code)
                 
                 # التحقق من وجود قاعدة البيانات وأنها تحتوي على الجداول الأساسية
-                if os.path.exists(db_path) and self.is_database_valid(db_path):
-                    current_db = str(settings.DATABASES['default']['NAME'])
-                    if current_db != str(db_path):
-                        settings.DATABASES['default']['NAME'] = db_path
-                        connection.close()
+                if self.is_database_valid(db_path):
+                    set_current_company(company_code)
                 else:
                     # إذا كانت قاعدة البيانات غير صالحة، إنشاؤها أو إصلاحها
                     self.fix_database(db_path)
@@ -87,27 +84,15 @@ class CompanyMiddleware:
             # في حالة الخطأ، استخدام قاعدة البيانات الافتراضية
             pass
         
-        response = self.get_response(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            reset_current_company(token)
         return response
     
     def is_database_valid(self, db_path):
-        """فحص صحة قاعدة البيانات"""
-        try:
-            import sqlite3
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            
-            # فحص وجود الجداول الأساسية
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='auth_user';")
-            auth_exists = cursor.fetchone() is not None
-            
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='core_company';")
-            company_exists = cursor.fetchone() is not None
-            
-            conn.close()
-            return auth_exists and company_exists
-        except:
-            return False
+        """فحص صحة قاعدة البيانات (من السجل المحفوظ في الذاكرة)"""
+        return is_database_valid(db_path)
     
     def fix_database(self, db_path):
         """إصلاح قاعدة البيانات"""
@@ -120,4 +105,6 @@ class CompanyMiddleware:
                 # نسخ قاعدة البيانات الرئيسية
                 shutil.copy2(main_db, db_path)
         except:
-            pass
\ No newline at end of file
+            pass
+        finally:
+            invalidate_database_validation(db_path)
\ No newline at end of file
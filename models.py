@@ -1,10 +1,9 @@
 # Django imports (must be at the top)
-from django.db import models
+from django.db import models, transaction, connections, IntegrityError
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 from decimal import Decimal
-from django.core.cache import cache
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 import uuid
@@ -279,7 +278,7 @@ class Product(CompanyFilterMixin, models.Model):
     
     objects = CompanyManager()
     name = models.CharField(max_length=200, verbose_name='اسم المنتج')
-    barcode = models.CharField(max_length=50, verbose_name='الباركود')
+    barcode = models.CharField(max_length=50, db_index=True, verbose_name='الباركود')
     category = models.CharField(max_length=50, choices=CATEGORY_CHOICES, verbose_name='الفئة')
     unit = models.CharField(max_length=20, choices=UNIT_CHOICES, default='قطعة', verbose_name='الوحدة')
     price = models.DecimalField(max_digits=10, decimal_places=2, default=0, verbose_name='السعر')
@@ -455,16 +454,7 @@ class POSSession(CompanyFilterMixin, models.Model):
         super().save(*args, **kwargs)
     
     def generate_session_number(self):
-        import datetime
-        today = datetime.date.today()
-        prefix = f"POS-{today.year}{today.month:02d}{today.day:02d}"
-        last_session = POSSession.objects.filter(session_number__startswith=prefix).order_by('-id').first()
-        if last_session:
-            last_number = int(last_session.session_number.split('-')[-1])
-            new_number = last_number + 1
-        else:
-            new_number = 1
-        return f"{prefix}-{new_number:03d}"
+        return next_document_number(self, 'session_number', 'POS', width=3)
 
 class POSSale(CompanyFilterMixin, models.Model):
     company = models.ForeignKey(Company, on_delete=models.CASCADE, verbose_name='الشركة', db_index=True)
@@ -925,38 +915,17 @@ class Setting(models.Model):
         return icons.get(category, '📋')
 
 class SettingsManager:
-    _cache = {}
+    """واجهة الإعدادات - القراءة من محرك الإعدادات الموحد (settings_cache.SettingsEngine)"""
     
     @classmethod
     def get(cls, key, company=None, branch=None, default=None):
-        cache_key = f"{company.id if company else 'global'}_{branch.id if branch else 'global'}_{key}"
-        
-        if cache_key in cls._cache:
-            return cls._cache[cache_key]
-        
-        try:
-            # البحث بالأولوية: فرع محدد -> شركة محددة -> عام
-            setting = Setting.objects.filter(key=key).filter(
-                models.Q(company=company, branch=branch) |
-                models.Q(company=company, branch__isnull=True) |
-                models.Q(is_global=True)
-            ).order_by(
-                models.Case(
-                    models.When(company=company, branch=branch, then=1),
-                    models.When(company=company, branch__isnull=True, then=2),
-                    models.When(is_global=True, then=3),
-                    default=4
-                )
-            ).first()
-            
-            if setting:
-                value = setting.get_value()
-                cls._cache[cache_key] = value
-                return value
-        except Setting.DoesNotExist:
-            pass
-        
-        return default
+        from .settings_cache import SettingsEngine
+        return SettingsEngine.get(key, company=company, branch=branch, default=default)
+    
+    @classmethod
+    def get_multiple(cls, keys, company=None, branch=None, defaults=None):
+        from .settings_cache import SettingsEngine
+        return SettingsEngine.get_multiple(keys, company=company, branch=branch, defaults=defaults)
     
     @classmethod
     def set(cls, key, value, company=None, branch=None, setting_type='string', category='عامة', description='', user=None):
@@ -977,46 +946,32 @@ class SettingsManager:
             if description:
                 setting.description = description
             setting.save()
-        
-        cache_key = f"{company.id if company else 'global'}_{branch.id if branch else 'global'}_{key}"
-        cls._cache[cache_key] = value
+        # حفظ الإعداد يزيد إصدار الشركة فيبطل الكاش في جميع العمليات
         return setting
     
     @classmethod
-    def clear_cache(cls):
-        cls._cache.clear()
+    def clear_cache(cls, company=None, branch=None):
+        from .settings_cache import SettingsEngine
+        SettingsEngine.invalidate(company, branch)
 
 class DynamicSettingsManager:
-    CACHE_PREFIX = 'setting_'
-    CACHE_TIMEOUT = 3600
+    """نفس SettingsManager مع ترتيب المعاملات القديم (key, branch, default)"""
     
     @classmethod
-    def get_cache_key(cls, key, branch_id=None):
-        return f"{cls.CACHE_PREFIX}{branch_id or 'global'}_{key}"
+    def get(cls, key, branch=None, default=None):
+        return SettingsManager.get(key, branch=branch, default=default)
     
     @classmethod
-    def get(cls, key, branch=None, default=None):
-        cache_key = cls.get_cache_key(key, branch.id if branch else None)
-        value = cache.get(cache_key)
-        if value is not None:
-            return value
-        
-        value = SettingsManager.get(key, branch, default)
-        cache.set(cache_key, value, cls.CACHE_TIMEOUT)
-        return value
+    def get_multiple(cls, keys, branch=None, defaults=None):
+        return SettingsManager.get_multiple(keys, branch=branch, defaults=defaults)
     
     @classmethod
     def set(cls, key, value, branch=None, setting_type='string', category='general'):
-        setting = SettingsManager.set(key, value, branch, setting_type, category)
-        cache_key = cls.get_cache_key(key, branch.id if branch else None)
-        cache.set(cache_key, value, cls.CACHE_TIMEOUT)
-        return setting
+        return SettingsManager.set(key, value, branch=branch, setting_type=setting_type, category=category)
     
     @classmethod
     def clear_cache(cls, key=None, branch=None):
-        if key:
-            cache_key = cls.get_cache_key(key, branch.id if branch else None)
-            cache.delete(cache_key)
+        SettingsManager.clear_cache(branch=branch)
 
 # نماذج المرتجعات
 class SaleReturn(CompanyFilterMixin, models.Model):
@@ -1054,16 +1009,7 @@ class SaleReturn(CompanyFilterMixin, models.Model):
         super().save(*args, **kwargs)
     
     def generate_return_number(self):
-        import datetime
-        today = datetime.date.today()
-        prefix = f"SR-{today.year}{today.month:02d}{today.day:02d}"
-        last_return = SaleReturn.objects.filter(return_number__startswith=prefix).order_by('-id').first()
-        if last_return:
-            last_number = int(last_return.return_number.split('-')[-1])
-            new_number = last_number + 1
-        else:
-            new_number = 1
-        return f"{prefix}-{new_number:04d}"
+        return next_document_number(self, 'return_number', 'SR')
 
 class SaleReturnItem(CompanyFilterMixin, models.Model):
     company = models.ForeignKey(Company, on_delete=models.CASCADE, verbose_name='الشركة', db_index=True)
@@ -1119,16 +1065,7 @@ class PurchaseReturn(CompanyFilterMixin, models.Model):
         super().save(*args, **kwargs)
     
     def generate_return_number(self):
-        import datetime
-        today = datetime.date.today()
-        prefix = f"PR-{today.year}{today.month:02d}{today.day:02d}"
-        last_return = PurchaseReturn.objects.filter(return_number__startswith=prefix).order_by('-id').first()
-        if last_return:
-            last_number = int(last_return.return_number.split('-')[-1])
-            new_number = last_number + 1
-        else:
-            new_number = 1
-        return f"{prefix}-{new_number:04d}"
+        return next_document_number(self, 'return_number', 'PR')
 
 class PurchaseReturnItem(CompanyFilterMixin, models.Model):
     company = models.ForeignKey(Company, on_delete=models.CASCADE, verbose_name='الشركة', db_index=True)
@@ -1333,17 +1270,24 @@ Purchase.add_to_class('confirmed_by', models.ForeignKey(User, on_delete=models.S
 Purchase.add_to_class('confirmed_at', models.DateTimeField(null=True, blank=True, verbose_name='تاريخ التأكيد'))
 
 
+# المسار الكامل للحساب في الشجرة (/1/12/1201/) لترتيب الشجرة وفلترة الفروع (core.account_tree)
+Account.add_to_class('tree_path', models.CharField(max_length=255, blank=True, default='', db_index=True, verbose_name='مسار الحساب'))
+Account.add_to_class('tree_depth', models.PositiveSmallIntegerField(default=0, verbose_name='مستوى الحساب'))
+
 
 # إضافة حقول لجلسة نقاط البيع
 POSSession.add_to_class('cash_sales', models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name='مبيعات نقدية'))
 POSSession.add_to_class('knet_sales', models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name='مبيعات كي نت'))
 POSSession.add_to_class('mixed_sales', models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name='مبيعات مختلطة'))
+POSSession.add_to_class('sales_count', models.IntegerField(default=0, verbose_name='عدد المبيعات'))
 
 # إضافة حقول لبيع نقاط البيع
 POSSale.add_to_class('customer_name', models.CharField(max_length=200, default='عميل نقدي', verbose_name='اسم العميل'))
 POSSale.add_to_class('paid_amount', models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name='المبلغ المدفوع'))
 POSSale.add_to_class('knet_amount', models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name='مبلغ الكي نت'))
 POSSale.add_to_class('linked_sale', models.ForeignKey(Sale, on_delete=models.SET_NULL, null=True, blank=True, verbose_name='فاتورة البيع المربوطة'))
+# مفتاح عدم التكرار الذي يولده جهاز نقاط البيع لكل إيصال (لمزامنة المبيعات بدون اتصال)
+POSSale.add_to_class('idempotency_key', models.CharField(max_length=64, unique=True, null=True, blank=True, verbose_name='مفتاح عدم التكرار'))
 
 # إضافة دوال تأكيد للمرتجعات
 def confirm_sale_return_method(self, user):
@@ -1396,11 +1340,8 @@ def confirm_invoice(self, user):
             product.stock -= item.quantity
             product.save()
     
-    # إنشاء قيد محاسبي
+    # إنشاء قيد محاسبي (رصيد العميل يتم تحديثه مع ترحيل القيد)
     create_sale_journal_entry(self)
-    
-    # تحديث رصيد العميل
-    update_customer_balance(self.customer)
 
 Sale.confirm_invoice = confirm_invoice
 
@@ -1467,276 +1408,44 @@ def confirm_purchase_return(purchase_return, user):
 
 # دوال إنشاء القيود المحاسبية
 def create_sale_return_journal_entry(sale_return):
-    """إنشاء قيد محاسبي لمرتجع البيع"""
+    """إنشاء قيد محاسبي لمرتجع البيع (مرة واحدة فقط لكل مرتجع)"""
+    from .posting import PostingPipeline
     try:
-        customer_account = get_or_create_customer_account(sale_return.customer)
-        sales_account = get_or_create_account('4001', 'مبيعات', 'revenue', sale_return.company)
-        sales_return_account = get_or_create_account('4002', 'مرتجعات مبيعات', 'revenue', sale_return.company)
-        
-        entry = JournalEntry.objects.create(
-            company=sale_return.company,
-            entry_type='return',
-            transaction_type='return',
-            description=f'مرتجع بيع #{sale_return.return_number} - {sale_return.customer.name}',
-            reference_id=sale_return.id,
-            reference_type='sale_return',
-            amount=sale_return.total_amount,
-            total_amount=sale_return.total_amount,
-            created_by=sale_return.created_by
-        )
-        
-        # مرتجعات مبيعات (مدين)
-        JournalEntryLine.objects.create(
-            company=sale_return.company,
-            journal_entry=entry,
-            account=sales_return_account,
-            debit=sale_return.total_amount,
-            credit=0,
-            description=f'مرتجع بيع #{sale_return.return_number}'
-        )
-        
-        # العميل (دائن)
-        JournalEntryLine.objects.create(
-            company=sale_return.company,
-            journal_entry=entry,
-            account=customer_account,
-            debit=0,
-            credit=sale_return.total_amount,
-            description=f'مرتجع بيع #{sale_return.return_number}'
-        )
-        
-        entry.is_posted = True
-        entry.posted_at = timezone.now()
-        entry.posted_by = sale_return.created_by
-        entry.save()
-        
+        return PostingPipeline.post_sale_return(sale_return)
     except Exception as e:
         pass
 
 def create_purchase_return_journal_entry(purchase_return):
-    """إنشاء قيد محاسبي لمرتجع الشراء"""
+    """إنشاء قيد محاسبي لمرتجع الشراء (مرة واحدة فقط لكل مرتجع)"""
+    from .posting import PostingPipeline
     try:
-        supplier_account = get_or_create_supplier_account(purchase_return.supplier)
-        purchases_account = get_or_create_account('5001', 'مشتريات', 'expense', purchase_return.company)
-        purchase_return_account = get_or_create_account('5002', 'مرتجعات مشتريات', 'expense', purchase_return.company)
-        
-        entry = JournalEntry.objects.create(
-            company=purchase_return.company,
-            entry_type='return',
-            transaction_type='return',
-            description=f'مرتجع شراء #{purchase_return.return_number} - {purchase_return.supplier.name}',
-            reference_id=purchase_return.id,
-            reference_type='purchase_return',
-            amount=purchase_return.total_amount,
-            total_amount=purchase_return.total_amount,
-            created_by=purchase_return.created_by
-        )
-        
-        # المورد (مدين)
-        JournalEntryLine.objects.create(
-            company=purchase_return.company,
-            journal_entry=entry,
-            account=supplier_account,
-            debit=purchase_return.total_amount,
-            credit=0,
-            description=f'مرتجع شراء #{purchase_return.return_number}'
-        )
-        
-        # مرتجعات مشتريات (دائن)
-        JournalEntryLine.objects.create(
-            company=purchase_return.company,
-            journal_entry=entry,
-            account=purchase_return_account,
-            debit=0,
-            credit=purchase_return.total_amount,
-            description=f'مرتجع شراء #{purchase_return.return_number}'
-        )
-        
-        entry.is_posted = True
-        entry.posted_at = timezone.now()
-        entry.posted_by = purchase_return.created_by
-        entry.save()
-        
+        return PostingPipeline.post_purchase_return(purchase_return)
     except Exception as e:
         pass
 
 def create_sale_journal_entry(sale):
-    """إنشاء قيد محاسبي لفاتورة البيع"""
+    """إنشاء قيد محاسبي لفاتورة البيع (مرة واحدة فقط لكل فاتورة)"""
+    from .posting import PostingPipeline
     try:
-        # البحث عن الحسابات المطلوبة
-        customer_account = get_or_create_customer_account(sale.customer)
-        sales_account = get_or_create_account('4001', 'مبيعات', 'revenue', sale.company)
-        
-        # إنشاء القيد
-        entry = JournalEntry.objects.create(
-            company=sale.company,
-            entry_type='sale',
-            transaction_type='sale',
-            description=f'فاتورة بيع #{sale.invoice_number} - {sale.customer.name}',
-            reference_id=sale.id,
-            reference_type='sale',
-            amount=sale.total_amount,
-            total_amount=sale.total_amount,
-            created_by=sale.created_by
-        )
-        
-        # سطر العميل (مدين)
-        JournalEntryLine.objects.create(
-            company=sale.company,
-            journal_entry=entry,
-            account=customer_account,
-            debit=sale.total_amount,
-            credit=0,
-            description=f'فاتورة بيع #{sale.invoice_number}'
-        )
-        
-        # سطر المبيعات (دائن)
-        JournalEntryLine.objects.create(
-            company=sale.company,
-            journal_entry=entry,
-            account=sales_account,
-            debit=0,
-            credit=sale.total_amount,
-            description=f'فاتورة بيع #{sale.invoice_number}'
-        )
-        
-        # ترحيل القيد
-        entry.is_posted = True
-        entry.posted_at = timezone.now()
-        entry.posted_by = sale.created_by
-        entry.save()
-        
+        return PostingPipeline.post_sale(sale)
     except Exception as e:
         pass  # تجاهل الأخطاء لعدم تعطيل العملية الأساسية
 
 def create_purchase_journal_entry(purchase):
-    """إنشاء قيد محاسبي لفاتورة الشراء"""
+    """إنشاء قيد محاسبي لفاتورة الشراء (مرة واحدة فقط لكل فاتورة)"""
+    from .posting import PostingPipeline
     try:
-        supplier_account = get_or_create_supplier_account(purchase.supplier)
-        purchases_account = get_or_create_account('5001', 'مشتريات', 'expense', purchase.company)
-        
-        entry = JournalEntry.objects.create(
-            company=purchase.company,
-            entry_type='purchase',
-            transaction_type='purchase',
-            description=f'فاتورة شراء #{purchase.invoice_number} - {purchase.supplier.name}',
-            reference_id=purchase.id,
-            reference_type='purchase',
-            amount=purchase.total_amount,
-            total_amount=purchase.total_amount,
-            created_by=purchase.created_by
-        )
-        
-        # سطر المشتريات (مدين)
-        JournalEntryLine.objects.create(
-            company=purchase.company,
-            journal_entry=entry,
-            account=purchases_account,
-            debit=purchase.total_amount,
-            credit=0,
-            description=f'فاتورة شراء #{purchase.invoice_number}'
-        )
-        
-        # سطر المورد (دائن)
-        JournalEntryLine.objects.create(
-            company=purchase.company,
-            journal_entry=entry,
-            account=supplier_account,
-            debit=0,
-            credit=purchase.total_amount,
-            description=f'فاتورة شراء #{purchase.invoice_number}'
-        )
-        
-        entry.is_posted = True
-        entry.posted_at = timezone.now()
-        entry.posted_by = purchase.created_by
-        entry.save()
-        
+        return PostingPipeline.post_purchase(purchase)
     except Exception as e:
         pass
 
 def create_payment_journal_entry(payment, payment_type='customer'):
-    """إنشاء قيد محاسبي للدفعات"""
+    """إنشاء قيد محاسبي للدفعات (مرة واحدة فقط لكل دفعة)"""
+    from .posting import PostingPipeline
     try:
-        cash_account = get_or_create_account('1001', 'النقدية', 'asset', payment.customer.company if payment_type == 'customer' else payment.supplier.company)
-        
         if payment_type == 'customer':
-            customer_account = get_or_create_customer_account(payment.customer)
-            description = f'دفعة من العميل {payment.customer.name} - #{payment.payment_number}'
-            
-            entry = JournalEntry.objects.create(
-                company=payment.customer.company,
-                entry_type='voucher',
-                transaction_type='voucher',
-                description=description,
-                reference_id=payment.id,
-                reference_type='customer_payment',
-                amount=payment.amount,
-                total_amount=payment.amount,
-                created_by=payment.created_by
-            )
-            
-            # النقدية (مدين)
-            JournalEntryLine.objects.create(
-                company=payment.customer.company,
-                journal_entry=entry,
-                account=cash_account,
-                debit=payment.amount,
-                credit=0,
-                description=description
-            )
-            
-            # العميل (دائن)
-            JournalEntryLine.objects.create(
-                company=payment.customer.company,
-                journal_entry=entry,
-                account=customer_account,
-                debit=0,
-                credit=payment.amount,
-                description=description
-            )
-            
-        else:  # supplier payment
-            supplier_account = get_or_create_supplier_account(payment.supplier)
-            description = f'دفعة للمورد {payment.supplier.name} - #{payment.payment_number}'
-            
-            entry = JournalEntry.objects.create(
-                company=payment.supplier.company,
-                entry_type='voucher',
-                transaction_type='voucher',
-                description=description,
-                reference_id=payment.id,
-                reference_type='supplier_payment',
-                amount=payment.amount,
-                total_amount=payment.amount,
-                created_by=payment.created_by
-            )
-            
-            # المورد (مدين)
-            JournalEntryLine.objects.create(
-                company=payment.supplier.company,
-                journal_entry=entry,
-                account=supplier_account,
-                debit=payment.amount,
-                credit=0,
-                description=description
-            )
-            
-            # النقدية (دائن)
-            JournalEntryLine.objects.create(
-                company=payment.supplier.company,
-                journal_entry=entry,
-                account=cash_account,
-                debit=0,
-                credit=payment.amount,
-                description=description
-            )
-        
-        entry.is_posted = True
-        entry.posted_at = timezone.now()
-        entry.posted_by = payment.created_by
-        entry.save()
-        
+            return PostingPipeline.post_customer_payment(payment)
+        return PostingPipeline.post_supplier_payment(payment)
     except Exception as e:
         pass
 
@@ -1749,7 +1458,8 @@ def get_or_create_customer_account(customer):
         defaults={
             'name': f'العميل - {customer.name}',
             'account_type': 'asset',
-            'balance': 0
+            'opening_balance': customer.opening_balance or 0,
+            'balance': customer.opening_balance or 0
         }
     )
     return account
@@ -1763,7 +1473,8 @@ def get_or_create_supplier_account(supplier):
         defaults={
             'name': f'المورد - {supplier.name}',
             'account_type': 'liability',
-            'balance': 0
+            'opening_balance': supplier.opening_balance or 0,
+            'balance': supplier.opening_balance or 0
         }
     )
     return account
@@ -1803,6 +1514,142 @@ def get_or_create_account(code, name, account_type, company=None):
     )
     return account
 
+# تسلسل أرقام المستندات
+class DocumentSequence(models.Model):
+    """
+    عداد أرقام المستندات لكل شركة وبادئة ويوم
+
+    يتم حجز الرقم بعملية UPDATE ذرية على صف العداد بدلاً من البحث عن آخر رقم
+    بـ LIKE، لذلك لا يتكرر الرقم بين الكاشيرات. إذا تم الحجز داخل معاملة الحفظ
+    فإن التراجع عنها يرجع العداد أيضاً فلا تحدث فجوات. حجز مجموعة أرقام
+    (block_size > 1) أسرع لكنه قد يترك فجوات عند إعادة تشغيل العملية.
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, null=True, blank=True, verbose_name='الشركة')
+    prefix = models.CharField(max_length=20, verbose_name='البادئة')
+    period = models.CharField(max_length=8, blank=True, verbose_name='الفترة')
+    last_value = models.PositiveIntegerField(default=0, verbose_name='آخر رقم')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='تاريخ التحديث')
+    
+    # مجموعات الأرقام المحجوزة لهذه العملية: المفتاح -> [الرقم التالي, آخر رقم]
+    _blocks = {}
+    _blocks_lock = threading.Lock()
+    
+    class Meta:
+        verbose_name = 'تسلسل مستندات'
+        verbose_name_plural = 'تسلسلات المستندات'
+        constraints = [
+            models.UniqueConstraint(fields=['company', 'prefix', 'period'], name='unique_document_sequence'),
+            models.UniqueConstraint(
+                fields=['prefix', 'period'], condition=models.Q(company__isnull=True),
+                name='unique_global_document_sequence'
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.prefix}-{self.period}: {self.last_value}"
+    
+    @classmethod
+    def reserve(cls, prefix, period='', company_id=None, count=1, seed=None):
+        """
+        حجز count رقم متتالي وإرجاع أولها
+
+        seed دالة ترجع آخر رقم مستخدم قبل إنشاء العداد (للبيانات الموجودة مسبقاً)،
+        ويتم استدعاؤها مرة واحدة فقط عند إنشاء صف العداد.
+        """
+        from .database_router import get_current_db_alias
+        alias = get_current_db_alias()
+        sequences = cls.objects.using(alias).filter(company_id=company_id, prefix=prefix, period=period)
+        
+        with transaction.atomic(using=alias):
+            if not sequences.update(last_value=models.F('last_value') + count):
+                start = seed() if seed else 0
+                try:
+                    with transaction.atomic(using=alias):
+                        cls.objects.using(alias).create(
+                            company_id=company_id, prefix=prefix, period=period, last_value=start + count
+                        )
+                except IntegrityError:
+                    # تم إنشاء العداد من عملية أخرى في نفس اللحظة
+                    sequences.update(last_value=models.F('last_value') + count)
+            last_value = sequences.values_list('last_value', flat=True).get()
+        
+        return last_value - count + 1
+    
+    @classmethod
+    def allocate(cls, prefix, period='', company_id=None, block_size=1, seed=None):
+        """
+        الحصول على الرقم التالي، مع إمكانية حجز مجموعة أرقام للعملية الحالية
+
+        داخل معاملة مفتوحة يتم الحجز رقماً رقماً دائماً، لأن التراجع عن المعاملة
+        سيرجع العداد بينما تبقى المجموعة في الذاكرة فتتكرر الأرقام.
+        """
+        from .database_router import get_current_db_alias
+        alias = get_current_db_alias()
+        if block_size <= 1 or connections[alias].in_atomic_block:
+            return cls.reserve(prefix, period, company_id, 1, seed)
+        
+        key = (alias, company_id, prefix)
+        with cls._blocks_lock:
+            block = cls._blocks.get(key)
+            if block and block[0] == period and block[1] <= block[2]:
+                value = block[1]
+                block[1] += 1
+                return value
+        
+        first = cls.reserve(prefix, period, company_id, block_size, seed)
+        with cls._blocks_lock:
+            cls._blocks[key] = [period, first + 1, first + block_size - 1]
+        return first
+
+def _document_sequence_scope(instance, field_name, code):
+    """البادئة والفترة والشركة ودالة البداية لعداد المستند"""
+    import datetime
+    
+    model = type(instance)
+    period = datetime.date.today().strftime('%Y%m%d')
+    full_prefix = f"{code}-{period}"
+    
+    company_id = None
+    if not model._meta.get_field(field_name).unique:
+        company_id = getattr(instance, 'company_id', None)
+        if not company_id:
+            current_company = getattr(threading.current_thread(), 'current_company', None)
+            company_id = current_company.id if current_company else None
+    
+    def seed():
+        existing = model._base_manager.filter(**{f'{field_name}__startswith': full_prefix})
+        if company_id:
+            existing = existing.filter(company_id=company_id)
+        last_number = existing.order_by('-id').values_list(field_name, flat=True).first()
+        try:
+            return int(last_number.split('-')[-1]) if last_number else 0
+        except ValueError:
+            return 0
+    
+    return full_prefix, period, company_id, seed
+
+def next_document_number(instance, field_name, code, width=4):
+    """
+    توليد رقم مستند بالشكل CODE-YYYYMMDD-NNNN من DocumentSequence
+
+    إذا كان الحقل فريداً على مستوى الجدول يكون العداد مشتركاً بين الشركات
+    حتى لا تتعارض الأرقام، وإلا يكون لكل شركة عداد مستقل.
+    """
+    from django.conf import settings
+    
+    full_prefix, period, company_id, seed = _document_sequence_scope(instance, field_name, code)
+    block_size = getattr(settings, 'DOCUMENT_SEQUENCE_BLOCK_SIZES', {}).get(code, 1)
+    value = DocumentSequence.allocate(code, period, company_id, block_size, seed)
+    return f"{full_prefix}-{value:0{width}d}"
+
+def reserve_document_numbers(instance, field_name, code, count, width=4):
+    """حجز count رقم متتالي بعملية UPDATE واحدة (لعمليات bulk_create)"""
+    if count <= 0:
+        return []
+    full_prefix, period, company_id, seed = _document_sequence_scope(instance, field_name, code)
+    first = DocumentSequence.reserve(code, period, company_id, count, seed)
+    return [f"{full_prefix}-{value:0{width}d}" for value in range(first, first + count)]
+
 # إضافة دالة توليد رقم الفاتورة
 def save(self, *args, **kwargs):
     if not self.invoice_number:
@@ -1820,16 +1667,7 @@ def save(self, *args, **kwargs):
     super(Sale, self).save(*args, **kwargs)
 
 def generate_invoice_number(self):
-    import datetime
-    today = datetime.date.today()
-    prefix = f"INV-{today.year}{today.month:02d}{today.day:02d}"
-    last_invoice = Sale.objects.filter(invoice_number__startswith=prefix).order_by('-id').first()
-    if last_invoice:
-        last_number = int(last_invoice.invoice_number.split('-')[-1])
-        new_number = last_number + 1
-    else:
-        new_number = 1
-    return f"{prefix}-{new_number:04d}"
+    return next_document_number(self, 'invoice_number', 'INV')
 
 Sale.save = save
 Sale.generate_invoice_number = generate_invoice_number
@@ -1844,43 +1682,27 @@ def save_purchase(self, *args, **kwargs):
     super(Purchase, self).save(*args, **kwargs)
 
 def generate_purchase_number(self):
-    import datetime
-    today = datetime.date.today()
-    prefix = f"PUR-{today.year}{today.month:02d}{today.day:02d}"
-    last_invoice = Purchase.objects.filter(invoice_number__startswith=prefix).order_by('-id').first()
-    if last_invoice:
-        last_number = int(last_invoice.invoice_number.split('-')[-1])
-        new_number = last_number + 1
-    else:
-        new_number = 1
-    return f"{prefix}-{new_number:04d}"
+    return next_document_number(self, 'invoice_number', 'PUR')
 
 Purchase.save = save_purchase
 Purchase.generate_purchase_number = generate_purchase_number
 
 # دوال تحديث الأرصدة
 def update_customer_balance(customer):
-    """تحديث رصيد العميل في دفتر الأستاذ"""
+    """مطابقة رصيد العميل في دفتر الأستاذ مع القيود المرحلة"""
     try:
+        from .account_ledger import AccountBalanceLedger
         account = get_or_create_customer_account(customer)
-        # حساب الرصيد من القيود
-        from django.db.models import Sum
-        debit_sum = JournalEntryLine.objects.filter(account=account).aggregate(Sum('debit'))['debit__sum'] or 0
-        credit_sum = JournalEntryLine.objects.filter(account=account).aggregate(Sum('credit'))['credit__sum'] or 0
-        account.balance = debit_sum - credit_sum
-        account.save()
+        AccountBalanceLedger.rebuild(account_ids=[account.id])
     except:
         pass
 
 def update_supplier_balance(supplier):
-    """تحديث رصيد المورد في دفتر الأستاذ"""
+    """مطابقة رصيد المورد في دفتر الأستاذ مع القيود المرحلة"""
     try:
+        from .account_ledger import AccountBalanceLedger
         account = get_or_create_supplier_account(supplier)
-        from django.db.models import Sum
-        debit_sum = JournalEntryLine.objects.filter(account=account).aggregate(Sum('debit'))['debit__sum'] or 0
-        credit_sum = JournalEntryLine.objects.filter(account=account).aggregate(Sum('credit'))['credit__sum'] or 0
-        account.balance = credit_sum - debit_sum
-        account.save()
+        AccountBalanceLedger.rebuild(account_ids=[account.id])
     except:
         pass
 
@@ -1891,16 +1713,7 @@ def save_pos_sale(self, *args, **kwargs):
     super(POSSale, self).save(*args, **kwargs)
 
 def generate_receipt_number(self):
-    import datetime
-    today = datetime.date.today()
-    prefix = f"REC-{today.year}{today.month:02d}{today.day:02d}"
-    last_receipt = POSSale.objects.filter(receipt_number__startswith=prefix).order_by('-id').first()
-    if last_receipt:
-        last_number = int(last_receipt.receipt_number.split('-')[-1])
-        new_number = last_number + 1
-    else:
-        new_number = 1
-    return f"{prefix}-{new_number:04d}"
+    return next_document_number(self, 'receipt_number', 'REC')
 
 POSSale.save = save_pos_sale
 POSSale.generate_receipt_number = generate_receipt_number
@@ -1912,16 +1725,7 @@ def save_manufacturing(self, *args, **kwargs):
     super(ManufacturingOrder, self).save(*args, **kwargs)
 
 def generate_order_number(self):
-    import datetime
-    today = datetime.date.today()
-    prefix = f"MFG-{today.year}{today.month:02d}{today.day:02d}"
-    last_order = ManufacturingOrder.objects.filter(order_number__startswith=prefix).order_by('-id').first()
-    if last_order:
-        last_number = int(last_order.order_number.split('-')[-1])
-        new_number = last_number + 1
-    else:
-        new_number = 1
-    return f"{prefix}-{new_number:04d}"
+    return next_document_number(self, 'order_number', 'MFG')
 
 ManufacturingOrder.save = save_manufacturing
 ManufacturingOrder.generate_order_number = generate_order_number
@@ -1998,6 +1802,14 @@ class JournalEntry(CompanyFilterMixin, models.Model):
         verbose_name = 'قيد يومية'
         verbose_name_plural = 'القيود اليومية'
         ordering = ['-created_at']
+        constraints = [
+            # قيد واحد فقط لكل حدث (core.posting)
+            models.UniqueConstraint(
+                fields=['reference_type', 'reference_id'],
+                condition=models.Q(reference_type__isnull=False, reference_id__isnull=False),
+                name='unique_journal_entry_reference'
+            ),
+        ]
     
     def __str__(self):
         return f"قيد #{self.entry_number} - {self.description}"
@@ -2008,16 +1820,7 @@ class JournalEntry(CompanyFilterMixin, models.Model):
         super().save(*args, **kwargs)
     
     def generate_entry_number(self):
-        import datetime
-        today = datetime.date.today()
-        prefix = f"JE-{today.year}{today.month:02d}{today.day:02d}"
-        last_entry = JournalEntry.objects.filter(entry_number__startswith=prefix).order_by('-id').first()
-        if last_entry:
-            last_number = int(last_entry.entry_number.split('-')[-1])
-            new_number = last_number + 1
-        else:
-            new_number = 1
-        return f"{prefix}-{new_number:04d}"
+        return next_document_number(self, 'entry_number', 'JE')
 
 class JournalEntryLine(CompanyFilterMixin, models.Model):
     company = models.ForeignKey(Company, on_delete=models.CASCADE, verbose_name='الشركة', db_index=True)
@@ -2072,16 +1875,7 @@ class CustomerPayment(CompanyFilterMixin, models.Model):
         super().save(*args, **kwargs)
     
     def generate_payment_number(self):
-        import datetime
-        today = datetime.date.today()
-        prefix = f"PAY-{today.year}{today.month:02d}{today.day:02d}"
-        last_payment = CustomerPayment.objects.filter(payment_number__startswith=prefix).order_by('-id').first()
-        if last_payment:
-            last_number = int(last_payment.payment_number.split('-')[-1])
-            new_number = last_number + 1
-        else:
-            new_number = 1
-        return f"{prefix}-{new_number:04d}"
+        return next_document_number(self, 'payment_number', 'PAY')
 
 class SupplierPayment(CompanyFilterMixin, models.Model):
     company = models.ForeignKey(Company, on_delete=models.CASCADE, verbose_name='الشركة', db_index=True)
@@ -2118,13 +1912,144 @@ class SupplierPayment(CompanyFilterMixin, models.Model):
         super().save(*args, **kwargs)
     
     def generate_payment_number(self):
-        import datetime
-        today = datetime.date.today()
-        prefix = f"SPY-{today.year}{today.month:02d}{today.day:02d}"
-        last_payment = SupplierPayment.objects.filter(payment_number__startswith=prefix).order_by('-id').first()
-        if last_payment:
-            last_number = int(last_payment.payment_number.split('-')[-1])
-            new_number = last_number + 1
-        else:
-            new_number = 1
-        return f"{prefix}-{new_number:04d}"
+        return next_document_number(self, 'payment_number', 'SPY')
+
+# طابور المهام الخلفية (core.job_queue)
+class BackgroundJob(models.Model):
+    """
+    مهمة مؤجلة في قاعدة بيانات الشركة
+
+    يتم إنشاؤها بعد نجاح معاملة الطلب (transaction.on_commit) وتنفيذها بأمر
+    run_workers بترتيب الإضافة لكل شركة، مع إعادة المحاولة عند الفشل.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'في الانتظار'),
+        ('running', 'قيد التنفيذ'),
+        ('done', 'تم'),
+        ('failed', 'فشل'),
+    ]
+    
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, null=True, blank=True, verbose_name='الشركة')
+    task = models.CharField(max_length=200, verbose_name='المهمة')
+    kwargs = models.JSONField(default=dict, blank=True, verbose_name='المعاملات')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', verbose_name='الحالة')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='عدد المحاولات')
+    max_attempts = models.PositiveIntegerField(default=5, verbose_name='الحد الأقصى للمحاولات')
+    run_after = models.DateTimeField(default=timezone.now, verbose_name='التنفيذ بعد')
+    locked_by = models.CharField(max_length=100, blank=True, verbose_name='العامل')
+    locked_at = models.DateTimeField(null=True, blank=True, verbose_name='وقت البدء')
+    last_error = models.TextField(blank=True, verbose_name='آخر خطأ')
+    created_at = models.DateTimeField(default=timezone.now, verbose_name='تاريخ الإنشاء')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='تاريخ الانتهاء')
+    
+    class Meta:
+        verbose_name = 'مهمة خلفية'
+        verbose_name_plural = 'المهام الخلفية'
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'id'], name='core_job_status_id_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.task} #{self.id} ({self.get_status_display()})"
+
+class AccountPeriodBalance(models.Model):
+    """
+    حركة الحساب الشهرية المرحلة
+
+    opening صافي (مدين - دائن) الحساب قبل بداية الشهر، و debit/credit مجموع
+    أسطر القيود المرحلة خلال الشهر. يتم تحديثها مع الترحيل (core.period_balances)
+    فتقارير أي تاريخ سابق تقرأ صفاً لكل حساب وشهر بدلاً من جميع أسطر القيود.
+    """
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='period_balances', verbose_name='الحساب')
+    year = models.PositiveSmallIntegerField(verbose_name='السنة')
+    month = models.PositiveSmallIntegerField(verbose_name='الشهر')
+    opening = models.DecimalField(max_digits=15, decimal_places=2, default=0, verbose_name='الرصيد الافتتاحي')
+    debit = models.DecimalField(max_digits=15, decimal_places=2, default=0, verbose_name='مدين')
+    credit = models.DecimalField(max_digits=15, decimal_places=2, default=0, verbose_name='دائن')
+    
+    class Meta:
+        verbose_name = 'رصيد حساب شهري'
+        verbose_name_plural = 'أرصدة الحسابات الشهرية'
+        ordering = ['account', 'year', 'month']
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'year', 'month'], name='unique_account_period_balance'),
+        ]
+    
+    def __str__(self):
+        return f"{self.account} - {self.month}/{self.year}"
+
+class POSCatalogItem(models.Model):
+    """
+    كتالوج نقطة البيع: صف لكل منتج في كل مخزن
+
+    نسخة مجمعة من المنتج وسعره الفعلي ومخزونه في المخزن يتم تحديثها مع حفظ
+    المنتج أو السعر أو المخزون (core.pos_catalog)، فالبحث وتفاصيل المنتج وقائمة
+    منتجات شاشة البيع تقرأ جدولاً واحداً مفهرساً بمخزن الجلسة.
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, verbose_name='الشركة', db_index=True)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='catalog_items', verbose_name='المنتج')
+    warehouse = models.ForeignKey(Warehouse, on_delete=models.CASCADE, related_name='catalog_items', verbose_name='المخزن')
+    name = models.CharField(max_length=200, verbose_name='اسم المنتج')
+    barcode = models.CharField(max_length=50, blank=True, verbose_name='الباركود')
+    category = models.CharField(max_length=50, blank=True, verbose_name='الفئة')
+    unit = models.CharField(max_length=20, blank=True, verbose_name='الوحدة')
+    brand = models.CharField(max_length=100, blank=True, verbose_name='الماركة')
+    description = models.TextField(blank=True, verbose_name='الوصف')
+    image = models.CharField(max_length=255, blank=True, verbose_name='الصورة')
+    price = models.DecimalField(max_digits=10, decimal_places=2, default=0, verbose_name='سعر البيع')
+    cost_price = models.DecimalField(max_digits=10, decimal_places=2, default=0, verbose_name='سعر التكلفة')
+    stock = models.DecimalField(max_digits=10, decimal_places=3, default=0, verbose_name='المخزون')
+    is_active = models.BooleanField(default=True, verbose_name='نشط')
+    version = models.BigIntegerField(default=0, verbose_name='رقم التغيير')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='تاريخ التحديث')
+    
+    class Meta:
+        verbose_name = 'منتج في كتالوج نقطة البيع'
+        verbose_name_plural = 'كتالوج نقطة البيع'
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'warehouse'], name='unique_pos_catalog_product_warehouse'),
+        ]
+        indexes = [
+            models.Index(fields=['warehouse', 'is_active', 'name'], name='core_poscat_wh_name_idx'),
+            models.Index(fields=['warehouse', 'barcode'], name='core_poscat_wh_barcode_idx'),
+            models.Index(fields=['warehouse', 'version'], name='core_poscat_wh_version_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.name} - {self.warehouse_id}: {self.stock}"
+
+class ChangeCounter(models.Model):
+    """
+    عداد تغييرات متزايد في قاعدة بيانات الشركة
+
+    يزيد بعملية UPDATE داخل معاملة التعديل، فكل تعديل يأخذ رقماً أكبر من كل
+    التعديلات التي تم حفظها قبله (مزامنة كتالوج نقطة البيع بـ ?since=).
+    """
+    name = models.CharField(max_length=50, unique=True, verbose_name='الاسم')
+    value = models.BigIntegerField(default=0, verbose_name='القيمة')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='تاريخ التحديث')
+    
+    class Meta:
+        verbose_name = 'عداد تغييرات'
+        verbose_name_plural = 'عدادات التغييرات'
+    
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+class POSCatalogTombstone(models.Model):
+    """منتج محذوف من كتالوج نقطة البيع (لإبلاغ نقاط البيع في المزامنة التالية)"""
+    product_id = models.IntegerField(verbose_name='رقم المنتج')
+    warehouse_id = models.IntegerField(verbose_name='رقم المخزن')
+    version = models.BigIntegerField(verbose_name='رقم التغيير')
+    deleted_at = models.DateTimeField(default=timezone.now, verbose_name='تاريخ الحذف')
+    
+    class Meta:
+        verbose_name = 'منتج محذوف من الكتالوج'
+        verbose_name_plural = 'منتجات محذوفة من الكتالوج'
+        indexes = [
+            models.Index(fields=['warehouse_id', 'version'], name='core_poscat_tomb_wh_ver_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.product_id} - {self.warehouse_id} (v{self.version})"
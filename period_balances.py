@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""
+أرصدة الحسابات الشهرية
+
+AccountPeriodBalance يحفظ لكل (حساب، سنة، شهر) صافي الحساب قبل بداية الشهر
+(opening) ومجموع المدين والدائن المرحل خلال الشهر. يتم تحديثه من دفتر الأرصدة
+(account_ledger) مع كل ترحيل، وتاريخ الحركة هو تاريخ إنشاء القيد.
+
+- ترحيل في الشهر الحالي: UPDATE على صف الشهر (وإنشاؤه أول مرة)
+- ترحيل بتاريخ سابق: نفس الشيء مع زيادة opening للأشهر التالية بعملية UPDATE واحدة
+
+تقارير أي تاريخ سابق (ميزان المراجعة، قائمة الدخل، الميزانية) تقرأ صف الحساب
+للأشهر الكاملة، وأسطر القيود فقط لجزء الشهر في بداية أو نهاية الفترة، بدلاً من
+جميع أسطر القيود.
+
+المطابقة الكاملة تتم بأمر: python manage.py rebuild_period_balances
+"""
+import calendar
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
+from django.db.models import Case, When, Value, F, Q, Sum, Subquery, OuterRef, DecimalField
+from django.db.models.functions import ExtractYear, ExtractMonth
+from django.utils import timezone
+
+from .database_router import get_current_db_alias
+
+PERIOD_FIELDS = ['opening', 'debit', 'credit']
+
+_ZERO = Decimal('0')
+_CENTS = Decimal('0.01')
+
+
+def _balance_field():
+    return DecimalField(max_digits=15, decimal_places=2)
+
+
+def period_of(moment):
+    """(السنة، الشهر) لتاريخ أو وقت (بالمنطقة الزمنية المحلية)"""
+    if isinstance(moment, datetime):
+        if timezone.is_aware(moment):
+            moment = timezone.localtime(moment)
+        moment = moment.date()
+    return moment.year, moment.month
+
+
+def _month_end(day):
+    return day.replace(day=calendar.monthrange(day.year, day.month)[1])
+
+
+def _day_start(day):
+    """بداية اليوم كوقت (aware إذا كانت المناطق الزمنية مفعلة)"""
+    moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment) and timezone.is_aware(timezone.now()):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def _before(year, month):
+    return Q(year__lt=year) | Q(year=year, month__lt=month)
+
+
+def _after(year, month):
+    return Q(year__gt=year) | Q(year=year, month__gt=month)
+
+
+class AccountPeriodLedger:
+    """تحديث وقراءة أرصدة الحسابات الشهرية"""
+
+    @staticmethod
+    def _case(chunk, index):
+        return Case(
+            *[When(account_id=row[0], then=Value(row[index], output_field=_balance_field())) for row in chunk],
+            default=Value(_ZERO),
+            output_field=_balance_field()
+        )
+
+    @staticmethod
+    def _carried(account_ids, year, month, using):
+        """صافي كل حساب قبل الشهر من آخر صف سابق (لإنشاء صف شهر جديد)"""
+        from .models import AccountPeriodBalance
+
+        carried = {}
+        rows = (
+            AccountPeriodBalance.objects.using(using)
+            .filter(account_id__in=account_ids).filter(_before(year, month))
+            .order_by('account_id', '-year', '-month')
+            .values_list('account_id', 'opening', 'debit', 'credit')
+        )
+        for account_id, opening, debit, credit in rows:
+            if account_id not in carried:
+                carried[account_id] = opening + debit - credit
+        return carried
+
+    @classmethod
+    def apply_totals(cls, totals, moment=None, sign=1, using=None, batch_size=500):
+        """
+        تطبيق مجاميع {account_id: (debit, credit)} على شهر moment
+
+        ثلاث عمليات لكل batch_size حساب: إنشاء صفوف الشهر الناقصة، UPDATE
+        للمدين والدائن، وUPDATE لـ opening في الأشهر التالية (للترحيل بتاريخ سابق).
+        """
+        from .models import AccountPeriodBalance
+
+        db = using or get_current_db_alias()
+        year, month = period_of(moment or timezone.now())
+        deltas = []
+        for account_id, (debit, credit) in totals.items():
+            debit = sign * Decimal(debit or 0)
+            credit = sign * Decimal(credit or 0)
+            if debit or credit:
+                deltas.append((account_id, debit, credit, debit - credit))
+
+        rows = AccountPeriodBalance.objects.using(db)
+        for start in range(0, len(deltas), batch_size):
+            chunk = deltas[start:start + batch_size]
+            account_ids = [row[0] for row in chunk]
+            current = rows.filter(account_id__in=account_ids, year=year, month=month)
+
+            existing = set(current.values_list('account_id', flat=True))
+            missing = [account_id for account_id in account_ids if account_id not in existing]
+            if missing:
+                carried = cls._carried(missing, year, month, db)
+                rows.bulk_create([
+                    AccountPeriodBalance(account_id=account_id, year=year, month=month,
+                                         opening=carried.get(account_id, _ZERO))
+                    for account_id in missing
+                ], ignore_conflicts=True)
+
+            current.update(
+                debit=F('debit') + cls._case(chunk, 1),
+                credit=F('credit') + cls._case(chunk, 2)
+            )
+            moved = [row for row in chunk if row[3]]
+            if moved:
+                rows.filter(account_id__in=[row[0] for row in moved]).filter(_after(year, month)).update(
+                    opening=F('opening') + cls._case(moved, 3)
+                )
+
+    @staticmethod
+    def _line_totals(date_from, date_to, account_ids, using):
+        """مجموع أسطر القيود المرحلة بين يومين (لجزء شهر فقط)"""
+        from .models import JournalEntryLine
+
+        lines = JournalEntryLine._base_manager.using(using).filter(
+            journal_entry__is_posted=True,
+            journal_entry__created_at__gte=_day_start(date_from),
+            journal_entry__created_at__lt=_day_start(date_to + timedelta(days=1)),
+        )
+        if account_ids is not None:
+            lines = lines.filter(account_id__in=account_ids)
+        return {
+            row['account']: (row['debit_sum'] or _ZERO, row['credit_sum'] or _ZERO)
+            for row in lines.values('account').annotate(debit_sum=Sum('debit'), credit_sum=Sum('credit')).order_by()
+        }
+
+    @classmethod
+    def net_as_of(cls, day, account_ids=None, using=None):
+        """
+        صافي (مدين - دائن) كل حساب حتى نهاية يوم day
+
+        صف واحد لكل حساب (آخر شهر سابق) باستعلام فرعي على الفهرس، وأسطر
+        القيود من بداية الشهر حتى day إذا لم يكن نهاية الشهر.
+        """
+        from .models import Account, AccountPeriodBalance
+
+        db = using or get_current_db_alias()
+        full_month = day == _month_end(day)
+        if full_month:
+            period = Q(year__lt=day.year) | Q(year=day.year, month__lte=day.month)
+        else:
+            period = _before(day.year, day.month)
+        latest = (
+            AccountPeriodBalance.objects.using(db)
+            .filter(account=OuterRef('pk')).filter(period)
+            .order_by('-year', '-month')
+            .annotate(closing=F('opening') + F('debit') - F('credit'))
+            .values('closing')[:1]
+        )
+        accounts = Account.objects.using(db)
+        if account_ids is not None:
+            accounts = accounts.filter(pk__in=account_ids)
+        net = {
+            account_id: closing or _ZERO
+            for account_id, closing in accounts.annotate(
+                closing=Subquery(latest, output_field=_balance_field())
+            ).values_list('id', 'closing')
+        }
+
+        if not full_month:
+            for account_id, (debit, credit) in cls._line_totals(day.replace(day=1), day, account_ids, db).items():
+                net[account_id] = net.get(account_id, _ZERO) + debit - credit
+        return net
+
+    @classmethod
+    def period_totals(cls, date_from, date_to, account_ids=None, using=None):
+        """
+        مجموع المدين والدائن لكل حساب بين date_from و date_to (None = من البداية)
+
+        الأشهر الكاملة من AccountPeriodBalance، وجزء الشهر في الطرفين من أسطر القيود.
+        """
+        from .models import AccountPeriodBalance
+
+        db = using or get_current_db_alias()
+        totals = {}
+
+        def add(rows):
+            for account_id, (debit, credit) in rows.items():
+                account_debit, account_credit = totals.get(account_id, (_ZERO, _ZERO))
+                totals[account_id] = (account_debit + debit, account_credit + credit)
+
+        if date_from is None or date_from.day == 1:
+            full_start = date_from
+        else:
+            full_start = _month_end(date_from) + timedelta(days=1)
+        full_end = date_to if date_to == _month_end(date_to) else date_to.replace(day=1) - timedelta(days=1)
+
+        if full_start is not None and full_start > full_end:
+            # الفترة داخل شهر واحد غير كامل
+            add(cls._line_totals(date_from, date_to, account_ids, db))
+            return totals
+
+        rows = AccountPeriodBalance.objects.using(db).annotate(period_index=F('year') * 12 + F('month'))
+        rows = rows.filter(period_index__lte=full_end.year * 12 + full_end.month)
+        if full_start is not None:
+            rows = rows.filter(period_index__gte=full_start.year * 12 + full_start.month)
+        if account_ids is not None:
+            rows = rows.filter(account_id__in=account_ids)
+        add({
+            row['account']: (row['debit_sum'] or _ZERO, row['credit_sum'] or _ZERO)
+            for row in rows.values('account').annotate(debit_sum=Sum('debit'), credit_sum=Sum('credit')).order_by()
+        })
+
+        if full_start is not None and date_from < full_start:
+            add(cls._line_totals(date_from, full_start - timedelta(days=1), account_ids, db))
+        if date_to > full_end:
+            add(cls._line_totals(full_end + timedelta(days=1), date_to, account_ids, db))
+        return totals
+
+    @classmethod
+    def account_balances(cls, date_from=None, date_to=None, account_ids=None, using=None):
+        """
+        أرصدة الحسابات لفترة بحسب طبيعة كل حساب
+
+        يرجع {account_id: {'opening', 'debit', 'credit', 'closing'}} حيث opening
+        الرصيد قبل date_from (أو الرصيد الافتتاحي للحساب) و closing الرصيد في
+        نهاية date_to (اليوم إذا لم يحدد).
+        """
+        from .account_ledger import AccountBalanceLedger
+        from .models import Account
+
+        db = using or get_current_db_alias()
+        date_to = date_to or date.today()
+        closing_net = cls.net_as_of(date_to, account_ids, db)
+        opening_net = cls.net_as_of(date_from - timedelta(days=1), account_ids, db) if date_from else {}
+        totals = cls.period_totals(date_from, date_to, account_ids, db)
+
+        accounts = Account.objects.using(db)
+        if account_ids is not None:
+            accounts = accounts.filter(pk__in=account_ids)
+        balances = OrderedDict()
+        for account_id, account_type, opening_balance in accounts.order_by('account_code').values_list(
+            'id', 'account_type', 'opening_balance'
+        ):
+            opening_balance = opening_balance or _ZERO
+            debit, credit = totals.get(account_id, (_ZERO, _ZERO))
+            balances[account_id] = {
+                'opening': opening_balance + AccountBalanceLedger.signed_balance(
+                    account_type, opening_net.get(account_id, _ZERO), _ZERO),
+                'debit': debit,
+                'credit': credit,
+                'closing': opening_balance + AccountBalanceLedger.signed_balance(
+                    account_type, closing_net.get(account_id, _ZERO), _ZERO),
+            }
+        return balances
+
+    @staticmethod
+    def compute(account_ids=None, using=None):
+        """الصفوف الصحيحة {(account_id, year, month): (opening, debit, credit)} من القيود المرحلة"""
+        from .models import JournalEntryLine
+
+        db = using or get_current_db_alias()
+        lines = JournalEntryLine._base_manager.using(db).filter(journal_entry__is_posted=True)
+        if account_ids is not None:
+            lines = lines.filter(account_id__in=account_ids)
+        rows = (
+            lines.annotate(
+                period_year=ExtractYear('journal_entry__created_at'),
+                period_month=ExtractMonth('journal_entry__created_at'),
+            )
+            .values('account', 'period_year', 'period_month')
+            .annotate(debit_sum=Sum('debit'), credit_sum=Sum('credit'))
+            .order_by('account', 'period_year', 'period_month')
+        )
+
+        expected = {}
+        carried = {}
+        for row in rows:
+            account_id = row['account']
+            debit = Decimal(row['debit_sum'] or 0).quantize(_CENTS)
+            credit = Decimal(row['credit_sum'] or 0).quantize(_CENTS)
+            opening = carried.get(account_id, _ZERO)
+            expected[(account_id, row['period_year'], row['period_month'])] = (opening, debit, credit)
+            carried[account_id] = opening + debit - credit
+        return expected
+
+    @classmethod
+    def rebuild(cls, account_ids=None, using=None, batch_size=500, dry_run=False):
+        """
+        مطابقة الأرصدة الشهرية مع القيود المرحلة
+
+        يتم إنشاء الصفوف الناقصة وتعديل المختلفة وحذف الزائدة، ويرجع تقرير
+        الانحراف: قائمة بالصفوف التي كانت مختلفة.
+        """
+        from .models import AccountPeriodBalance
+
+        db = using or get_current_db_alias()
+        expected = cls.compute(account_ids, using=db)
+        rows = AccountPeriodBalance.objects.using(db)
+        if account_ids is not None:
+            rows = rows.filter(account_id__in=account_ids)
+
+        drift = []
+        changed = []
+        extra = []
+        seen = set()
+        for row in rows.iterator():
+            key = (row.account_id, row.year, row.month)
+            seen.add(key)
+            stored = (row.opening, row.debit, row.credit)
+            correct = expected.get(key)
+            if correct is None:
+                if any(stored):
+                    drift.append({'key': key, 'stored': stored, 'expected': None})
+                extra.append(row.pk)
+            elif stored != correct:
+                drift.append({'key': key, 'stored': stored, 'expected': correct})
+                row.opening, row.debit, row.credit = correct
+                changed.append(row)
+
+        missing = [
+            AccountPeriodBalance(account_id=key[0], year=key[1], month=key[2],
+                                 opening=values[0], debit=values[1], credit=values[2])
+            for key, values in expected.items() if key not in seen
+        ]
+        drift.extend({'key': (row.account_id, row.year, row.month), 'stored': None,
+                      'expected': (row.opening, row.debit, row.credit)} for row in missing)
+
+        if not dry_run:
+            for start in range(0, len(changed), batch_size):
+                AccountPeriodBalance.objects.using(db).bulk_update(changed[start:start + batch_size], PERIOD_FIELDS)
+            AccountPeriodBalance.objects.using(db).bulk_create(missing, batch_size=batch_size)
+            for start in range(0, len(extra), batch_size):
+                AccountPeriodBalance.objects.using(db).filter(pk__in=extra[start:start + batch_size]).delete()
+        return drift
+
+
+def report_period(params):
+    """
+    فترة التقرير من معاملات الطلب: date_from/date_to (أو start_date/end_date)، أو as_of
+
+    يرجع (None, None) إذا لم تحدد فترة، ليعرض التقرير الأرصدة الحالية مباشرة.
+    """
+    def parse(*names):
+        for name in names:
+            value = params.get(name)
+            if value:
+                try:
+                    return datetime.strptime(value, '%Y-%m-%d').date()
+                except ValueError:
+                    return None
+        return None
+
+    date_from = parse('date_from', 'start_date')
+    date_to = parse('date_to', 'end_date', 'as_of')
+    if date_from and date_to and date_from > date_to:
+        date_from, date_to = date_to, date_from
+    return date_from, date_to
+
+
+def period_account_balances(params, using=None):
+    """
+    (date_from, date_to, balances) لتقارير الحسابات
+
+    balances تساوي None إذا لم تحدد فترة في الطلب (يستخدم Account.balance).
+    """
+    date_from, date_to = report_period(params)
+    if date_from is None and date_to is None:
+        return None, None, None
+    return date_from, date_to, AccountPeriodLedger.account_balances(date_from, date_to, using=using)
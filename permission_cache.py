@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+الصلاحيات المجمعة لكل (مستخدم، شركة)
+
+يتم تحميل صلاحيات المستخدم مرة واحدة وتحويلها إلى قناع بتات لكل شاشة
+(عرض/إضافة/تعديل/...) مع مجموعات ثابتة بأرقام الفروع والمخازن المسموحة، فيصبح
+فحص الصلاحية عملية في الذاكرة بدون أي استعلام.
+
+الكائن محفوظ في LRU داخل العملية وفي cache الخاص بـ Django بمفتاح يحتوي على
+إصدار صلاحيات المستخدم، ويتم زيادة الإصدار عند أي تعديل على Permission أو
+الفروع/المخازن المسموحة أو ملف المستخدم. كل طلب يحصل على الكائن مرة واحدة
+عن طريق get_request_permissions(request).
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .database_router import get_current_db_alias
+from .versioned_cache import LRUCache, get_versions, bump_version
+
+ACTIONS = ('view', 'add', 'edit', 'delete', 'confirm', 'print', 'export')
+ACTION_BITS = {action: 1 << index for index, action in enumerate(ACTIONS)}
+ALL_ACTIONS_MASK = (1 << len(ACTIONS)) - 1
+
+CACHE_TIMEOUT = 3600
+
+_local = LRUCache(
+    maxsize=getattr(settings, 'PERMISSIONS_LOCAL_CACHE_SIZE', 4096),
+    ttl=getattr(settings, 'PERMISSIONS_LOCAL_CACHE_TTL', 300)
+)
+
+
+def permissions_version_key(alias, user_id):
+    return f"perm_version:{alias}:{user_id}"
+
+
+def invalidate_user_permissions(user_id, alias=None):
+    """إبطال الصلاحيات المجمعة للمستخدم في جميع العمليات"""
+    bump_version(permissions_version_key(alias or get_current_db_alias(), user_id))
+
+
+class CompiledPermissions:
+    """
+    صلاحيات مستخدم في شركة
+
+    masks: الشاشة -> قناع البتات للعمليات المسموحة
+    branches/warehouses: الشاشة -> frozenset بالأرقام المسموحة (غير موجود = بدون قيود)
+    profile_company_id/profile_active: ملف المستخدم (None إذا لم يوجد)
+    """
+
+    __slots__ = ('user_id', 'company_id', 'is_superuser', 'is_active',
+                 'masks', 'branches', 'warehouses', 'profile_company_id', 'profile_active')
+
+    def __init__(self, user_id, company_id, is_superuser, is_active, masks, branches, warehouses,
+                 profile_company_id=None, profile_active=False):
+        self.user_id = user_id
+        self.company_id = company_id
+        self.is_superuser = is_superuser
+        self.is_active = is_active
+        self.masks = masks
+        self.branches = branches
+        self.warehouses = warehouses
+        self.profile_company_id = profile_company_id
+        self.profile_active = profile_active
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def has_profile(self):
+        return self.profile_company_id is not None
+
+    def has_screen(self, screen):
+        """هل يوجد سجل صلاحية للشاشة"""
+        return screen in self.masks
+
+    def allows(self, screen, action='view', branch_id=None, warehouse_id=None):
+        """
+        فحص الصلاحية في الذاكرة
+
+        يرجع None إذا لم يوجد سجل صلاحية للشاشة ليقرر المستدعي القيمة الافتراضية.
+        """
+        if not self.is_active:
+            return False
+        if self.is_superuser:
+            return True
+
+        mask = self.masks.get(screen)
+        if mask is None:
+            return None
+        if not mask & ACTION_BITS.get(action, 0):
+            return False
+
+        allowed_branches = self.branches.get(screen)
+        if branch_id and allowed_branches and branch_id not in allowed_branches:
+            return False
+        allowed_warehouses = self.warehouses.get(screen)
+        if warehouse_id and allowed_warehouses and warehouse_id not in allowed_warehouses:
+            return False
+        return True
+
+    def actions(self, screen):
+        """قائمة العمليات المسموحة للشاشة"""
+        mask = ALL_ACTIONS_MASK if self.is_superuser else self.masks.get(screen, 0)
+        return [action for action in ACTIONS if mask & ACTION_BITS[action]]
+
+    def as_dict(self):
+        """الشاشة -> قائمة العمليات (نفس شكل get_user_permissions)"""
+        return {screen: self.actions(screen) for screen in self.masks}
+
+    @classmethod
+    def compile(cls, user, company_id=None, alias=None):
+        """تحميل صلاحيات المستخدم من قاعدة البيانات (3 استعلامات كحد أقصى)"""
+        from .models import Permission, UserProfile
+
+        alias = alias or get_current_db_alias()
+
+        profile = (
+            UserProfile._base_manager.using(alias)
+            .filter(user_id=user.id)
+            .values('company_id', 'is_active')
+            .first()
+        )
+
+        masks = {}
+        branches = {}
+        warehouses = {}
+        permissions = Permission._base_manager.using(alias).filter(user_id=user.id)
+        if company_id:
+            permissions = permissions.filter(Q(company_id=company_id) | Q(company__isnull=True))
+        # الصلاحيات العامة أولاً ثم صلاحيات الشركة لتكون لها الأولوية
+        permissions = permissions.order_by('company_id' if company_id else 'id').prefetch_related(
+            'branch_access', 'warehouse_access'
+        )
+
+        for permission in permissions:
+            if permission.screen in masks and permission.company_id != company_id:
+                continue
+            mask = 0
+            for action in ACTIONS:
+                if getattr(permission, f'can_{action}', False):
+                    mask |= ACTION_BITS[action]
+            masks[permission.screen] = mask
+            branches.pop(permission.screen, None)
+            warehouses.pop(permission.screen, None)
+            branch_ids = frozenset(branch.id for branch in permission.branch_access.all())
+            warehouse_ids = frozenset(warehouse.id for warehouse in permission.warehouse_access.all())
+            if branch_ids:
+                branches[permission.screen] = branch_ids
+            if warehouse_ids:
+                warehouses[permission.screen] = warehouse_ids
+
+        return cls(
+            user_id=user.id,
+            company_id=company_id,
+            is_superuser=user.is_superuser,
+            is_active=user.is_active,
+            masks=masks,
+            branches=branches,
+            warehouses=warehouses,
+            profile_company_id=profile['company_id'] if profile else None,
+            profile_active=bool(profile and profile['is_active']),
+        )
+
+
+def get_compiled_permissions(user, company_id=None, alias=None):
+    """الصلاحيات المجمعة من الذاكرة أو الكاش أو قاعدة البيانات"""
+    alias = alias or get_current_db_alias()
+    version = get_versions([permissions_version_key(alias, user.id)])[0]
+    if version is None:
+        return CompiledPermissions.compile(user, company_id, alias)
+
+    # حالة المستخدم جزء من المفتاح حتى يطبق تعطيل الحساب أو ترقيته فوراً
+    key = f"perm:{alias}:{user.id}:{company_id or 'global'}:{int(user.is_superuser)}{int(user.is_active)}:v{version}"
+    compiled = _local.get(key)
+    if compiled is not None:
+        return compiled
+
+    compiled = cache.get(key)
+    if compiled is None:
+        compiled = CompiledPermissions.compile(user, company_id, alias)
+        cache.set(key, compiled, CACHE_TIMEOUT)
+    _local.set(key, compiled)
+    return compiled
+
+
+def _request_company_id(request):
+    company = getattr(request, 'company', None)
+    if company is not None:
+        return company.id
+    session = getattr(request, 'session', None)
+    return session.get('company_id') if session is not None else None
+
+
+def get_request_permissions(request):
+    """الصلاحيات المجمعة للطلب الحالي (يتم تحميلها مرة واحدة لكل طلب)"""
+    compiled = getattr(request, '_compiled_permissions', None)
+    if compiled is None:
+        compiled = get_compiled_permissions(request.user, _request_company_id(request))
+        request._compiled_permissions = compiled
+    return compiled
+
+
+@receiver(post_save, sender='core.Permission')
+@receiver(post_delete, sender='core.Permission')
+def permission_changed(sender, instance, **kwargs):
+    invalidate_user_permissions(instance.user_id, kwargs.get('using'))
+
+
+@receiver(m2m_changed, sender='core.Permission_branch_access')
+@receiver(m2m_changed, sender='core.Permission_warehouse_access')
+def permission_access_changed(sender, instance, action, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    using = kwargs.get('using')
+    if kwargs.get('reverse'):
+        # التعديل من جهة الفرع/المخزن: إبطال جميع المستخدمين المتأثرين
+        from .models import Permission
+        user_ids = Permission._base_manager.using(using).filter(pk__in=kwargs.get('pk_set') or []).values_list('user_id', flat=True)
+        for user_id in set(user_ids):
+            invalidate_user_permissions(user_id, using)
+    else:
+        invalidate_user_permissions(instance.user_id, using)
+
+
+@receiver(post_save, sender='core.UserProfile')
+@receiver(post_delete, sender='core.UserProfile')
+def user_profile_changed(sender, instance, **kwargs):
+    invalidate_user_permissions(instance.user_id, kwargs.get('using'))
@@ -4,11 +4,11 @@ from django.contrib.auth.models import User
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
-from django.db import transaction
 from django.contrib import messages
 from django.core.paginator import Paginator
 from django.db.models import Q, Count
 from django.utils import timezone
+from .database_router import company_atomic
 from .models import Permission, Company
 from .permissions_utils import check_user_permission, AVAILABLE_SCREENS, AVAILABLE_ACTIONS
 import json
@@ -193,7 +193,7 @@ def update_user_permissions(request):
         else:
             company = Company.objects.first()
         
-        with transaction.atomic():
+        with company_atomic():
             # Process each screen's permissions
             for screen, actions in permissions_data.items():
                 if screen not in AVAILABLE_SCREENS:
@@ -338,7 +338,7 @@ def apply_permission_template(request, user_id, template_name):
         
         template = templates[template_name]
         
-        with transaction.atomic():
+        with company_atomic():
             # Clear existing permissions
             Permission.objects.filter(user=user, company=company).delete()
             
@@ -5,7 +5,6 @@
 """
 
 from django.contrib.auth.models import User
-from django.db import models
 from django.core.cache import cache
 from django.utils import timezone
 from typing import Dict, List, Optional, Tuple
@@ -137,8 +136,10 @@ class PermissionSystem:
     @staticmethod
     def clear_user_permissions_cache(user_id: int, company_id: int = None):
         """مسح كاش صلاحيات المستخدم"""
+        from .permission_cache import invalidate_user_permissions
         cache_key = PermissionSystem.get_cache_key(user_id, company_id)
         cache.delete(cache_key)
+        invalidate_user_permissions(user_id)
         logger.info(f"Cleared permissions cache for user {user_id}, company {company_id}")
     
     @staticmethod
@@ -155,50 +156,17 @@ class PermissionSystem:
             }
         
         company_id = company.id if company else None
-        cache_key = PermissionSystem.get_cache_key(user.id, company_id)
-        
-        # محاولة جلب الصلاحيات من الكاش
-        if use_cache:
-            cached_permissions = cache.get(cache_key)
-            if cached_permissions is not None:
-                return cached_permissions
         
         try:
-            from .models import Permission
-            
-            # جلب صلاحيات المستخدم من قاعدة البيانات
-            permissions_query = Permission.objects.filter(user=user)
-            if company:
-                permissions_query = permissions_query.filter(
-                    models.Q(company=company) | models.Q(company__isnull=True)
-                )
-            
-            user_permissions = {}
-            for permission in permissions_query:
-                screen_permissions = []
-                
-                if permission.can_view:
-                    screen_permissions.append('view')
-                if permission.can_add:
-                    screen_permissions.append('add')
-                if permission.can_edit:
-                    screen_permissions.append('edit')
-                if permission.can_delete:
-                    screen_permissions.append('delete')
-                if permission.can_confirm:
-                    screen_permissions.append('confirm')
-                if permission.can_print:
-                    screen_permissions.append('print')
-                if permission.can_export:
-                    screen_permissions.append('export')
-                
-                user_permissions[permission.screen] = screen_permissions
+            from .permission_cache import get_compiled_permissions, CompiledPermissions
             
-            # حفظ في الكاش لمدة ساعة
+            # الصلاحيات المجمعة (محفوظة بإصدار يتغير مع أي تعديل على الصلاحيات)
             if use_cache:
-                cache.set(cache_key, user_permissions, 3600)
+                compiled = get_compiled_permissions(user, company_id)
+            else:
+                compiled = CompiledPermissions.compile(user, company_id)
             
-            return user_permissions
+            return compiled.as_dict()
             
         except Exception as e:
             logger.error(f"Error getting user permissions: {e}")
@@ -223,35 +191,16 @@ class PermissionSystem:
             return False
         
         try:
-            # جلب صلاحيات المستخدم
-            user_permissions = PermissionSystem.get_user_permissions(user, company)
-            
-            # فحص الصلاحية الأساسية
-            screen_permissions = user_permissions.get(screen, [])
-            if action not in screen_permissions:
-                return False
-            
-            # فحص صلاحيات الفرع والمخزن إذا كانت مطلوبة
-            if branch or warehouse:
-                from .models import Permission
-                
-                permission_obj = Permission.objects.filter(
-                    user=user, 
-                    screen=screen
-                ).first()
-                
-                if permission_obj:
-                    # فحص صلاحية الفرع
-                    if branch and permission_obj.branch_access.exists():
-                        if not permission_obj.branch_access.filter(id=branch.id).exists():
-                            return False
-                    
-                    # فحص صلاحية المخزن
-                    if warehouse and permission_obj.warehouse_access.exists():
-                        if not permission_obj.warehouse_access.filter(id=warehouse.id).exists():
-                            return False
-            
-            return True
+            from .permission_cache import get_compiled_permissions
+            
+            # فحص العملية والفرع والمخزن في الذاكرة من الصلاحيات المجمعة
+            compiled = get_compiled_permissions(user, company.id if company else None)
+            return bool(compiled.allows(
+                screen,
+                action,
+                branch.id if branch else None,
+                warehouse.id if warehouse else None
+            ))
             
         except Exception as e:
             logger.error(f"Error checking permission: {e}")
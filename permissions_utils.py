@@ -46,16 +46,10 @@ def check_user_permission(user, screen, action):
     if user.is_superuser:
         return True
     
-    # فحص الصلاحية من قاعدة البيانات
+    # فحص الصلاحية من الصلاحيات المجمعة (بدون استعلام عند دفء الكاش)
     try:
-        from .models import Permission
-        permission = Permission.objects.filter(
-            user=user,
-            screen=screen
-        ).first()
-        
-        if permission:
-            return getattr(permission, f'can_{action}', False)
+        from .permission_cache import get_compiled_permissions
+        return bool(get_compiled_permissions(user).allows(screen, action))
     except:
         pass
     
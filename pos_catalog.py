@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+"""
+كتالوج نقطة البيع (POSCatalogItem)
+
+صف لكل منتج في كل مخزن فيه بيانات العرض والسعر الفعلي والمخزون في المخزن:
+- السعر: سعر ProductPrice النشط للمخزن (سعر فرع المخزن أولاً، ثم السعر
+  العام بدون فرع)، وإذا لم يوجد فسعر المنتج
+- المخزون: ProductStock للمنتج في المخزن، وإذا لم يوجد فمخزون المنتج
+
+التحديث:
+- حفظ منتج أو سعر: إعادة بناء صفوف المنتج في جميع المخازن (عدد ثابت من الاستعلامات)
+- تعديل المخزون (إشارات ProductStock أو عمليات UPDATE في StockLedger و
+  POSCheckoutService): UPDATE واحد لعمود stock من ProductStock
+- إنشاء مخزن: بناء صفوف المخزن لجميع منتجات الشركة
+
+كل تعديل يأخذ رقماً من عداد التغييرات (ChangeCounter) ويحفظ في version لكل صف
+معدل، والمنتجات المحذوفة تسجل في POSCatalogTombstone، فنقطة البيع تطلب التغييرات
+بعد آخر رقم لديها فقط (feed).
+
+كتالوج المخزن يبنى تلقائياً عند أول قراءة إذا لم تكن له صفوف (الشركات الموجودة
+قبل إضافة الكتالوج). التعديلات الجماعية بدون إشارات: python manage.py rebuild_pos_catalog
+"""
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import DecimalField, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .database_router import get_current_db_alias
+
+DEFAULT_LIMIT = 20
+CHANGE_COUNTER = 'pos_catalog'
+FEED_CACHE_TIMEOUT = 3600
+
+# المخازن التي تم التحقق من وجود كتالوجها في هذه العملية {(alias, warehouse_id)}
+_filled = set()
+
+
+def next_change(using=None):
+    """
+    رقم التغيير التالي للكتالوج
+
+    UPDATE على صف العداد أولاً فيأخذ قفل الكتابة حتى نهاية المعاملة، فلا يأخذ
+    تعديلان نفس الرقم ولا يظهر رقم قبل حفظ التعديل الذي أخذه. يجب استدعاؤها
+    داخل معاملة التعديل نفسها (كما في POSCatalog.refresh).
+    """
+    from .models import ChangeCounter
+
+    db = using or get_current_db_alias()
+    counters = ChangeCounter._base_manager.using(db)
+    # update() لا يحدث auto_now، و updated_at هو Last-Modified في feed
+    if not counters.filter(name=CHANGE_COUNTER).update(value=F('value') + 1, updated_at=timezone.now()):
+        try:
+            with transaction.atomic(using=db):
+                counters.create(name=CHANGE_COUNTER, value=1)
+        except IntegrityError:
+            counters.filter(name=CHANGE_COUNTER).update(value=F('value') + 1, updated_at=timezone.now())
+    return counters.filter(name=CHANGE_COUNTER).values_list('value', flat=True).get()
+
+
+def current_change(using=None):
+    """(آخر رقم تغيير، وقت آخر تغيير) أو (0, None) إذا لم يتغير الكتالوج بعد"""
+    from .models import ChangeCounter
+
+    row = ChangeCounter._base_manager.using(using or get_current_db_alias()).filter(
+        name=CHANGE_COUNTER
+    ).values_list('value', 'updated_at').first()
+    return row or (0, None)
+
+
+class POSCatalog:
+    """بناء كتالوج نقطة البيع والقراءة منه"""
+
+    @staticmethod
+    def _price_rank(branch_id, warehouse_branch_id):
+        if branch_id == warehouse_branch_id:
+            return 0
+        return 1 if branch_id is None else 2
+
+    @classmethod
+    def refresh(cls, product_ids=None, warehouse_ids=None, using=None, batch_size=500):
+        """
+        إعادة بناء صفوف الكتالوج للمنتجات و/أو المخازن المحددة (الكل إذا لم تحدد)
+
+        أربعة استعلامات قراءة بغض النظر عن عدد المنتجات، ثم حذف الصفوف القديمة
+        وإنشاء الجديدة دفعة واحدة. يرجع عدد الصفوف.
+        """
+        from .models import Product, ProductPrice, ProductStock, Warehouse, POSCatalogItem
+
+        db = using or get_current_db_alias()
+        with transaction.atomic(using=db):
+            products = Product._base_manager.using(db)
+            warehouses = Warehouse._base_manager.using(db)
+            prices = ProductPrice._base_manager.using(db).filter(is_active=True)
+            stocks = ProductStock._base_manager.using(db)
+            existing = POSCatalogItem._base_manager.using(db)
+            if product_ids is not None:
+                product_ids = list(product_ids)
+                products = products.filter(pk__in=product_ids)
+                prices = prices.filter(product_id__in=product_ids)
+                stocks = stocks.filter(product_id__in=product_ids)
+                existing = existing.filter(product_id__in=product_ids)
+            if warehouse_ids is not None:
+                warehouse_ids = list(warehouse_ids)
+                warehouses = warehouses.filter(pk__in=warehouse_ids)
+                prices = prices.filter(warehouse_id__in=warehouse_ids)
+                stocks = stocks.filter(warehouse_id__in=warehouse_ids)
+                existing = existing.filter(warehouse_id__in=warehouse_ids)
+
+            products = list(products.only(
+                'id', 'company_id', 'name', 'barcode', 'category', 'unit', 'brand', 'description',
+                'image', 'price', 'cost_price', 'stock', 'is_active'
+            ))
+            warehouses_by_company = {}
+            for warehouse_id, company_id, branch_id in warehouses.filter(is_active=True).values_list(
+                'id', 'company_id', 'branch_id'
+            ):
+                warehouses_by_company.setdefault(company_id, []).append((warehouse_id, branch_id))
+
+            branch_of = {
+                warehouse_id: branch_id
+                for company_warehouses in warehouses_by_company.values()
+                for warehouse_id, branch_id in company_warehouses
+            }
+            best_prices = {}
+            for product_id, warehouse_id, branch_id, selling_price, cost_price in prices.order_by('id').values_list(
+                'product_id', 'warehouse_id', 'branch_id', 'selling_price', 'cost_price'
+            ):
+                rank = cls._price_rank(branch_id, branch_of.get(warehouse_id))
+                current = best_prices.get((product_id, warehouse_id))
+                if current is None or rank < current[0]:
+                    best_prices[(product_id, warehouse_id)] = (rank, selling_price, cost_price)
+            stock_levels = {
+                (product_id, warehouse_id): current_stock
+                for product_id, warehouse_id, current_stock in stocks.values_list(
+                    'product_id', 'warehouse_id', 'current_stock'
+                )
+            }
+
+            rows = []
+            for product in products:
+                for warehouse_id, _ in warehouses_by_company.get(product.company_id, ()):
+                    key = (product.id, warehouse_id)
+                    price = best_prices.get(key)
+                    rows.append(POSCatalogItem(
+                        company_id=product.company_id,
+                        product_id=product.id,
+                        warehouse_id=warehouse_id,
+                        name=product.name,
+                        barcode=product.barcode or '',
+                        category=product.category or '',
+                        unit=product.unit or '',
+                        brand=product.brand or '',
+                        description=product.description or '',
+                        image=product.image.name if product.image else '',
+                        price=price[1] if price and price[1] else product.price or 0,
+                        cost_price=price[2] if price and price[2] else product.cost_price or 0,
+                        stock=stock_levels.get(key, product.stock or 0),
+                        is_active=product.is_active,
+                    ))
+
+            version = next_change(db)
+            current_pairs = {(row.product_id, row.warehouse_id) for row in rows}
+            removed = [
+                pair for pair in existing.values_list('product_id', 'warehouse_id')
+                if pair not in current_pairs
+            ]
+            cls._tombstone(removed, version, db)
+
+            existing.delete()
+            for row in rows:
+                row.version = version
+            for start in range(0, len(rows), batch_size):
+                POSCatalogItem._base_manager.using(db).bulk_create(rows[start:start + batch_size])
+            return len(rows)
+
+    @staticmethod
+    def _tombstone(pairs, version, using, batch_size=500):
+        from .models import POSCatalogTombstone
+
+        tombstones = [
+            POSCatalogTombstone(product_id=product_id, warehouse_id=warehouse_id, version=version)
+            for product_id, warehouse_id in pairs
+        ]
+        for start in range(0, len(tombstones), batch_size):
+            POSCatalogTombstone._base_manager.using(using).bulk_create(tombstones[start:start + batch_size])
+
+    @classmethod
+    def remove(cls, product_ids, using=None):
+        """تسجيل حذف صفوف المنتجات قبل حذفها مع المنتج"""
+        from .models import POSCatalogItem
+
+        db = using or get_current_db_alias()
+        with transaction.atomic(using=db):
+            pairs = list(POSCatalogItem._base_manager.using(db).filter(
+                product_id__in=list(product_ids)
+            ).values_list('product_id', 'warehouse_id'))
+            if pairs:
+                cls._tombstone(pairs, next_change(db), db)
+
+    @staticmethod
+    def refresh_stock(product_ids, using=None):
+        """تحديث مخزون صفوف المنتجات في جميع المخازن بعملية UPDATE واحدة"""
+        from .models import Product, ProductStock, POSCatalogItem
+
+        db = using or get_current_db_alias()
+        with transaction.atomic(using=db):
+            product_ids = list(product_ids)
+            if not product_ids:
+                return 0
+            warehouse_stock = ProductStock._base_manager.using(db).filter(
+                product_id=OuterRef('product_id'), warehouse_id=OuterRef('warehouse_id')
+            ).values('current_stock')[:1]
+            product_stock = Product._base_manager.using(db).filter(pk=OuterRef('product_id')).values('stock')[:1]
+            return POSCatalogItem._base_manager.using(db).filter(product_id__in=product_ids).update(
+                stock=Coalesce(
+                    Subquery(warehouse_stock), Subquery(product_stock),
+                    output_field=DecimalField(max_digits=10, decimal_places=3)
+                ),
+                version=next_change(db),
+                updated_at=timezone.now()
+            )
+
+    @staticmethod
+    def warehouse_for(user, using=None):
+        """مخزن الكاشير: مخزن الجلسة المفتوحة ثم المخزن الافتراضي في ملف المستخدم"""
+        from .models import POSSession, UserProfile
+
+        if not getattr(user, 'is_authenticated', False):
+            return None
+        db = using or get_current_db_alias()
+        warehouse_id = POSSession._base_manager.using(db).filter(
+            cashier=user, status='open'
+        ).order_by('-id').values_list('warehouse_id', flat=True).first()
+        if warehouse_id:
+            return warehouse_id
+        return UserProfile._base_manager.using(db).filter(user=user).exclude(
+            default_warehouse=None
+        ).values_list('default_warehouse_id', flat=True).first()
+
+    @classmethod
+    def ensure_warehouse(cls, warehouse_id, using=None):
+        """
+        بناء كتالوج المخزن إذا لم تكن له صفوف (بيانات قبل إضافة الكتالوج)
+
+        التحقق مرة واحدة لكل مخزن في العملية، والصفوف بعدها تحدث من الإشارات.
+        """
+        from .models import POSCatalogItem
+
+        db = using or get_current_db_alias()
+        if (db, warehouse_id) in _filled:
+            return
+        if not POSCatalogItem._base_manager.using(db).filter(warehouse_id=warehouse_id).exists():
+            cls.refresh(warehouse_ids=[warehouse_id], using=db)
+        _filled.add((db, warehouse_id))
+
+    @classmethod
+    def items(cls, warehouse_id, using=None):
+        """منتجات المخزن النشطة في الكتالوج"""
+        from .models import POSCatalogItem
+
+        db = using or get_current_db_alias()
+        cls.ensure_warehouse(warehouse_id, db)
+        return POSCatalogItem._base_manager.using(db).filter(
+            warehouse_id=warehouse_id, is_active=True
+        )
+
+    @classmethod
+    def search(cls, query, warehouse_id, limit=DEFAULT_LIMIT, using=None):
+        """
+        البحث في كتالوج المخزن
+
+        ترتيب فهرس البحث (bm25) ثم صفوف الكتالوج باستعلام واحد، أو البحث
+        العادي في الكتالوج إذا لم يكن الفهرس متاحاً.
+        """
+        from .product_search import ProductSearchIndex
+
+        db = using or get_current_db_alias()
+        items = cls.items(warehouse_id, db)
+        ids = ProductSearchIndex.search(query, limit, using=db)
+        if ids is None:
+            return list(items.filter(
+                Q(name__icontains=query) |
+                Q(barcode__icontains=query) |
+                Q(category__icontains=query)
+            ).order_by('name')[:limit])
+
+        by_product = {item.product_id: item for item in items.filter(product_id__in=ids)}
+        return [by_product[product_id] for product_id in ids if product_id in by_product]
+
+    @staticmethod
+    def as_dict(item):
+        """بيانات المنتج في نقطة البيع (نفس مفاتيح واجهات المنتجات)"""
+        return {
+            'id': item.product_id,
+            'name': item.name,
+            'barcode': item.barcode,
+            'category': item.category,
+            'unit': item.unit or 'قطعة',
+            'price': float(item.price or 0),
+            'cost_price': float(item.cost_price or 0),
+            'stock': float(item.stock or 0),
+            'brand': item.brand,
+            'description': item.description,
+            'image_url': default_storage.url(item.image) if item.image else '',
+            'warehouse_id': item.warehouse_id,
+        }
+
+    @classmethod
+    def feed(cls, warehouse_id, since=None, using=None):
+        """
+        كتالوج المخزن لنقطة البيع
+
+        بدون since: جميع المنتجات النشطة (محفوظ في الكاش برقم التغيير). مع since:
+        الصفوف التي تغيرت بعده فقط، والمنتجات المحذوفة أو غير النشطة في removed.
+        """
+        from .models import POSCatalogItem, POSCatalogTombstone
+
+        db = using or get_current_db_alias()
+        version = current_change(db)[0]
+        if since is None:
+            key = f"pos_catalog_feed:{db}:{warehouse_id}:v{version}"
+            payload = cache.get(key)
+            if payload is None:
+                payload = {
+                    'version': version,
+                    'full': True,
+                    'products': [cls.as_dict(item) for item in cls.items(warehouse_id, db).order_by('name')],
+                    'removed': [],
+                }
+                cache.set(key, payload, FEED_CACHE_TIMEOUT)
+            return payload
+
+        products = []
+        removed = set()
+        changed = POSCatalogItem._base_manager.using(db).filter(
+            warehouse_id=warehouse_id, version__gt=since, version__lte=version
+        )
+        for item in changed:
+            if item.is_active:
+                products.append(cls.as_dict(item))
+            else:
+                removed.add(item.product_id)
+        active = {product['id'] for product in products}
+        removed.update(
+            product_id for product_id in POSCatalogTombstone._base_manager.using(db).filter(
+                warehouse_id=warehouse_id, version__gt=since, version__lte=version
+            ).values_list('product_id', flat=True)
+            if product_id not in active
+        )
+        return {
+            'version': version,
+            'full': False,
+            'products': products,
+            'removed': sorted(removed),
+        }
+
+
+@receiver(post_save, sender='core.Product')
+def product_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        POSCatalog.refresh([instance.pk], using=kwargs.get('using'))
+
+
+@receiver(pre_delete, sender='core.Product')
+def product_deleting(sender, instance, **kwargs):
+    POSCatalog.remove([instance.pk], using=kwargs.get('using'))
+
+
+@receiver(post_save, sender='core.ProductPrice')
+@receiver(post_delete, sender='core.ProductPrice')
+def price_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    using = kwargs.get('using') or get_current_db_alias()
+    product_id = instance.product_id
+    # بعد الحفظ: حذف المنتج يحذف أسعاره أولاً ولا يجب إعادة إنشاء صفوفه قبل حذفه
+    transaction.on_commit(lambda: POSCatalog.refresh([product_id], using=using), using=using)
+
+
+@receiver(post_save, sender='core.ProductStock')
+@receiver(post_delete, sender='core.ProductStock')
+def stock_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        POSCatalog.refresh_stock([instance.product_id], using=kwargs.get('using'))
+
+
+@receiver(post_save, sender='core.Warehouse')
+def warehouse_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        POSCatalog.refresh(warehouse_ids=[instance.pk], using=kwargs.get('using'))
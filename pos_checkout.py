@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+خدمة إتمام البيع في نقاط البيع
+
+تنفذ عملية البيع كاملة داخل معاملة واحدة وبعدد ثابت من الاستعلامات مهما كان
+عدد العناصر في السلة:
+- جلب جميع المنتجات باستعلام in_bulk واحد
+- التحقق من المخزون في الذاكرة
+- خصم المخزون بعملية UPDATE واحدة مشروطة (stock >= الكمية لكل منتج)
+- إدراج عناصر البيع وحركات المخزون بـ bulk_create
+
+checkout_batch ينفذ نفس العملية لمجموعة إيصالات من جهاز كان بدون اتصال، في
+معاملة واحدة وبعدد ثابت من الاستعلامات لكل دفعة، مع تجاهل الإيصالات التي سبق
+حفظها عن طريق مفتاح عدم التكرار (idempotency_key) الفريد في POSSale.
+"""
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, When, F, Q, DecimalField
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .barcode_map import invalidate_barcode_stock
+from .database_router import company_atomic, get_current_db_alias
+from .models import Product, POSSale, POSSaleItem, StockMovement, reserve_document_numbers
+from .pos_catalog import POSCatalog
+from .pos_session_totals import POSSessionTotals
+from .stock_ledger import StockLedger
+from .utils import safe_decimal
+
+IDEMPOTENCY_KEY_MAX_LENGTH = 64
+
+
+class POSCheckoutService:
+    """إتمام بيع نقاط البيع بعدد ثابت من الاستعلامات"""
+
+    @staticmethod
+    def parse_items(items_data):
+        """تحويل عناصر السلة القادمة من الواجهة إلى قيم Decimal"""
+        items = []
+        for item_data in items_data:
+            quantity = safe_decimal(item_data.get('quantity'))
+            if quantity <= 0:
+                raise ValidationError('الكمية يجب أن تكون أكبر من صفر')
+            items.append({
+                'product_id': int(item_data['product_id']),
+                'quantity': quantity,
+                'unit_price': safe_decimal(item_data.get('unit_price')),
+                'discount_percent': safe_decimal(item_data.get('discount_percent', 0)),
+            })
+        if not items:
+            raise ValidationError('السلة فارغة')
+        return items
+
+    @staticmethod
+    def load_products(items):
+        """جلب منتجات السلة باستعلام واحد والتحقق من المخزون في الذاكرة"""
+        required = OrderedDict()
+        for item in items:
+            required[item['product_id']] = required.get(item['product_id'], Decimal('0')) + item['quantity']
+
+        products = Product.objects.in_bulk(list(required.keys()))
+        for product_id, quantity in required.items():
+            product = products.get(product_id)
+            if product is None or not product.is_active:
+                raise ValidationError(f'المنتج رقم {product_id} غير موجود')
+            if (product.stock or 0) < quantity:
+                raise ValidationError(f'المخزون غير كافي للمنتج {product.name}')
+
+        return products, required
+
+    @staticmethod
+    def build_lines(items, discount_amount):
+        """حساب إجماليات السلة في الذاكرة: (الأسطر، المجموع الفرعي، الإجمالي)"""
+        lines = []
+        subtotal = Decimal('0')
+        for item in items:
+            gross = item['quantity'] * item['unit_price']
+            line_discount = gross * (item['discount_percent'] / 100) if item['discount_percent'] > 0 else Decimal('0')
+            total_price = gross - line_discount
+            lines.append((item, line_discount, total_price))
+            subtotal += total_price
+        return lines, subtotal, subtotal - discount_amount
+
+    @staticmethod
+    def decrement_stock(required):
+        """
+        خصم المخزون لجميع المنتجات بعملية UPDATE واحدة
+
+        الشرط stock >= الكمية جزء من جملة WHERE، فإذا سبق كاشير آخر وسحب
+        المخزون لن يتم تحديث كل الصفوف ويتم التراجع عن البيع بالكامل.
+        """
+        condition = Q()
+        whens = []
+        for product_id, quantity in required.items():
+            condition |= Q(id=product_id, stock__gte=quantity)
+            whens.append(When(id=product_id, then=F('stock') - quantity))
+
+        updated = Product.objects.filter(condition).update(
+            stock=Case(*whens, default=F('stock'), output_field=DecimalField(max_digits=10, decimal_places=3))
+        )
+        if updated != len(required):
+            raise ValidationError('المخزون غير كافي، تم تعديله من عملية بيع أخرى')
+
+    @staticmethod
+    def apply_movements(movements, product_ids):
+        """
+        تطبيق حركات البيع على دفتر المخزون بعد خصم Product.stock
+
+        StockLedger يحدث كتالوج نقطة البيع وخريطة الباركود مرة واحدة بعد كتابة
+        المخزن، وإذا كانت الجلسة بدون مخزن (لا يوجد ما يكتب في الدفتر) يتم
+        تحديثهما هنا من Product.stock، فيتم التحديث مرة واحدة فقط لكل بيع.
+        """
+        if any(movement.warehouse_id for movement in movements):
+            StockLedger.apply_movements(movements)
+            return
+        db = get_current_db_alias()
+        POSCatalog.refresh_stock(product_ids, db)
+        transaction.on_commit(lambda: invalidate_barcode_stock(db), using=db)
+
+    @classmethod
+    def checkout(cls, session, company, user, items_data, customer_name='عميل نقدي',
+                 payment_method='cash', cash_amount=0, card_amount=0, discount_amount=0):
+        """
+        تنفيذ عملية البيع وإرجاع POSSale
+
+        يرفع ValidationError برسالة مناسبة للمستخدم إذا كانت السلة غير صالحة
+        أو المخزون غير كافٍ، ولا يتم حفظ أي شيء في هذه الحالة.
+        """
+        items = cls.parse_items(items_data)
+        cash_amount = safe_decimal(cash_amount)
+        card_amount = safe_decimal(card_amount)
+        discount_amount = safe_decimal(discount_amount)
+
+        products, required = cls.load_products(items)
+
+        # حساب الإجماليات في الذاكرة قبل الحفظ حتى يتم حفظ البيع مرة واحدة
+        lines, subtotal, total_amount = cls.build_lines(items, discount_amount)
+
+        with company_atomic():
+            pos_sale = POSSale.objects.create(
+                company=company,
+                session=session,
+                customer_name=customer_name,
+                payment_method=payment_method,
+                cash_amount=cash_amount,
+                card_amount=card_amount,
+                discount_amount=discount_amount,
+                subtotal=subtotal,
+                total_amount=total_amount,
+                change_amount=(cash_amount + card_amount) - total_amount,
+                created_by=user
+            )
+
+            cls.decrement_stock(required)
+
+            POSSaleItem.objects.bulk_create([
+                POSSaleItem(
+                    company=company,
+                    pos_sale=pos_sale,
+                    product=products[item['product_id']],
+                    quantity=item['quantity'],
+                    unit_price=item['unit_price'],
+                    discount_percent=item['discount_percent'],
+                    discount_amount=line_discount,
+                    total_price=total_price
+                )
+                for item, line_discount, total_price in lines
+            ])
+
+            reference = f'بيع نقاط البيع #{pos_sale.receipt_number}'
+            movements = StockMovement.objects.bulk_create([
+                StockMovement(
+                    company=company,
+                    product=products[item['product_id']],
+                    warehouse_id=session.warehouse_id,
+                    movement_type='out',
+                    quantity=item['quantity'],
+                    reference=reference,
+                    created_by=user
+                )
+                for item, line_discount, total_price in lines
+            ])
+            # bulk_create لا يرسل إشارات، لذلك يتم تحديث مخزون المخزن هنا
+            cls.apply_movements(movements, required.keys())
+
+        return pos_sale
+
+    @staticmethod
+    def parse_created_at(value):
+        """وقت البيع المسجل في الجهاز (None إذا لم يرسل)، بالمنطقة الزمنية الحالية إذا كان بدونها"""
+        if not value:
+            return None
+        try:
+            created_at = parse_datetime(str(value))
+        except ValueError:
+            created_at = None
+        if created_at is None:
+            raise ValidationError('وقت البيع غير صالح')
+        if settings.USE_TZ and timezone.is_naive(created_at):
+            created_at = timezone.make_aware(created_at)
+        return created_at
+
+    @classmethod
+    def prepare_receipt(cls, receipt, products, available):
+        """
+        التحقق من إيصال واحد في الدفعة وحساب إجمالياته
+
+        available هو المخزون المتبقي بعد الإيصالات السابقة في نفس الدفعة،
+        ويتم خصم كميات الإيصال منه فقط إذا كان الإيصال صالحاً.
+        """
+        items = cls.parse_items(receipt.get('items') or [])
+        cash_amount = safe_decimal(receipt.get('cash_amount', 0))
+        card_amount = safe_decimal(receipt.get('card_amount', 0))
+        discount_amount = safe_decimal(receipt.get('discount_amount', 0))
+
+        payment_method = receipt.get('payment_method') or 'cash'
+        if payment_method not in dict(POSSale.PAYMENT_METHODS):
+            raise ValidationError('طريقة الدفع غير صالحة')
+        created_at = cls.parse_created_at(receipt.get('created_at'))
+
+        required = OrderedDict()
+        for item in items:
+            required[item['product_id']] = required.get(item['product_id'], Decimal('0')) + item['quantity']
+        for product_id, quantity in required.items():
+            product = products.get(product_id)
+            if product is None or not product.is_active:
+                raise ValidationError(f'المنتج رقم {product_id} غير موجود')
+            if available[product_id] < quantity:
+                raise ValidationError(f'المخزون غير كافي للمنتج {product.name}')
+        for product_id, quantity in required.items():
+            available[product_id] -= quantity
+
+        lines, subtotal, total_amount = cls.build_lines(items, discount_amount)
+        return {
+            'payment_method': payment_method,
+            'customer_name': receipt.get('customer_name') or 'عميل نقدي',
+            'cash_amount': cash_amount,
+            'card_amount': card_amount,
+            'discount_amount': discount_amount,
+            'subtotal': subtotal,
+            'total_amount': total_amount,
+            'created_at': created_at,
+            'lines': lines,
+            'required': required,
+        }
+
+    @classmethod
+    def checkout_batch(cls, session, company, user, receipts):
+        """
+        حفظ دفعة إيصالات من جهاز نقاط البيع في معاملة واحدة
+
+        يرجع نتيجة لكل إيصال بنفس الترتيب:
+        - created: تم الحفظ الآن
+        - duplicate: سبق حفظه بنفس المفتاح (إعادة إرسال)
+        - error: إيصال غير صالح (لا يؤثر على باقي الدفعة)
+
+        إذا فشل خصم المخزون بسبب عملية بيع متزامنة يتم التراجع عن الدفعة كاملة
+        ويرفع ValidationError، ويمكن للجهاز إعادة إرسالها بأمان.
+        """
+        results = [None] * len(receipts)
+        keys = {}
+        for index, receipt in enumerate(receipts):
+            key = str((receipt or {}).get('idempotency_key') or '').strip()
+            if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+                results[index] = {'idempotency_key': key, 'status': 'error', 'error': 'مفتاح عدم التكرار غير صالح'}
+            elif key in keys:
+                results[index] = {'idempotency_key': key, 'status': 'duplicate', 'duplicate_of': keys[key]}
+            else:
+                keys[key] = index
+
+        # الإيصالات المحفوظة سابقاً باستعلام واحد
+        existing = POSSale.objects.filter(idempotency_key__in=list(keys)).values_list(
+            'idempotency_key', 'id', 'receipt_number'
+        )
+        for key, sale_id, receipt_number in existing:
+            results[keys.pop(key)] = {
+                'idempotency_key': key, 'status': 'duplicate', 'sale_id': sale_id, 'receipt_number': receipt_number
+            }
+
+        # جميع منتجات الدفعة باستعلام واحد
+        product_ids = set()
+        for index in keys.values():
+            for item_data in receipts[index].get('items') or []:
+                try:
+                    product_ids.add(int(item_data['product_id']))
+                except (KeyError, TypeError, ValueError):
+                    pass
+        products = Product.objects.in_bulk(list(product_ids))
+        available = {product_id: product.stock or Decimal('0') for product_id, product in products.items()}
+
+        prepared = []
+        for key, index in keys.items():
+            try:
+                prepared.append((key, index, cls.prepare_receipt(receipts[index], products, available)))
+            except (ValidationError, KeyError, TypeError, ValueError) as e:
+                message = e.messages[0] if isinstance(e, ValidationError) else 'بيانات الإيصال غير صالحة'
+                results[index] = {'idempotency_key': key, 'status': 'error', 'error': message}
+
+        if prepared:
+            with company_atomic():
+                numbers = reserve_document_numbers(POSSale(company=company), 'receipt_number', 'REC', len(prepared))
+                sales = []
+                for (key, index, data), receipt_number in zip(prepared, numbers):
+                    sale = POSSale(
+                        company=company,
+                        session=session,
+                        receipt_number=receipt_number,
+                        idempotency_key=key,
+                        customer_name=data['customer_name'],
+                        payment_method=data['payment_method'],
+                        cash_amount=data['cash_amount'],
+                        card_amount=data['card_amount'],
+                        discount_amount=data['discount_amount'],
+                        subtotal=data['subtotal'],
+                        total_amount=data['total_amount'],
+                        change_amount=(data['cash_amount'] + data['card_amount']) - data['total_amount'],
+                        created_by=user
+                    )
+                    if data['created_at']:
+                        sale.created_at = data['created_at']
+                    sales.append(sale)
+                sales = POSSale.objects.bulk_create(sales)
+
+                # بعض قواعد البيانات لا ترجع الأرقام من bulk_create
+                if any(sale.pk is None for sale in sales):
+                    ids = dict(POSSale.objects.filter(idempotency_key__in=[sale.idempotency_key for sale in sales])
+                               .values_list('idempotency_key', 'id'))
+                    for sale in sales:
+                        sale.pk = ids[sale.idempotency_key]
+
+                required = OrderedDict()
+                for key, index, data in prepared:
+                    for product_id, quantity in data['required'].items():
+                        required[product_id] = required.get(product_id, Decimal('0')) + quantity
+                cls.decrement_stock(required)
+
+                sale_items = []
+                movements = []
+                for sale, (key, index, data) in zip(sales, prepared):
+                    reference = f'بيع نقاط البيع #{sale.receipt_number}'
+                    for item, line_discount, total_price in data['lines']:
+                        product = products[item['product_id']]
+                        sale_items.append(POSSaleItem(
+                            company=company,
+                            pos_sale=sale,
+                            product=product,
+                            quantity=item['quantity'],
+                            unit_price=item['unit_price'],
+                            discount_percent=item['discount_percent'],
+                            discount_amount=line_discount,
+                            total_price=total_price
+                        ))
+                        movements.append(StockMovement(
+                            company=company,
+                            product=product,
+                            warehouse_id=session.warehouse_id,
+                            movement_type='out',
+                            quantity=item['quantity'],
+                            reference=reference,
+                            created_by=user
+                        ))
+                POSSaleItem.objects.bulk_create(sale_items)
+                movements = StockMovement.objects.bulk_create(movements)
+
+                # bulk_create لا يرسل إشارات، لذلك يتم تحديث مخزون المخزن وعدادات الجلسة هنا
+                cls.apply_movements(movements, required.keys())
+                POSSessionTotals.apply_sales(sales)
+
+            for sale, (key, index, data) in zip(sales, prepared):
+                results[index] = {
+                    'idempotency_key': key, 'status': 'created', 'sale_id': sale.pk, 'receipt_number': sale.receipt_number
+                }
+
+        # التكرار داخل نفس الدفعة يأخذ نتيجة الإيصال الأول
+        for index, result in enumerate(results):
+            if 'duplicate_of' in result:
+                first = results[result.pop('duplicate_of')]
+                result['sale_id'] = first.get('sale_id')
+                result['receipt_number'] = first.get('receipt_number')
+                if first['status'] == 'error':
+                    result.update(status='error', error=first['error'])
+        return results
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+إجماليات جلسات نقاط البيع
+
+POSSession يحتفظ بعدادات تراكمية (total_sales و cash_sales و knet_sales و
+mixed_sales و sales_count و total_cash و total_card) يتم تحديثها بعملية UPDATE
+ذرية باستخدام F() داخل نفس معاملة البيع، فإغلاق الجلسة وتقريرها لا يحتاجان
+لتجميع مبيعات الجلسة مهما كان عددها.
+
+تقرير الجلسة (Z) يقرأ الإجماليات من العدادات، وعدد العناصر وأكثر المنتجات مبيعاً
+محفوظة في الكاش بمفتاح يحتوي على عدادات الجلسة، وقائمة المبيعات صفحات.
+
+عمليات bulk_create لا ترسل إشارات، لذلك يجب استدعاء apply_sales بعدها.
+المطابقة الكاملة تتم بأمر: python manage.py rebuild_pos_sessions
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db.models import Case, When, Value, F, Sum, Count, DecimalField
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from .database_router import get_current_db_alias
+
+COUNTER_FIELDS = ('total_sales', 'cash_sales', 'knet_sales', 'mixed_sales', 'total_cash', 'total_card')
+
+CACHE_TIMEOUT = 3600
+REPORT_PAGE_SIZE = 50
+TOP_PRODUCTS_COUNT = 5
+
+_ZERO = Decimal('0')
+
+
+def _amount_field():
+    return DecimalField(max_digits=12, decimal_places=2)
+
+
+class POSSessionTotals:
+    """تحديث عدادات جلسة نقاط البيع من مبيعاتها"""
+
+    @staticmethod
+    def sale_deltas(payment_method, total_amount, cash_amount, card_amount):
+        """مقدار تغيير كل عداد لبيع واحد"""
+        total_amount = Decimal(total_amount or 0)
+        cash_amount = Decimal(cash_amount or 0)
+        card_amount = Decimal(card_amount or 0)
+
+        deltas = dict.fromkeys(COUNTER_FIELDS, _ZERO)
+        deltas['total_sales'] = total_amount
+        if payment_method == 'cash':
+            deltas['cash_sales'] = total_amount
+            deltas['total_cash'] = cash_amount
+        elif payment_method == 'card':
+            deltas['knet_sales'] = total_amount
+            deltas['total_card'] = card_amount
+        elif payment_method == 'mixed':
+            deltas['mixed_sales'] = total_amount
+            deltas['total_cash'] = cash_amount
+            deltas['total_card'] = card_amount
+        return deltas
+
+    @staticmethod
+    def apply_deltas(session_id, deltas, count, using=None):
+        """تطبيق التغييرات على الجلسة بعملية UPDATE واحدة"""
+        from .models import POSSession
+
+        values = {
+            field: F(field) + Value(amount, output_field=_amount_field())
+            for field, amount in deltas.items() if amount
+        }
+        if count:
+            values['sales_count'] = F('sales_count') + count
+        if values:
+            POSSession._base_manager.using(using or get_current_db_alias()).filter(pk=session_id).update(**values)
+
+    @classmethod
+    def apply_sales(cls, sales, sign=1, using=None):
+        """تطبيق قائمة مبيعات (مثلاً بعد bulk_create) على جلساتها: UPDATE واحد لكل جلسة"""
+        totals = defaultdict(lambda: [dict.fromkeys(COUNTER_FIELDS, _ZERO), 0])
+        for sale in sales:
+            entry = totals[sale.session_id]
+            deltas = cls.sale_deltas(sale.payment_method, sale.total_amount, sale.cash_amount, sale.card_amount)
+            for field, amount in deltas.items():
+                entry[0][field] += sign * amount
+            entry[1] += sign
+        for session_id, (deltas, count) in totals.items():
+            cls.apply_deltas(session_id, deltas, count, using=using)
+
+    @staticmethod
+    def compute(session_ids=None, using=None):
+        """العدادات الصحيحة لكل جلسة باستعلام تجميع واحد"""
+        from .models import POSSale
+
+        def method_sum(field, *methods):
+            return Sum(
+                Case(When(payment_method__in=methods, then=F(field)), default=Value(_ZERO), output_field=_amount_field())
+            )
+
+        sales = POSSale._base_manager.using(using or get_current_db_alias())
+        if session_ids is not None:
+            sales = sales.filter(session_id__in=session_ids)
+        rows = sales.values('session').annotate(
+            total_sales=Sum('total_amount'),
+            cash_sales=method_sum('total_amount', 'cash'),
+            knet_sales=method_sum('total_amount', 'card'),
+            mixed_sales=method_sum('total_amount', 'mixed'),
+            total_cash=method_sum('cash_amount', 'cash', 'mixed'),
+            total_card=method_sum('card_amount', 'card', 'mixed'),
+            sales_count=Count('id'),
+        ).order_by()
+        return {row.pop('session'): row for row in rows}
+
+    @staticmethod
+    def report_details(session, using=None):
+        """
+        عدد العناصر وأكثر المنتجات مبيعاً لتقرير الجلسة
+
+        المفتاح يحتوي على عدادات الجلسة، فيتم التجميع مرة واحدة بعد كل تغيير في
+        مبيعاتها (ومرة واحدة فقط للجلسة المغلقة).
+        """
+        from .models import POSSaleItem
+
+        db = using or get_current_db_alias()
+        key = f"pos_session_report:{db}:{session.pk}:{session.sales_count}:{session.total_sales}"
+        details = cache.get(key)
+        if details is None:
+            items = POSSaleItem._base_manager.using(db).filter(pos_sale__session_id=session.pk)
+            details = {
+                'items_count': items.count(),
+                'top_products': list(
+                    items.values('product__name').annotate(
+                        total_quantity=Sum('quantity'),
+                        total_sales=Sum('total_price')
+                    ).order_by('-total_sales')[:TOP_PRODUCTS_COUNT]
+                ),
+            }
+            cache.set(key, details, CACHE_TIMEOUT)
+        return details
+
+    @staticmethod
+    def sales_page(session, page=1, page_size=REPORT_PAGE_SIZE, using=None):
+        """
+        صفحة من مبيعات الجلسة (الأحدث أولاً)
+
+        عدد الصفحات من sales_count بدلاً من COUNT. يرجع dict فيه sales و page
+        و num_pages و has_previous و has_next.
+        """
+        from .models import POSSale
+
+        num_pages = max(1, -(-session.sales_count // page_size))
+        try:
+            page = min(max(int(page or 1), 1), num_pages)
+        except (TypeError, ValueError):
+            page = 1
+        start = (page - 1) * page_size
+        sales = POSSale._base_manager.using(using or get_current_db_alias()).filter(
+            session_id=session.pk
+        ).order_by('-created_at', '-id')[start:start + page_size]
+        return {
+            'sales': list(sales),
+            'page': page,
+            'num_pages': num_pages,
+            'has_previous': page > 1,
+            'has_next': page < num_pages,
+        }
+
+    @classmethod
+    def rebuild(cls, session_ids=None, using=None, batch_size=500, dry_run=False):
+        """
+        مطابقة عدادات الجلسات مع مبيعاتها
+
+        يرجع تقرير الانحراف: قائمة الجلسات التي كانت عداداتها مختلفة.
+        """
+        from .models import POSSession
+
+        db = using or get_current_db_alias()
+        expected = cls.compute(session_ids, using=db)
+        sessions = POSSession._base_manager.using(db).only('id', 'session_number', 'sales_count', *COUNTER_FIELDS)
+        if session_ids is not None:
+            sessions = sessions.filter(pk__in=session_ids)
+
+        changed = []
+        drift = []
+        for session in sessions.iterator():
+            values = expected.get(session.pk, {})
+            correct = {field: values.get(field) or _ZERO for field in COUNTER_FIELDS}
+            correct['sales_count'] = values.get('sales_count') or 0
+            stored = {field: getattr(session, field) for field in correct}
+            if stored != correct:
+                drift.append({'session_id': session.pk, 'session_number': session.session_number,
+                              'stored': stored, 'expected': correct})
+                for field, value in correct.items():
+                    setattr(session, field, value)
+                changed.append(session)
+
+        if not dry_run:
+            fields = list(COUNTER_FIELDS) + ['sales_count']
+            for start in range(0, len(changed), batch_size):
+                POSSession._base_manager.using(db).bulk_update(changed[start:start + batch_size], fields)
+        return drift
+
+
+def _sale_state(sale):
+    return (sale.session_id, sale.payment_method, sale.total_amount, sale.cash_amount, sale.card_amount)
+
+
+@receiver(post_init, sender='core.POSSale')
+def remember_sale_state(sender, instance, **kwargs):
+    """حفظ قيم البيع عند التحميل لعكسها عند التعديل"""
+    values = instance.__dict__
+    if instance.pk and all(name in values for name in ('session_id', 'payment_method', 'total_amount', 'cash_amount', 'card_amount')):
+        instance._session_state = _sale_state(instance)
+
+
+def _apply_state(state, sign, using):
+    session_id, payment_method, total_amount, cash_amount, card_amount = state
+    deltas = POSSessionTotals.sale_deltas(payment_method, total_amount, cash_amount, card_amount)
+    POSSessionTotals.apply_deltas(
+        session_id, {field: sign * amount for field, amount in deltas.items()}, sign, using=using
+    )
+
+
+@receiver(post_save, sender='core.POSSale')
+def pos_sale_saved(sender, instance, created, raw=False, **kwargs):
+    """تحديث عدادات الجلسة عند إضافة أو تعديل بيع"""
+    new_state = _sale_state(instance)
+    old_state = getattr(instance, '_session_state', None)
+    instance._session_state = new_state
+    if raw or (not created and old_state == new_state):
+        return
+
+    using = kwargs.get('using')
+    if not created and old_state is not None:
+        _apply_state(old_state, -1, using)
+    _apply_state(new_state, 1, using)
+
+
+@receiver(post_delete, sender='core.POSSale')
+def pos_sale_deleted(sender, instance, **kwargs):
+    """عكس البيع المحذوف من عدادات الجلسة"""
+    state = getattr(instance, '_session_state', None) or _sale_state(instance)
+    _apply_state(state, -1, kwargs.get('using'))
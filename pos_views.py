@@ -3,10 +3,14 @@ Point of Sale (POS) Views
 Handles POS system functionality
 """
 
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError
 from django.shortcuts import render, redirect, get_object_or_404
 from django.http import JsonResponse
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 from django.utils import timezone
 from django.contrib import messages
 import json
@@ -68,6 +72,155 @@ def process_pos_sale(request):
     
     return JsonResponse({'success': False, 'error': 'Invalid request method'})
 
+@login_required
+def sync_pos_sales(request):
+    """
+    Upload a batch of receipts queued by an offline till
+
+    Body: {"session_id": 1, "receipts": [{"idempotency_key": "...", "items": [...], ...}]}
+    Every receipt gets its own result (created / duplicate / error), so the till
+    can safely resend the whole queue after a dropped connection. The endpoint
+    is session-authenticated, so the till must send the csrftoken cookie value
+    in the X-CSRFToken header.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'Invalid request method'}, status=405)
+
+    try:
+        data = json.loads(request.body)
+    except (TypeError, ValueError):
+        return JsonResponse({'success': False, 'error': 'بيانات غير صالحة'}, status=400)
+
+    receipts = data.get('receipts') if isinstance(data, dict) else None
+    if not isinstance(receipts, list) or not all(isinstance(receipt, dict) for receipt in receipts):
+        return JsonResponse({'success': False, 'error': 'قائمة الإيصالات غير صالحة'}, status=400)
+
+    max_batch = getattr(settings, 'POS_SYNC_MAX_BATCH', 500)
+    if len(receipts) > max_batch:
+        return JsonResponse({'success': False, 'error': f'الحد الأقصى {max_batch} إيصال في الدفعة'}, status=400)
+
+    from .models import POSSession
+    from .pos_checkout import POSCheckoutService
+
+    session_id = data.get('session_id')
+    if session_id:
+        try:
+            session_id = int(session_id)
+        except (TypeError, ValueError):
+            return JsonResponse({'success': False, 'error': 'رقم الجلسة غير صالح'}, status=400)
+
+    sessions = POSSession.objects.select_related('company').filter(cashier=request.user, status='open')
+    if session_id:
+        sessions = sessions.filter(id=session_id)
+    session = sessions.first()
+    if session is None:
+        return JsonResponse({'success': False, 'error': 'لا توجد جلسة مفتوحة'}, status=409)
+
+    company = getattr(request, 'company', None) or session.company
+    try:
+        results = POSCheckoutService.checkout_batch(session, company, request.user, receipts)
+    except (ValidationError, IntegrityError) as e:
+        # تم التراجع عن الدفعة كاملة (بيع متزامن أو إعادة إرسال متزامنة)، ويمكن إعادة إرسالها
+        logger.warning(f"POS batch rolled back: {e}")
+        message = ' '.join(e.messages) if isinstance(e, ValidationError) else 'تم إرسال نفس الإيصالات من طلب آخر'
+        return JsonResponse({'success': False, 'retry': True, 'error': message}, status=409)
+    except Exception as e:
+        logger.error(f"Error syncing POS sales: {e}")
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+    summary = {'created': 0, 'duplicate': 0, 'error': 0}
+    for result in results:
+        summary[result['status']] += 1
+    return JsonResponse({'success': True, 'summary': summary, 'results': results})
+
+@login_required
+def barcode_lookup(request):
+    """
+    Resolve a scanned barcode to a product
+
+    GET ?code=<barcode>. Exact match only: answered from the per-process
+    barcode map, falling back to an indexed equality query for codes not in it.
+    """
+    from .barcode_map import BarcodeMap
+
+    code = request.GET.get('code', '')
+    if not code.strip():
+        return JsonResponse({'success': False, 'error': 'يرجى إدخال الباركود'}, status=400)
+
+    try:
+        entry = BarcodeMap.lookup(code)
+    except Exception as e:
+        logger.error(f"Error looking up barcode {code}: {e}")
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+    if entry is None:
+        return JsonResponse({'success': False, 'error': 'الباركود غير موجود'}, status=404)
+    return JsonResponse({
+        'success': True,
+        'product': {
+            'id': entry.id,
+            'name': entry.name,
+            'price': float(entry.price),
+            'stock': float(entry.stock),
+        }
+    })
+
+def _catalog_feed_state(request):
+    """(warehouse_id, version, last_modified) for the cashier's catalog, cached on the request"""
+    if not hasattr(request, '_catalog_feed_state'):
+        from .pos_catalog import POSCatalog, current_change
+
+        warehouse_id = POSCatalog.warehouse_for(request.user)
+        version, last_modified = current_change() if warehouse_id else (0, None)
+        request._catalog_feed_state = (warehouse_id, version, last_modified)
+    return request._catalog_feed_state
+
+def _catalog_feed_etag(request):
+    warehouse_id, version, _ = _catalog_feed_state(request)
+    if not warehouse_id:
+        return None
+    from .database_router import get_current_db_alias
+    return f"{get_current_db_alias()}-{warehouse_id}-{request.GET.get('since') or 'full'}-{version}"
+
+def _catalog_feed_last_modified(request):
+    return _catalog_feed_state(request)[2]
+
+@login_required
+@condition(etag_func=_catalog_feed_etag, last_modified_func=_catalog_feed_last_modified)
+def catalog_feed(request):
+    """
+    Versioned product catalog for the cashier's warehouse
+
+    Without ?since the full snapshot is returned; with ?since=<version> only
+    products changed after that version plus the ids removed since then.
+    Responses carry ETag/Last-Modified so an unchanged catalog costs a 304.
+    Clients store the returned version and pass it as ?since on the next poll.
+    """
+    from .pos_catalog import POSCatalog
+
+    warehouse_id, _, _ = _catalog_feed_state(request)
+    if not warehouse_id:
+        return JsonResponse({'success': False, 'error': 'لا يوجد مخزن للمستخدم، يرجى فتح جلسة'}, status=409)
+
+    since = request.GET.get('since')
+    if since:
+        try:
+            since = int(since)
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'رقم الإصدار غير صالح'}, status=400)
+    else:
+        since = None
+
+    try:
+        feed = POSCatalog.feed(warehouse_id, since)
+    except Exception as e:
+        logger.error(f"Error building catalog feed: {e}")
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+    response = JsonResponse({'success': True, 'warehouse_id': warehouse_id, **feed})
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
 @login_required
 def close_pos_session(request, session_id):
     """Close a POS session"""
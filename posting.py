@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+"""
+مسار الترحيل الموحد للقيود المحاسبية
+
+كل حدث (فاتورة بيع، فاتورة شراء، مرتجع، دفعة...) ينتج قيداً واحداً فقط مفتاحه
+(reference_type, reference_id). المفتاح فريد في JournalEntry، فإذا تم استدعاء
+الترحيل أكثر من مرة لنفس الحدث (من إشارة الحفظ ومن دالة التأكيد مثلاً) أو من
+عمليتين في نفس اللحظة يتم إرجاع القيد الموجود بدون إنشاء قيد جديد.
+
+القيد ينشأ مرحلاً، وأسطره تدرج بـ bulk_create، ثم تطبق مجاميع الحسابات على
+الأرصدة مرة واحدة (bulk_create لا يرسل إشارات دفتر الأرصدة). post_many يرحل
+آلاف القيود (مسير الرواتب، الإقفال الشهري) بعدد ثابت من العمليات تقريباً.
+"""
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .account_ledger import AccountBalanceLedger
+from .database_router import get_current_db_alias
+
+_ZERO = Decimal('0')
+_TOLERANCE = Decimal('0.001')
+
+
+class PostingPipeline:
+    """ترحيل قيد واحد لكل حدث بشكل آمن للتكرار"""
+
+    @staticmethod
+    def find(reference_type, reference_id, using=None):
+        """القيد الموجود للحدث أو None"""
+        from .models import JournalEntry
+
+        return (
+            JournalEntry._base_manager.using(using or get_current_db_alias())
+            .filter(reference_type=reference_type, reference_id=reference_id)
+            .first()
+        )
+
+    @staticmethod
+    def _normalize_lines(lines):
+        """تحويل الأسطر إلى (account_id, debit, credit, description) وحذف الأسطر الصفرية"""
+        normalized = []
+        for line in lines:
+            account = line['account']
+            debit = Decimal(str(line.get('debit') or 0))
+            credit = Decimal(str(line.get('credit') or 0))
+            if not debit and not credit:
+                continue
+            normalized.append((getattr(account, 'pk', account), debit, credit, line.get('description', '')))
+        return normalized
+
+    @staticmethod
+    def event(reference_type, reference_id, entry_type, description, lines, user=None, company=None):
+        """حدث ترحيل واحد لـ post_many"""
+        return {
+            'reference_type': reference_type,
+            'reference_id': reference_id,
+            'entry_type': entry_type,
+            'description': description,
+            'lines': lines,
+            'user': user,
+            'company': company,
+        }
+
+    @classmethod
+    def _validate(cls, event):
+        """الأسطر المنظفة ومجموع المدين، ويرفع ValidationError إذا كان القيد غير متوازن"""
+        normalized = cls._normalize_lines(event['lines'])
+        total_debit = sum((debit for _, debit, _, _ in normalized), _ZERO)
+        total_credit = sum((credit for _, _, credit, _ in normalized), _ZERO)
+        if not normalized:
+            raise ValidationError(f"القيد بدون أسطر: {event['description']}")
+        if abs(total_debit - total_credit) > _TOLERANCE:
+            raise ValidationError(f"القيد غير متوازن: مدين {total_debit} دائن {total_credit} ({event['description']})")
+        return normalized, total_debit
+
+    @classmethod
+    def invalid_reason(cls, event):
+        """سبب رفض القيد (بدون أسطر أو غير متوازن) أو None إذا كان صالحاً للترحيل"""
+        try:
+            cls._validate(event)
+        except ValidationError as e:
+            return e.messages[0]
+        return None
+
+    @staticmethod
+    def _company_id(event):
+        """شركة القيد: من الحدث ثم الشركة الحالية ثم شركة أول حساب (bulk_create لا يستدعي save)"""
+        company = event.get('company')
+        if company is None:
+            company = getattr(threading.current_thread(), 'current_company', None)
+        if company is None:
+            account = event['lines'][0]['account'] if event['lines'] else None
+            return getattr(account, 'company_id', None)
+        return getattr(company, 'pk', company)
+
+    @staticmethod
+    def _reference_key(event):
+        if event.get('reference_type') and event.get('reference_id'):
+            return (event['reference_type'], event['reference_id'])
+        return None
+
+    @staticmethod
+    def find_many(keys, using=None):
+        """القيود الموجودة لعدة أحداث: {(reference_type, reference_id): entry} باستعلام لكل نوع مرجع"""
+        from .models import JournalEntry
+
+        by_type = {}
+        for reference_type, reference_id in keys:
+            by_type.setdefault(reference_type, set()).add(reference_id)
+
+        entries = JournalEntry._base_manager.using(using or get_current_db_alias())
+        found = {}
+        for reference_type, reference_ids in by_type.items():
+            for entry in entries.filter(reference_type=reference_type, reference_id__in=reference_ids):
+                found[(entry.reference_type, entry.reference_id)] = entry
+        return found
+
+    @classmethod
+    def post(cls, reference_type, reference_id, entry_type, description, lines, user=None, company=None, using=None):
+        """
+        ترحيل قيد الحدث مرة واحدة وإرجاعه
+
+        lines قائمة {'account', 'debit', 'credit', 'description'}. يرفع
+        ValidationError إذا كان القيد غير متوازن أو بدون أسطر.
+        """
+        event = cls.event(reference_type, reference_id, entry_type, description, lines, user, company)
+        return cls.post_many([event], using=using)[0]
+
+    @classmethod
+    def post_many(cls, events, using=None, batch_size=500):
+        """
+        ترحيل عدة قيود دفعة واحدة (مسير رواتب، إقفال شهري...)
+
+        events قائمة من PostingPipeline.event. يتم التحقق من توازن جميع القيود
+        قبل الكتابة، ثم حجز أرقام القيود بعملية واحدة وإدراج القيود والأسطر
+        بـ bulk_create وتطبيق أرصدة جميع الحسابات بعملية UPDATE واحدة لكل
+        batch_size حساب. يرجع القيود بنفس ترتيب events (القيد الموجود للأحداث
+        المرحلة من قبل أو المكررة داخل الدفعة).
+        """
+        from .models import JournalEntry, JournalEntryLine, reserve_document_numbers
+
+        db = using or get_current_db_alias()
+        validated = [cls._validate(event) for event in events]
+
+        keys = [cls._reference_key(event) for event in events]
+        results = [None] * len(events)
+        existing = cls.find_many({key for key in keys if key}, using=db)
+
+        pending = []
+        first_index = {}
+        for index, key in enumerate(keys):
+            if key in existing:
+                results[index] = existing[key]
+            elif key and key in first_index:
+                continue
+            else:
+                if key:
+                    first_index[key] = index
+                pending.append(index)
+        if not pending:
+            return cls._fill_duplicates(results, keys, first_index)
+
+        try:
+            with transaction.atomic(using=db):
+                numbers = reserve_document_numbers(
+                    JournalEntry(company_id=cls._company_id(events[pending[0]])),
+                    'entry_number', 'JE', len(pending)
+                )
+                now = timezone.now()
+                entries = []
+                for index, entry_number in zip(pending, numbers):
+                    event = events[index]
+                    total_debit = validated[index][1]
+                    entries.append(JournalEntry(
+                        company_id=cls._company_id(event),
+                        entry_number=entry_number,
+                        entry_type=event['entry_type'],
+                        transaction_type=event['entry_type'],
+                        description=event['description'],
+                        reference_type=event.get('reference_type'),
+                        reference_id=event.get('reference_id'),
+                        amount=total_debit,
+                        total_amount=total_debit,
+                        created_by=event.get('user'),
+                        created_at=now,
+                        is_posted=True,
+                        posted_at=now,
+                        posted_by=event.get('user')
+                    ))
+                entries = JournalEntry._base_manager.using(db).bulk_create(entries, batch_size=batch_size)
+
+                # بعض قواعد البيانات لا ترجع الأرقام من bulk_create
+                if any(entry.pk is None for entry in entries):
+                    ids = dict(JournalEntry._base_manager.using(db).filter(entry_number__in=numbers)
+                               .values_list('entry_number', 'id'))
+                    for entry in entries:
+                        entry.pk = ids[entry.entry_number]
+
+                lines = []
+                totals = OrderedDict()
+                for index, entry in zip(pending, entries):
+                    for account_id, debit, credit, line_description in validated[index][0]:
+                        lines.append(JournalEntryLine(
+                            company_id=entry.company_id,
+                            journal_entry=entry,
+                            account_id=account_id,
+                            debit=debit,
+                            credit=credit,
+                            description=line_description
+                        ))
+                        account_debit, account_credit = totals.get(account_id, (_ZERO, _ZERO))
+                        totals[account_id] = (account_debit + debit, account_credit + credit)
+                    results[index] = entry
+                JournalEntryLine._base_manager.using(db).bulk_create(lines, batch_size=batch_size)
+
+                # bulk_create لا يرسل إشارات دفتر الأرصدة، فيتم تطبيق المجاميع هنا مرة واحدة
+                AccountBalanceLedger.apply_totals(totals, using=db, batch_size=batch_size, moment=now)
+        except IntegrityError:
+            # تم ترحيل بعض الأحداث من عملية أخرى في نفس اللحظة: ترحيل الدفعة قيداً قيداً
+            if len(events) == 1:
+                existing = cls.find(*keys[0], using=db) if keys[0] else None
+                if existing is None:
+                    raise
+                return [existing]
+            return [cls.post_many([event], using=db)[0] for event in events]
+        return cls._fill_duplicates(results, keys, first_index)
+
+    @staticmethod
+    def _fill_duplicates(results, keys, first_index):
+        """الأحداث المكررة داخل الدفعة تأخذ قيد أول حدث بنفس المفتاح"""
+        for index, key in enumerate(keys):
+            if results[index] is None and key in first_index:
+                results[index] = results[first_index[key]]
+        return results
+
+    @classmethod
+    def post_sale(cls, sale, user=None):
+        """
+        قيد فاتورة البيع: العميل/المبيعات، وتكلفة البضاعة/المخزون إذا وجدت تكلفة
+        """
+        from .models import get_or_create_customer_account, get_or_create_account, SaleItem
+
+        company = sale.company
+        customer_account = get_or_create_customer_account(sale.customer)
+        sales_account = get_or_create_account('4001', 'مبيعات', 'revenue', company)
+        reference = f'فاتورة بيع #{sale.invoice_number}'
+
+        lines = [
+            {'account': customer_account, 'debit': sale.total_amount, 'credit': 0, 'description': reference},
+            {'account': sales_account, 'debit': 0, 'credit': sale.total_amount, 'description': reference},
+        ]
+
+        total_cost = _ZERO
+        for quantity, cost_price in SaleItem.objects.filter(sale=sale).values_list('quantity', 'product__cost_price'):
+            total_cost += Decimal(quantity or 0) * Decimal(cost_price or 0)
+        if total_cost > 0:
+            cost_account = get_or_create_account('5101', 'تكلفة البضاعة المباعة', 'expense', company)
+            inventory_account = get_or_create_account('1301', 'مخزون البضاعة', 'asset', company)
+            lines.extend([
+                {'account': cost_account, 'debit': total_cost, 'credit': 0,
+                 'description': f'تكلفة البضاعة المباعة #{sale.invoice_number}'},
+                {'account': inventory_account, 'debit': 0, 'credit': total_cost,
+                 'description': f'تخفيض المخزون #{sale.invoice_number}'},
+            ])
+
+        return cls.post(
+            'sale', sale.id, 'sale',
+            f'فاتورة بيع #{sale.invoice_number} - {sale.customer.name}',
+            lines,
+            user=user or sale.created_by,
+            company=company
+        )
+
+    @classmethod
+    def post_purchase(cls, purchase, user=None):
+        """قيد فاتورة الشراء: المخزون (جرد مستمر) / المورد"""
+        from .models import get_or_create_supplier_account, get_or_create_account
+
+        company = purchase.company
+        supplier_account = get_or_create_supplier_account(purchase.supplier)
+        inventory_account = get_or_create_account('1301', 'مخزون البضاعة', 'asset', company)
+        reference = f'فاتورة شراء #{purchase.invoice_number}'
+
+        return cls.post(
+            'purchase', purchase.id, 'purchase',
+            f'فاتورة شراء #{purchase.invoice_number} - {purchase.supplier.name}',
+            [
+                {'account': inventory_account, 'debit': purchase.total_amount, 'credit': 0, 'description': reference},
+                {'account': supplier_account, 'debit': 0, 'credit': purchase.total_amount, 'description': reference},
+            ],
+            user=user or purchase.created_by,
+            company=company
+        )
+
+    @classmethod
+    def post_sale_return(cls, sale_return, user=None):
+        """قيد مرتجع البيع: مرتجعات المبيعات/العميل، والمخزون/تكلفة البضاعة إذا وجدت تكلفة"""
+        from .models import get_or_create_customer_account, get_or_create_account
+
+        company = sale_return.company
+        customer_account = get_or_create_customer_account(sale_return.customer)
+        sales_return_account = get_or_create_account('4002', 'مرتجعات مبيعات', 'revenue', company)
+        reference = f'مرتجع بيع #{sale_return.return_number}'
+
+        lines = [
+            {'account': sales_return_account, 'debit': sale_return.total_amount, 'credit': 0, 'description': reference},
+            {'account': customer_account, 'debit': 0, 'credit': sale_return.total_amount, 'description': reference},
+        ]
+
+        total_cost = _ZERO
+        for quantity, cost_price in sale_return.items.values_list('quantity', 'product__cost_price'):
+            total_cost += Decimal(str(quantity or 0)) * Decimal(str(cost_price or 0))
+        if total_cost > 0:
+            inventory_account = get_or_create_account('1301', 'مخزون البضاعة', 'asset', company)
+            cost_account = get_or_create_account('5101', 'تكلفة البضاعة المباعة', 'expense', company)
+            lines.extend([
+                {'account': inventory_account, 'debit': total_cost, 'credit': 0,
+                 'description': f'إرجاع بضاعة للمخزون #{sale_return.return_number}'},
+                {'account': cost_account, 'debit': 0, 'credit': total_cost,
+                 'description': f'عكس تكلفة البضاعة المباعة #{sale_return.return_number}'},
+            ])
+
+        return cls.post(
+            'sale_return', sale_return.id, 'return',
+            f'مرتجع بيع #{sale_return.return_number} - {sale_return.customer.name}',
+            lines,
+            user=user or sale_return.created_by,
+            company=company
+        )
+
+    @classmethod
+    def post_purchase_return(cls, purchase_return, user=None):
+        """قيد مرتجع الشراء: المورد / المخزون"""
+        from .models import get_or_create_supplier_account, get_or_create_account
+
+        company = purchase_return.company
+        supplier_account = get_or_create_supplier_account(purchase_return.supplier)
+        inventory_account = get_or_create_account('1301', 'مخزون البضاعة', 'asset', company)
+        reference = f'مرتجع شراء #{purchase_return.return_number}'
+
+        return cls.post(
+            'purchase_return', purchase_return.id, 'return',
+            f'مرتجع شراء #{purchase_return.return_number} - {purchase_return.supplier.name}',
+            [
+                {'account': supplier_account, 'debit': purchase_return.total_amount, 'credit': 0, 'description': reference},
+                {'account': inventory_account, 'debit': 0, 'credit': purchase_return.total_amount, 'description': reference},
+            ],
+            user=user or purchase_return.created_by,
+            company=company
+        )
+
+    @classmethod
+    def post_customer_payment(cls, payment, user=None):
+        """قيد دفعة العميل: النقدية / العميل"""
+        from .models import get_or_create_customer_account, get_or_create_account
+
+        company = payment.customer.company
+        customer_account = get_or_create_customer_account(payment.customer)
+        cash_account = get_or_create_account('1001', 'النقدية', 'asset', company)
+        reference = f'دفعة من {payment.customer.name} #{payment.payment_number}'
+
+        return cls.post(
+            'customer_payment', payment.id, 'voucher',
+            f'دفعة من العميل {payment.customer.name} - #{payment.payment_number}',
+            [
+                {'account': cash_account, 'debit': payment.amount, 'credit': 0, 'description': reference},
+                {'account': customer_account, 'debit': 0, 'credit': payment.amount, 'description': reference},
+            ],
+            user=user or payment.created_by,
+            company=company
+        )
+
+    @classmethod
+    def post_supplier_payment(cls, payment, user=None):
+        """قيد دفعة المورد: المورد / النقدية"""
+        from .models import get_or_create_supplier_account, get_or_create_account
+
+        company = payment.supplier.company
+        supplier_account = get_or_create_supplier_account(payment.supplier)
+        cash_account = get_or_create_account('1001', 'النقدية', 'asset', company)
+        reference = f'دفعة للمورد {payment.supplier.name} #{payment.payment_number}'
+
+        return cls.post(
+            'supplier_payment', payment.id, 'voucher',
+            f'دفعة للمورد {payment.supplier.name} - #{payment.payment_number}',
+            [
+                {'account': supplier_account, 'debit': payment.amount, 'credit': 0, 'description': reference},
+                {'account': cash_account, 'debit': 0, 'credit': payment.amount, 'description': reference},
+            ],
+            user=user or payment.created_by,
+            company=company
+        )
+
+    @classmethod
+    def post_sales_commission(cls, sale, sales_rep, user=None):
+        """قيد عمولة المندوب للفاتورة: عمولات المبيعات / عمولات مستحقة، أو None بدون نسبة عمولة"""
+        from .models import get_or_create_account
+
+        commission_rate = getattr(sales_rep, 'commission_rate', None) or _ZERO
+        if commission_rate <= 0:
+            return None
+
+        company = sale.company
+        commission_amount = sale.total_amount * (commission_rate / 100)
+        expense_account = get_or_create_account('5202', 'عمولات المبيعات', 'expense', company)
+        payable_account = get_or_create_account('2102', 'عمولات مستحقة الدفع', 'liability', company)
+
+        return cls.post(
+            'sales_commission', sale.id, 'expense',
+            f'عمولة مندوب المبيعات - فاتورة #{sale.invoice_number}',
+            [
+                {'account': expense_account, 'debit': commission_amount, 'credit': 0,
+                 'description': 'عمولة مندوب المبيعات'},
+                {'account': payable_account, 'debit': 0, 'credit': commission_amount,
+                 'description': 'عمولة مستحقة الدفع'},
+            ],
+            user=user or sale.created_by,
+            company=company
+        )
+
+    @staticmethod
+    def salary_accounts(company=None):
+        """حسابا قيد الراتب (مرة واحدة لكل مسير رواتب)"""
+        from .models import get_or_create_account
+
+        return (
+            get_or_create_account('5201', 'مصروف الرواتب', 'expense', company),
+            get_or_create_account('1001', 'النقدية', 'asset', company),
+        )
+
+    @classmethod
+    def salary_event(cls, salary, user=None, accounts=None):
+        """حدث قيد الراتب: مصروف الرواتب / النقدية"""
+        company = salary.company_id
+        salary_account, cash_account = accounts or cls.salary_accounts(salary.company)
+        employee_name = salary.employee.get_full_name() or salary.employee.username
+        return cls.event(
+            'salary', salary.id, 'salary',
+            f'راتب {employee_name} - {salary.month}/{salary.year}',
+            [
+                {'account': salary_account, 'debit': salary.net_salary, 'credit': 0,
+                 'description': f'راتب {employee_name}'},
+                {'account': cash_account, 'debit': 0, 'credit': salary.net_salary,
+                 'description': f'صرف راتب {employee_name}'},
+            ],
+            user=user or salary.created_by,
+            company=company
+        )
+
+    @classmethod
+    def salary_events(cls, salaries, user=None):
+        """أحداث قيود مسير الرواتب (الحسابات تجلب مرة واحدة لكل شركة)"""
+        accounts = {}
+        events = []
+        for salary in salaries:
+            if salary.company_id not in accounts:
+                accounts[salary.company_id] = cls.salary_accounts(salary.company)
+            events.append(cls.salary_event(salary, user, accounts[salary.company_id]))
+        return events
+
+    @classmethod
+    def post_salaries(cls, salaries, user=None):
+        """قيود مسير رواتب كامل بدفعة واحدة"""
+        return cls.post_many(cls.salary_events(salaries, user))
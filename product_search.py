@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+فهرس البحث في المنتجات (SQLite FTS5)
+
+جدول FTS5 في قاعدة بيانات كل شركة يحفظ النص المطبع لاسم المنتج والباركود
+والفئة والماركة (rowid = رقم المنتج)، فالبحث في نقطة البيع مع كل حرف يقرأ
+الفهرس بدلاً من LIKE '%q%' على جدول المنتجات كاملاً:
+- التطبيع العربي: الألف والهمزات (أ إ آ ٱ ← ا، ؤ ← و، ئ ى ← ي)، التاء
+  المربوطة (ة ← ه)، التشكيل والتطويل، والأرقام العربية ← 0-9
+- أداة التعريف: الكلمات التي تبدأ بـ "ال" تفهرس بها وبدونها، وتحذف من كلمات
+  البحث، فـ "مراعي" و "المراعي" و "المرا" تطابق "حليب المراعي"
+- كل كلمة في البحث بادئة ("كلمة"*) وجميع الكلمات مطلوبة
+- الترتيب bm25 مع وزن أعلى للاسم والباركود
+
+المنتجات النشطة فقط في الفهرس، والمزامنة عند حفظ أو حذف المنتج. التعديلات
+الجماعية (update / bulk_create) لا ترسل إشارات: python manage.py rebuild_product_search
+"""
+import re
+
+from django.db import connections, OperationalError, DatabaseError
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .database_router import get_current_db_alias
+
+TABLE = 'core_product_search'
+DEFAULT_LIMIT = 20
+
+# أوزان bm25 بترتيب الأعمدة: name, barcode, category, brand
+_WEIGHTS = (10.0, 8.0, 2.0, 3.0)
+
+_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+_LETTERS = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ؤ': 'و', 'ئ': 'ي', 'ى': 'ي', 'ة': 'ه',
+    **{chr(0x0660 + digit): str(digit) for digit in range(10)},
+    **{chr(0x06f0 + digit): str(digit) for digit in range(10)},
+})
+_TOKEN = re.compile(r'\w+')
+_ARTICLE = 'ال'
+
+# قواعد البيانات التي تم التحقق من وجود الفهرس فيها في هذه العملية
+_ready = {}
+
+
+def normalize_arabic(text):
+    """تطبيع النص للبحث (نفس التطبيع للفهرس ولنص البحث)"""
+    if not text:
+        return ''
+    return _DIACRITICS.sub('', str(text)).translate(_LETTERS).lower()
+
+
+def _without_article(word):
+    if word.startswith(_ARTICLE) and len(word) > len(_ARTICLE) + 1:
+        return word[len(_ARTICLE):]
+    return None
+
+
+def index_text(text):
+    """النص المطبع كما يحفظ في الفهرس مع الكلمات بدون أداة التعريف"""
+    normalized = normalize_arabic(text)
+    extra = [word for word in map(_without_article, _TOKEN.findall(normalized)) if word]
+    return ' '.join([normalized] + extra) if extra else normalized
+
+
+def build_match(query):
+    """نص MATCH من نص البحث: كل كلمة بادئة، أو None إذا لم توجد كلمات"""
+    tokens = [
+        _without_article(token) or token
+        for token in _TOKEN.findall(normalize_arabic(query))
+    ]
+    if not tokens:
+        return None
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+class ProductSearchIndex:
+    """فهرس FTS5 للمنتجات في قاعدة بيانات الشركة الحالية"""
+
+    @staticmethod
+    def _row(product):
+        return [
+            product.pk,
+            product.company_id,
+            index_text(product.name),
+            normalize_arabic(product.barcode),
+            index_text(product.category),
+            index_text(getattr(product, 'brand', '')),
+        ]
+
+    @classmethod
+    def ensure(cls, using=None):
+        """
+        إنشاء الفهرس إذا لم يكن موجوداً (وتعبئته من المنتجات)
+
+        يرجع False إذا كانت قاعدة البيانات ليست SQLite أو بدون FTS5، وعندها
+        يستخدم البحث العادي.
+        """
+        db = using or get_current_db_alias()
+        if db in _ready:
+            return _ready[db]
+
+        connection = connections[db]
+        if connection.vendor != 'sqlite':
+            _ready[db] = False
+            return False
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [TABLE])
+                exists = cursor.fetchone() is not None
+                if not exists:
+                    cursor.execute(
+                        f"CREATE VIRTUAL TABLE {TABLE} USING fts5("
+                        f"company_id UNINDEXED, name, barcode, category, brand, "
+                        f"tokenize = 'unicode61 remove_diacritics 2')"
+                    )
+        except OperationalError as e:
+            print(f"FTS5 غير متاح في {db}: {e}")
+            _ready[db] = False
+            return False
+
+        _ready[db] = True
+        if not exists:
+            cls.rebuild(using=db)
+        return True
+
+    @classmethod
+    def rebuild(cls, using=None, batch_size=1000):
+        """إعادة تعبئة الفهرس من جميع المنتجات النشطة، يرجع عدد المنتجات"""
+        from .models import Product
+
+        db = using or get_current_db_alias()
+        if not cls.ensure(db):
+            return 0
+
+        products = Product._base_manager.using(db).filter(is_active=True).only(
+            'id', 'company_id', 'name', 'barcode', 'category', 'brand'
+        ).order_by('id')
+        count = 0
+        with connections[db].cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TABLE}")
+            batch = []
+            for product in products.iterator(chunk_size=batch_size):
+                batch.append(cls._row(product))
+                if len(batch) >= batch_size:
+                    cls._insert(cursor, batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                cls._insert(cursor, batch)
+                count += len(batch)
+            # دمج أجزاء الفهرس بعد التعبئة الكاملة
+            cursor.execute(f"INSERT INTO {TABLE}({TABLE}) VALUES ('optimize')")
+        return count
+
+    @staticmethod
+    def _insert(cursor, rows):
+        cursor.executemany(
+            f"INSERT INTO {TABLE}(rowid, company_id, name, barcode, category, brand) VALUES (%s, %s, %s, %s, %s, %s)",
+            rows
+        )
+
+    @classmethod
+    def update(cls, product, using=None):
+        """تحديث المنتج في الفهرس (حذفه إذا أصبح غير نشط)"""
+        db = using or get_current_db_alias()
+        if not cls.ensure(db):
+            return
+        with connections[db].cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TABLE} WHERE rowid = %s", [product.pk])
+            if product.is_active:
+                cls._insert(cursor, [cls._row(product)])
+
+    @classmethod
+    def remove(cls, product_id, using=None):
+        db = using or get_current_db_alias()
+        if not cls.ensure(db):
+            return
+        with connections[db].cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TABLE} WHERE rowid = %s", [product_id])
+
+    @classmethod
+    def search(cls, query, limit=DEFAULT_LIMIT, company_id=None, using=None):
+        """
+        أرقام المنتجات المطابقة مرتبة حسب bm25
+
+        يرجع None إذا لم يكن الفهرس متاحاً (ليستخدم البحث العادي)، و [] إذا لم
+        يحتو نص البحث على كلمات.
+        """
+        db = using or get_current_db_alias()
+        if not cls.ensure(db):
+            return None
+        match = build_match(query)
+        if match is None:
+            return []
+
+        sql = f"SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s"
+        params = [match]
+        if company_id:
+            sql += " AND company_id = %s"
+            params.append(company_id)
+        weights = ', '.join(str(weight) for weight in _WEIGHTS)
+        # العمود الأول (company_id) غير مفهرس ووزنه صفر
+        sql += f" ORDER BY bm25({TABLE}, 0.0, {weights}) LIMIT %s"
+        params.append(limit)
+        try:
+            with connections[db].cursor() as cursor:
+                cursor.execute(sql, params)
+                return [row[0] for row in cursor.fetchall()]
+        except DatabaseError as e:
+            print(f"خطأ في البحث في فهرس المنتجات: {e}")
+            return None
+
+    @classmethod
+    def search_products(cls, query, limit=DEFAULT_LIMIT, company_id=None, using=None):
+        """المنتجات المطابقة بترتيب الفهرس، أو None إذا لم يكن الفهرس متاحاً"""
+        from .models import Product
+
+        db = using or get_current_db_alias()
+        ids = cls.search(query, limit, company_id, db)
+        if ids is None:
+            return None
+        products = Product._base_manager.using(db).in_bulk(ids)
+        return [products[product_id] for product_id in ids if product_id in products]
+
+
+@receiver(post_save, sender='core.Product')
+def product_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    try:
+        ProductSearchIndex.update(instance, kwargs.get('using'))
+    except DatabaseError as e:
+        print(f"خطأ في تحديث فهرس البحث للمنتج {instance.pk}: {e}")
+
+
+@receiver(post_delete, sender='core.Product')
+def product_deleted(sender, instance, **kwargs):
+    try:
+        ProductSearchIndex.remove(instance.pk, kwargs.get('using'))
+    except DatabaseError as e:
+        print(f"خطأ في حذف المنتج {instance.pk} من فهرس البحث: {e}")
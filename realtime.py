@@ -78,7 +78,13 @@ class RealtimeManager:
 def product_saved(sender, instance, **kwargs):
     RealtimeManager.notify_product_update(instance)
 
+def notify_sale_created_job(sale_id, instance=None):
+    from .models import Sale
+    sale = instance or Sale.objects.select_related('customer').get(pk=sale_id)
+    RealtimeManager.notify_sale_created(sale)
+
 @receiver(post_save, sender='core.Sale')
 def sale_saved(sender, instance, created, **kwargs):
     if created:
-        RealtimeManager.notify_sale_created(instance)
\ No newline at end of file
+        from .job_queue import JobQueue
+        JobQueue.dispatch(notify_sale_created_job, instance=instance, sale_id=instance.id)
\ No newline at end of file
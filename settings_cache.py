@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+ذاكرة الإعدادات المؤقتة
+
+1) لقطة الإعدادات لكل شركة (SettingsSnapshot)
+
+الإعدادات تأتي من مصدرين: ملف app_settings.json (صفحة الإعدادات) وجدول Setting
+(عامة ثم خاصة بالشركة). يتم تحميل المصدرين مرة واحدة لكل إصدار في ذاكرة العملية،
+وكل طلب يحصل على اللقطة مرة واحدة فقط عن طريق get_request_settings(request).
+
+الإصدار محفوظ في cache الخاص بـ Django ويتم زيادته عند حفظ أو حذف أي Setting
+أو حفظ ملف الإعدادات، فتعيد جميع العمليات تحميل اللقطة في الطلب التالي.
+عند دفء الكاش لا يتم تنفيذ أي استعلام للإعدادات أثناء عرض الصفحة.
+
+2) محرك الإعدادات (SettingsEngine) المستخدم من SettingsManager و
+DynamicSettingsManager: ذاكرة LRU محدودة الحجم والمدة داخل العملية أمام cache
+الخاص بـ Django، والمفاتيح تحتوي على إصدار الشركة فتغيير الإصدار من أي عملية
+يبطل القيم القديمة في جميع العمليات.
+"""
+import threading
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver, Signal
+
+from .database_router import get_current_db_alias
+from .versioned_cache import LRUCache, get_versions, bump_version
+
+VERSION_PREFIX = 'settings_version'
+FILE_SCOPE = 'file'
+
+# إشارة تغيير إعداد (تُرسل داخل العملية، والعمليات الأخرى تعتمد على الإصدار)
+setting_changed = Signal()
+
+# اللقطات المحملة في هذه العملية: (alias, company_id) -> SettingsSnapshot
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def _version_key(*parts):
+    return ':'.join([VERSION_PREFIX] + [str(part) for part in parts])
+
+
+def scope_version_key(alias, company_id=None):
+    """مفتاح إصدار إعدادات قاعدة بيانات وشركة (أو الإعدادات العامة)"""
+    return _version_key(alias, company_id or 'global')
+
+
+def file_version_key():
+    return _version_key(FILE_SCOPE)
+
+
+def bump_settings_version(alias=None, company_id=None):
+    """إبطال إعدادات شركة (أو الإعدادات العامة لقاعدة البيانات)"""
+    bump_version(scope_version_key(alias or get_current_db_alias(), company_id))
+
+
+def bump_file_settings_version():
+    """إبطال الإعدادات المحفوظة في ملف app_settings.json"""
+    bump_version(file_version_key())
+
+
+class SettingsSnapshot:
+    """
+    الإعدادات الفعالة لشركة في لحظة معينة
+
+    raw: قيم ملف app_settings.json كما هي (نفس ما كانت ترجعه get_setting)،
+    والملف هو المرجع فلا تغيرها صفوف Setting، والقيمة '' قيمة حقيقية
+    typed: القيم بعد Setting.get_value() للاستخدام في القوالب، بأولوية الملف ثم
+    إعدادات Setting العامة ثم إعدادات الشركة (كما كانت في القوالب).
+    """
+
+    def __init__(self, raw, typed):
+        self.raw = raw
+        self.typed = typed
+
+    def get(self, key, default=None):
+        value = self.raw.get(key)
+        return default if value is None else value
+
+    def get_typed(self, key, default=None):
+        value = self.typed.get(key)
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return key in self.raw
+
+    @classmethod
+    def load(cls, alias, company_id=None):
+        from .models import Setting
+        from .settings_helper import get_all_settings
+
+        raw = dict(get_all_settings())
+        typed = dict(raw)
+
+        scope = Q(company__isnull=True)
+        if company_id:
+            scope |= Q(company_id=company_id)
+        rows = Setting.objects.using(alias).filter(scope, branch__isnull=True)
+        # الإعدادات العامة أولاً ثم إعدادات الشركة لتكون لها الأولوية
+        for setting in sorted(rows, key=lambda setting: setting.company_id is not None):
+            typed[setting.key] = setting.get_value()
+
+        return cls(raw, typed)
+
+
+def get_settings_snapshot(company_id=None, alias=None):
+    """لقطة الإعدادات للشركة من ذاكرة العملية، وإعادة تحميلها إذا تغير الإصدار"""
+    alias = alias or get_current_db_alias()
+    versions = get_versions([file_version_key(), scope_version_key(alias), scope_version_key(alias, company_id)])
+
+    if None in versions:
+        # الكاش لا يحفظ القيم (مثل DummyCache) فلا يمكن معرفة التغييرات
+        return SettingsSnapshot.load(alias, company_id)
+
+    cache_key = (alias, company_id)
+    entry = _snapshots.get(cache_key)
+    if entry is not None and entry[0] == versions:
+        return entry[1]
+
+    snapshot = SettingsSnapshot.load(alias, company_id)
+    with _snapshots_lock:
+        _snapshots[cache_key] = (versions, snapshot)
+    return snapshot
+
+
+def currency_quantum(company_id=None, alias=None):
+    """أصغر وحدة في العملة حسب إعداد decimal_places (0.01 إذا لم يكن صالحاً)"""
+    try:
+        places = max(int(get_settings_snapshot(company_id, alias).get('decimal_places', 2)), 0)
+    except (TypeError, ValueError):
+        places = 2
+    return Decimal(1).scaleb(-places)
+
+
+def to_money(value, quantum):
+    """
+    مبلغ من استعلام SQL خام إلى Decimal بدقة العملة
+
+    SQLite يرجع الأعمدة العشرية و SUM() كـ float، و Decimal(float) يحفظ خطأ
+    التمثيل الثنائي (12.1 + 0.2 = 12.2999...)، لذلك التحويل عن طريق str.
+    """
+    return Decimal(str(value or 0)).quantize(quantum)
+
+
+def _request_company_id(request):
+    company = getattr(request, 'company', None)
+    if company is not None:
+        return company.id
+    session = getattr(request, 'session', None)
+    return session.get('company_id') if session is not None else None
+
+
+def get_request_settings(request):
+    """لقطة الإعدادات للطلب الحالي (يتم تحميلها مرة واحدة لكل طلب)"""
+    snapshot = getattr(request, '_settings_snapshot', None)
+    if snapshot is None:
+        snapshot = get_settings_snapshot(_request_company_id(request))
+        request._settings_snapshot = snapshot
+    return snapshot
+
+
+class SettingsEngine:
+    """
+    قراءة الإعدادات بأولوية: الفرع ثم الشركة ثم الإعدادات العامة
+
+    المستوى الأول LRU داخل العملية، والثاني cache الخاص بـ Django، وكلاهما
+    بمفاتيح تحتوي على إصدار النطاق. القيم غير الموجودة تُحفظ أيضاً حتى لا
+    يتكرر الاستعلام عنها.
+    """
+
+    CACHE_PREFIX = 'setting'
+    CACHE_TIMEOUT = 3600
+
+    local = LRUCache(
+        maxsize=getattr(settings, 'SETTINGS_LOCAL_CACHE_SIZE', 2048),
+        ttl=getattr(settings, 'SETTINGS_LOCAL_CACHE_TTL', 60)
+    )
+
+    @staticmethod
+    def _scope(company=None, branch=None):
+        company_id = getattr(company, 'id', company)
+        branch_id = getattr(branch, 'id', branch)
+        if company_id is None and branch is not None:
+            company_id = getattr(branch, 'company_id', None)
+        if company_id is None:
+            current = getattr(threading.current_thread(), 'current_company', None)
+            company_id = getattr(current, 'id', None)
+        return company_id, branch_id
+
+    @classmethod
+    def _cache_key(cls, alias, company_id, branch_id, versions, key):
+        version = '.'.join(str(v) for v in versions)
+        return f"{cls.CACHE_PREFIX}:{alias}:{company_id or 'global'}:{branch_id or 'global'}:v{version}:{key}"
+
+    @staticmethod
+    def _rank(setting, company_id, branch_id):
+        """ترتيب أولوية الإعداد للنطاق المطلوب (None إذا لا ينطبق)"""
+        if branch_id and setting.branch_id == branch_id:
+            return 0
+        if setting.branch_id is None and company_id and setting.company_id == company_id:
+            return 1
+        if setting.branch_id is None and setting.company_id is None:
+            return 2
+        if setting.is_global:
+            return 3
+        return None
+
+    @classmethod
+    def _load(cls, alias, keys, company_id, branch_id):
+        """جلب عدة مفاتيح من قاعدة البيانات باستعلام واحد"""
+        from .models import Setting
+
+        scope = Q(branch__isnull=True, company__isnull=True) | Q(is_global=True)
+        if company_id:
+            scope |= Q(branch__isnull=True, company_id=company_id)
+        if branch_id:
+            scope |= Q(branch_id=branch_id)
+
+        best = {}
+        for setting in Setting.objects.using(alias).filter(scope, key__in=keys):
+            rank = cls._rank(setting, company_id, branch_id)
+            if rank is None:
+                continue
+            if setting.key not in best or rank < best[setting.key][0]:
+                best[setting.key] = (rank, setting)
+
+        return {key: (True, setting.get_value()) for key, (rank, setting) in best.items()}
+
+    @classmethod
+    def get_multiple(cls, keys, company=None, branch=None, defaults=None):
+        """الحصول على عدة إعدادات: عملية كاش واحدة واستعلام واحد كحد أقصى"""
+        defaults = defaults or {}
+        alias = get_current_db_alias()
+        company_id, branch_id = cls._scope(company, branch)
+        versions = get_versions([scope_version_key(alias), scope_version_key(alias, company_id)])
+        if None in versions:
+            found = cls._load(alias, list(keys), company_id, branch_id)
+            return {key: found[key][1] if key in found else defaults.get(key) for key in keys}
+
+        cache_keys = {key: cls._cache_key(alias, company_id, branch_id, versions, key) for key in keys}
+        entries = {}
+
+        # المستوى الأول: ذاكرة العملية
+        for key, cache_key in cache_keys.items():
+            entry = cls.local.get(cache_key)
+            if entry is not None:
+                entries[key] = entry
+
+        # المستوى الثاني: cache الخاص بـ Django
+        pending = [key for key in keys if key not in entries]
+        if pending:
+            shared = cache.get_many([cache_keys[key] for key in pending])
+            for key in pending:
+                entry = shared.get(cache_keys[key])
+                if entry is not None:
+                    entries[key] = entry
+                    cls.local.set(cache_keys[key], entry)
+
+        # قاعدة البيانات
+        pending = [key for key in keys if key not in entries]
+        if pending:
+            found = cls._load(alias, pending, company_id, branch_id)
+            loaded = {key: found.get(key, (False, None)) for key in pending}
+            cache.set_many({cache_keys[key]: entry for key, entry in loaded.items()}, cls.CACHE_TIMEOUT)
+            for key, entry in loaded.items():
+                cls.local.set(cache_keys[key], entry)
+            entries.update(loaded)
+
+        return {
+            key: entries[key][1] if entries[key][0] else defaults.get(key)
+            for key in keys
+        }
+
+    @classmethod
+    def get(cls, key, company=None, branch=None, default=None):
+        return cls.get_multiple([key], company, branch, {key: default})[key]
+
+    @classmethod
+    def invalidate(cls, company=None, branch=None):
+        """إبطال إعدادات النطاق في جميع العمليات"""
+        company_id, branch_id = cls._scope(company, branch)
+        bump_settings_version(company_id=company_id)
+
+    @classmethod
+    def broadcast(cls, key, value, company=None, branch=None, deleted=False):
+        """إبلاغ جميع العمليات بتغيير إعداد"""
+        cls.invalidate(company, branch)
+        setting_changed.send(sender=cls, key=key, value=value, branch=branch, deleted=deleted)
+
+
+@receiver(post_save, sender='core.Setting')
+@receiver(post_delete, sender='core.Setting')
+def invalidate_settings_snapshot(sender, instance, **kwargs):
+    """زيادة إصدار إعدادات الشركة عند أي تعديل"""
+    bump_settings_version(kwargs.get('using'), instance.company_id)
@@ -7,6 +7,11 @@ from django.conf import settings
 
 SETTINGS_FILE = os.path.join(settings.BASE_DIR, 'app_settings.json')
 
+def _invalidate_snapshots():
+    """إبطال لقطات الإعدادات في جميع العمليات بعد تعديل الملف"""
+    from .settings_cache import bump_file_settings_version
+    bump_file_settings_version()
+
 def save_setting(key, value):
     """حفظ إعداد في ملف JSON"""
     try:
@@ -24,6 +29,7 @@ def save_setting(key, value):
         with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
             json.dump(current_settings, f, ensure_ascii=False, indent=2)
         
+        _invalidate_snapshots()
         return True
     except Exception as e:
         print(f"خطأ في حفظ الإعداد {key}: {e}")
@@ -46,6 +52,7 @@ def save_all_settings(settings_dict):
     try:
         with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
             json.dump(settings_dict, f, ensure_ascii=False, indent=2)
+        _invalidate_snapshots()
         return True
     except Exception as e:
         print(f"خطأ في حفظ الإعدادات: {e}")
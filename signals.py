@@ -14,10 +14,11 @@
 
 #from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
-from django.db import transaction
 from django.core.cache import cache
 import logging
 
+from .database_router import company_atomic
+
 # إعداد نظام التسجيل
 logger = logging.getLogger('erp_signals')
 
@@ -42,7 +43,7 @@ def get_models():
     """
     if instance.status == 'confirmed' and hasattr(instance, '_just_confirmed'):
         try:
-            with transaction.atomic():
+            with company_atomic():
                 from .inventory import InventoryManager
                 from .accounting import AccountingEngine
                 
@@ -81,7 +82,7 @@ def get_models():
     """
     if instance.status == 'confirmed' and hasattr(instance, '_just_confirmed'):
         try:
-            with transaction.atomic():
+            with company_atomic():
                 from .inventory import InventoryManager
                 from .accounting import AccountingEngine
                 
@@ -118,7 +119,7 @@ def get_models():
     """
     if created:
         try:
-            with transaction.atomic():
+            with company_atomic():
                 from .inventory import InventoryManager
                 
                 InventoryManager.update_stock(
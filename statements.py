@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+كشوف حساب العملاء والموردين
+
+الكشف استعلام UNION ALL واحد (الفواتير المؤكدة + الدفعات) مرتب من الأحدث بمفتاح
+(التاريخ، النوع، الرقم)، والرصيد الجاري يحسب داخل قاعدة البيانات بدالة نافذة
+SUM() OVER، والصفحات بمفتاح آخر صف (keyset) بدلاً من OFFSET، فتحميل الصفحة
+الأولى لعميل لديه عشرات الآلاف من الفواتير لا يقرأ إلا صفوف الصفحة.
+
+الرصيد أعلى الصفحة:
+- الصفحة الأولى: الرصيد النهائي (الرصيد الافتتاحي + مجموع الحركات)
+- الصفحات التالية: الرصيد قبل آخر صف في الصفحة السابقة
+
+الرقمان محفوظان في الكاش بإصدار خاص بالعميل/المورد يزيد مع أي تعديل على
+فواتيره أو دفعاته أو رصيده الافتتاحي، ويتم حفظ رصيد الصفحة التالية عند عرض
+الصفحة الحالية فلا يحتاج التنقل لأي استعلام تجميع.
+"""
+from datetime import date
+
+from django.core.cache import cache
+from django.db import connections
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .database_router import get_current_db_alias
+from .settings_cache import currency_quantum, to_money
+from .versioned_cache import get_versions, bump_version
+
+CACHE_TIMEOUT = 3600
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# نوع الحركة في مفتاح الترتيب: الفاتورة قبل الدفعة في نفس اليوم
+DOCUMENT_KIND = 0
+PAYMENT_KIND = 1
+
+
+def statement_version_key(alias, party_type, party_id):
+    return f"statement_version:{alias}:{party_type}:{party_id}"
+
+
+def invalidate_statement(party_type, party_id, alias=None):
+    """إبطال أرصدة كشف الحساب المحفوظة في جميع العمليات"""
+    bump_version(statement_version_key(alias or get_current_db_alias(), party_type, party_id))
+
+
+# الحركات الأقدم من المفتاح (d, kind, id) بترتيب الكشف
+_KEYSET_BEFORE = "(d < %s OR (d = %s AND (kind < %s OR (kind = %s AND id < %s))))"
+
+
+def _keyset_params(cursor):
+    day, kind, row_id = cursor
+    return [day, day, kind, kind, row_id]
+
+
+def encode_cursor(row):
+    """مفتاح الصفحة التالية من آخر صف: YYYY-MM-DD.kind.id"""
+    return f"{row['date'].isoformat()}.{row['kind']}.{row['id']}"
+
+
+def decode_cursor(cursor):
+    """(date, kind, id) أو None إذا كان المفتاح غير صالح"""
+    try:
+        day, kind, row_id = cursor.split('.')
+        return date.fromisoformat(day), int(kind), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+class PartyStatement:
+    """
+    كشف حساب عميل أو مورد
+
+    sign: اتجاه الرصيد (العميل مدين: الفاتورة تزيد الرصيد، المورد دائن: الفاتورة
+    تزيد الرصيد المستحق له).
+    """
+
+    def __init__(self, party_type, party, document_model, payment_model, document_label, sign):
+        self.party_type = party_type
+        self.party = party
+        self.document_model = document_model
+        self.payment_model = payment_model
+        self.document_label = document_label
+        self.sign = sign
+        self._quantum = None
+
+    @classmethod
+    def for_customer(cls, customer):
+        from .models import Sale, CustomerPayment
+        return cls('customer', customer, Sale, CustomerPayment, 'فاتورة بيع', 1)
+
+    @classmethod
+    def for_supplier(cls, supplier):
+        from .models import Purchase, SupplierPayment
+        return cls('supplier', supplier, Purchase, SupplierPayment, 'فاتورة شراء', -1)
+
+    def _union_sql(self, connection, cursor=None, limit=None):
+        """
+        استعلام الحركات: (d, kind, id, number, method, debit, credit)
+
+        مع cursor و limit يتم تطبيق المفتاح والحد داخل كل جزء من UNION، فلا
+        يرتب إلا limit صف من كل جدول.
+        """
+        qn = connection.ops.quote_name
+        party_column = qn(f'{self.party_type}_id')
+        # الفاتورة للعميل مدين وللمورد دائن، والدفعة عكسها
+        document_debit, document_credit = ('total_amount', '0') if self.sign > 0 else ('0', 'total_amount')
+        payment_debit, payment_credit = ('0', 'amount') if self.sign > 0 else ('amount', '0')
+        branches = [
+            (
+                f"SELECT DATE(created_at) AS d, {DOCUMENT_KIND} AS kind, id, invoice_number AS number, "
+                f"'' AS method, {document_debit} AS debit, {document_credit} AS credit "
+                f"FROM {qn(self.document_model._meta.db_table)} WHERE {party_column} = %s AND status = 'confirmed'"
+            ),
+            (
+                f"SELECT payment_date AS d, {PAYMENT_KIND} AS kind, id, payment_number AS number, "
+                f"payment_method AS method, {payment_debit} AS debit, {payment_credit} AS credit "
+                f"FROM {qn(self.payment_model._meta.db_table)} WHERE {party_column} = %s"
+            ),
+        ]
+
+        parts = []
+        params = []
+        for branch in branches:
+            branch_params = [self.party.pk]
+            if cursor is not None or limit is not None:
+                branch = f"SELECT * FROM ({branch}) b"
+                if cursor is not None:
+                    branch += f" WHERE {_KEYSET_BEFORE}"
+                    branch_params += _keyset_params(cursor)
+                if limit is not None:
+                    branch += " ORDER BY d DESC, kind DESC, id DESC LIMIT %s"
+                    branch_params.append(limit)
+                branch = f"SELECT * FROM ({branch}) p"
+            parts.append(branch)
+            params += branch_params
+        return " UNION ALL ".join(parts), params
+
+    def _version(self, alias):
+        return get_versions([statement_version_key(alias, self.party_type, self.party.pk)])[0]
+
+    def _money(self, value):
+        """قيمة من الاستعلام الخام بدقة عملة الشركة"""
+        if self._quantum is None:
+            self._quantum = currency_quantum(getattr(self.party, 'company_id', None))
+        return to_money(value, self._quantum)
+
+    def _amount(self, debit, credit):
+        """أثر الحركة على الرصيد حسب اتجاه الكشف"""
+        return self.sign * (self._money(debit) - self._money(credit))
+
+    def _balance_before(self, cursor, alias):
+        """
+        الرصيد قبل الحركة cursor (أو الرصيد النهائي إذا كان cursor = None)
+
+        الرصيد الافتتاحي + مجموع الحركات حتى ما قبل cursor، باستعلام تجميع واحد.
+        """
+        connection = connections[alias]
+        union_sql, params = self._union_sql(connection)
+        sql = f"SELECT SUM(debit), SUM(credit) FROM ({union_sql}) tx"
+        if cursor is not None:
+            # الحركات الأقدم من cursor
+            sql += f" WHERE {_KEYSET_BEFORE}"
+            params += _keyset_params(cursor)
+        with connection.cursor() as db_cursor:
+            db_cursor.execute(sql, params)
+            debit, credit = db_cursor.fetchone()
+        return self._money(self.party.opening_balance) + self._amount(debit, credit)
+
+    def _cached_balance(self, cursor_token, cursor, alias, version):
+        key = f"statement_balance:{alias}:{self.party_type}:{self.party.pk}:{cursor_token or 'top'}:v{version}"
+        balance = cache.get(key)
+        if balance is None:
+            balance = self._balance_before(cursor, alias)
+            cache.set(key, balance, CACHE_TIMEOUT)
+        return balance
+
+    def page(self, cursor_token=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        صفحة من الكشف (الأحدث أولاً)
+
+        يرجع dict فيه transactions و opening_balance و final_balance و next_cursor.
+        """
+        alias = get_current_db_alias()
+        limit = max(1, min(int(limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+        cursor = decode_cursor(cursor_token) if cursor_token else None
+        if cursor is None:
+            cursor_token = None
+        version = self._version(alias)
+
+        final_balance = self._cached_balance(None, None, alias, version)
+        top_balance = final_balance if cursor is None else self._cached_balance(cursor_token, cursor, alias, version)
+
+        connection = connections[alias]
+        union_sql, params = self._union_sql(connection, cursor, limit + 1)
+        sql = (
+            f"SELECT d, kind, id, number, method, debit, credit, "
+            f"SUM(debit - credit) OVER (ORDER BY d DESC, kind DESC, id DESC "
+            f"ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS newer "
+            f"FROM ({union_sql}) tx ORDER BY d DESC, kind DESC, id DESC LIMIT %s"
+        )
+        params.append(limit + 1)
+
+        with connection.cursor() as db_cursor:
+            db_cursor.execute(sql, params)
+            rows = db_cursor.fetchall()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        payment_methods = dict(self.payment_model.PAYMENT_METHODS)
+        transactions = []
+        for day, kind, row_id, number, method, debit, credit, newer in rows:
+            if isinstance(day, str):
+                day = date.fromisoformat(day[:10])
+            debit = self._money(debit)
+            credit = self._money(credit)
+            is_document = kind == DOCUMENT_KIND
+            transactions.append({
+                'date': day,
+                'kind': kind,
+                'id': row_id,
+                'description': f'{self.document_label} #{number}' if is_document else f'دفعة #{number}',
+                'debit': debit,
+                'credit': credit,
+                'type': ('sale' if self.party_type == 'customer' else 'purchase') if is_document else 'payment',
+                'payment_method': '-' if is_document else payment_methods.get(method, method),
+                # الحركات الأحدث في نفس الصفحة تطرح من رصيد أعلى الصفحة
+                'balance': top_balance - self.sign * self._money(newer),
+            })
+
+        next_cursor = None
+        if has_more and transactions:
+            last = transactions[-1]
+            next_cursor = encode_cursor(last)
+            # الرصيد أعلى الصفحة التالية معروف الآن فيحفظ بدون استعلام
+            cache.set(
+                f"statement_balance:{alias}:{self.party_type}:{self.party.pk}:{next_cursor}:v{version}",
+                last['balance'] - self._amount(last['debit'], last['credit']),
+                CACHE_TIMEOUT
+            )
+
+        return {
+            'transactions': transactions,
+            'opening_balance': self.party.opening_balance,
+            'final_balance': final_balance,
+            'next_cursor': next_cursor,
+            'has_more': has_more,
+        }
+
+
+def statement_page(request, statement):
+    """صفحة الكشف حسب ?cursor= و ?limit= في الطلب"""
+    try:
+        limit = int(request.GET.get('limit') or DEFAULT_PAGE_SIZE)
+    except ValueError:
+        limit = DEFAULT_PAGE_SIZE
+    return statement.page(request.GET.get('cursor'), limit)
+
+
+@receiver(post_save, sender='core.Sale')
+@receiver(post_delete, sender='core.Sale')
+@receiver(post_save, sender='core.CustomerPayment')
+@receiver(post_delete, sender='core.CustomerPayment')
+def customer_statement_changed(sender, instance, **kwargs):
+    invalidate_statement('customer', instance.customer_id, kwargs.get('using'))
+
+
+@receiver(post_save, sender='core.Purchase')
+@receiver(post_delete, sender='core.Purchase')
+@receiver(post_save, sender='core.SupplierPayment')
+@receiver(post_delete, sender='core.SupplierPayment')
+def supplier_statement_changed(sender, instance, **kwargs):
+    invalidate_statement('supplier', instance.supplier_id, kwargs.get('using'))
+
+
+@receiver(post_save, sender='core.Customer')
+def customer_changed(sender, instance, **kwargs):
+    """الرصيد الافتتاحي جزء من أرصدة الكشف"""
+    invalidate_statement('customer', instance.pk, kwargs.get('using'))
+
+
+@receiver(post_save, sender='core.Supplier')
+def supplier_changed(sender, instance, **kwargs):
+    invalidate_statement('supplier', instance.pk, kwargs.get('using'))
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+دفتر المخزون
+
+ProductStock.current_stock هو رصيد مُجسَّم لكل (منتج، مخزن) يتم تحديثه داخل
+نفس المعاملة مع كل حركة مخزون (StockMovement) بعملية UPDATE ذرية باستخدام F().
+صفحة المخزون تقرأ هذا الجدول مباشرة بدلاً من إعادة حساب المخزون من الفواتير.
+
+اتجاه الحركة:
+- in و return و adjustment: الكمية تضاف كما هي (موجبة أو سالبة)
+- out و transfer: الكمية تخصم من المخزن
+
+الحركات بدون مخزن لا تدخل في الدفتر (تؤثر فقط على Product.stock العام).
+عمليات bulk_create لا ترسل إشارات، لذلك يجب استدعاء apply_movements بعدها.
+
+المطابقة الكاملة تتم بأمر: python manage.py rebuild_stock
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, When, Value, F, Sum, DecimalField
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .barcode_map import invalidate_barcode_stock
+from .database_router import get_current_db_alias
+from .pos_catalog import POSCatalog
+
+OUTGOING_TYPES = ('out', 'transfer')
+
+_ZERO = Decimal('0')
+
+
+def _quantity_field():
+    return DecimalField(max_digits=10, decimal_places=3)
+
+
+class StockLedger:
+    """تحديث المخزون المُجسَّم لكل منتج ومخزن من حركات المخزون"""
+
+    @staticmethod
+    def signed_quantity(movement_type, quantity):
+        """الكمية بإشارتها حسب نوع الحركة"""
+        quantity = Decimal(quantity or 0)
+        if movement_type in OUTGOING_TYPES:
+            return -abs(quantity)
+        return quantity
+
+    @staticmethod
+    def signed_quantity_expression():
+        """نفس signed_quantity كتعبير SQL للاستعلامات المجمعة"""
+        return Case(
+            When(movement_type__in=OUTGOING_TYPES, then=-F('quantity')),
+            default=F('quantity'),
+            output_field=_quantity_field()
+        )
+
+    @classmethod
+    def apply_deltas(cls, deltas, company_id=None, using=None):
+        """
+        تطبيق {(product_id, warehouse_id): كمية} على ProductStock
+
+        لكل مخزن عملية UPDATE واحدة بـ CASE، ثم إنشاء الصفوف غير الموجودة.
+        """
+        from .models import ProductStock
+
+        db = using or get_current_db_alias()
+        manager = ProductStock._base_manager.using(db)
+
+        by_warehouse = defaultdict(dict)
+        for (product_id, warehouse_id), delta in deltas.items():
+            if warehouse_id and delta:
+                by_warehouse[warehouse_id][product_id] = by_warehouse[warehouse_id].get(product_id, _ZERO) + delta
+
+        for warehouse_id, products in by_warehouse.items():
+            rows = manager.filter(warehouse_id=warehouse_id, product_id__in=list(products.keys()))
+            updated = rows.update(
+                current_stock=Case(
+                    *[When(product_id=product_id, then=F('current_stock') + Value(delta, output_field=_quantity_field()))
+                      for product_id, delta in products.items()],
+                    default=F('current_stock'),
+                    output_field=_quantity_field()
+                ),
+                last_updated=timezone.now()
+            )
+            if updated == len(products):
+                continue
+
+            existing = set(rows.values_list('product_id', flat=True))
+            for product_id, delta in products.items():
+                if product_id in existing:
+                    continue
+                try:
+                    with transaction.atomic(using=db):
+                        manager.create(
+                            company_id=company_id,
+                            product_id=product_id,
+                            warehouse_id=warehouse_id,
+                            current_stock=delta
+                        )
+                except IntegrityError:
+                    # تم إنشاء الصف من عملية متزامنة
+                    manager.filter(warehouse_id=warehouse_id, product_id=product_id).update(
+                        current_stock=F('current_stock') + Value(delta, output_field=_quantity_field()),
+                        last_updated=timezone.now()
+                    )
+
+        if by_warehouse:
+            # عمليات UPDATE لا ترسل إشارات، وخريطة الباركود تقرأ المخزون بعد الحفظ
+            POSCatalog.refresh_stock({product_id for products in by_warehouse.values() for product_id in products}, db)
+            transaction.on_commit(lambda: invalidate_barcode_stock(db), using=db)
+
+    @classmethod
+    def apply_movements(cls, movements, sign=1, using=None):
+        """تطبيق قائمة حركات (مثلاً بعد bulk_create) على المخزون المُجسَّم"""
+        deltas = defaultdict(lambda: _ZERO)
+        company_id = None
+        for movement in movements:
+            if not movement.warehouse_id:
+                continue
+            company_id = company_id or movement.company_id
+            deltas[(movement.product_id, movement.warehouse_id)] += sign * cls.signed_quantity(
+                movement.movement_type, movement.quantity
+            )
+        if deltas:
+            cls.apply_deltas(deltas, company_id=company_id, using=using)
+
+    @classmethod
+    def compute(cls, using=None):
+        """الأرصدة الصحيحة {(product_id, warehouse_id): كمية} باستعلام تجميع واحد"""
+        from .models import StockMovement
+
+        db = using or get_current_db_alias()
+        rows = (
+            StockMovement._base_manager.using(db)
+            .filter(warehouse__isnull=False)
+            .values('product', 'warehouse')
+            .annotate(quantity=Sum(cls.signed_quantity_expression()))
+            .order_by()
+        )
+        return {(row['product'], row['warehouse']): row['quantity'] or _ZERO for row in rows}
+
+    @classmethod
+    def rebuild(cls, using=None, batch_size=500, dry_run=False, reset_unmatched=False):
+        """
+        مطابقة ProductStock.current_stock مع حركات المخزون
+
+        يرجع تقرير الانحراف: الصفوف التي كان رصيدها المخزن مختلفاً، والصفوف
+        الناقصة التي تم إنشاؤها (stored_stock = None).
+
+        الصفوف التي ليس لها أي حركة (مخزون قديم أدخل مباشرة أو بتسويات قبل الدفتر)
+        لا تتغير وتظهر في التقرير بـ unmatched = True، إلا مع reset_unmatched
+        فيصبح رصيدها صفراً.
+        """
+        from .models import ProductStock, Product
+
+        db = using or get_current_db_alias()
+        expected = cls.compute(using=db)
+        manager = ProductStock._base_manager.using(db)
+
+        changed = []
+        drift = []
+        for stock in manager.only('id', 'product_id', 'warehouse_id', 'current_stock').iterator():
+            key = (stock.product_id, stock.warehouse_id)
+            unmatched = key not in expected
+            quantity = expected.pop(key, _ZERO)
+            if stock.current_stock != quantity:
+                drift.append({
+                    'product_id': stock.product_id,
+                    'warehouse_id': stock.warehouse_id,
+                    'stored_stock': stock.current_stock,
+                    'expected_stock': quantity,
+                    'unmatched': unmatched,
+                })
+                if unmatched and not reset_unmatched:
+                    continue
+                stock.current_stock = quantity
+                changed.append(stock)
+
+        # حركات لمنتجات ليس لها صف في ProductStock
+        missing = []
+        if expected:
+            companies = dict(
+                Product._base_manager.using(db)
+                .filter(pk__in={product_id for product_id, _ in expected})
+                .values_list('id', 'company_id')
+            )
+            for (product_id, warehouse_id), quantity in expected.items():
+                drift.append({
+                    'product_id': product_id,
+                    'warehouse_id': warehouse_id,
+                    'stored_stock': None,
+                    'expected_stock': quantity,
+                    'unmatched': False,
+                })
+                missing.append(ProductStock(
+                    company_id=companies.get(product_id),
+                    product_id=product_id,
+                    warehouse_id=warehouse_id,
+                    current_stock=quantity
+                ))
+
+        if not dry_run:
+            for start in range(0, len(changed), batch_size):
+                manager.bulk_update(changed[start:start + batch_size], ['current_stock'])
+            if missing:
+                manager.bulk_create(missing, batch_size=batch_size)
+        return drift
+
+
+def _movement_state(movement):
+    return (movement.product_id, movement.warehouse_id, movement.movement_type, movement.quantity)
+
+
+@receiver(post_init, sender='core.StockMovement')
+def remember_movement_state(sender, instance, **kwargs):
+    """حفظ قيم الحركة عند التحميل لعكسها عند التعديل"""
+    values = instance.__dict__
+    if instance.pk and all(name in values for name in ('product_id', 'warehouse_id', 'movement_type', 'quantity')):
+        instance._ledger_state = _movement_state(instance)
+
+
+def _state_deltas(state, sign):
+    product_id, warehouse_id, movement_type, quantity = state
+    return {(product_id, warehouse_id): sign * StockLedger.signed_quantity(movement_type, quantity)}
+
+
+@receiver(post_save, sender='core.StockMovement')
+def stock_movement_saved(sender, instance, created, raw=False, **kwargs):
+    """تحديث المخزون المُجسَّم عند إضافة أو تعديل حركة"""
+    new_state = _movement_state(instance)
+    old_state = getattr(instance, '_ledger_state', None)
+    instance._ledger_state = new_state
+    if raw or (not created and old_state == new_state):
+        return
+
+    deltas = defaultdict(lambda: _ZERO)
+    if not created and old_state is not None:
+        for key, delta in _state_deltas(old_state, -1).items():
+            deltas[key] += delta
+    for key, delta in _state_deltas(new_state, 1).items():
+        deltas[key] += delta
+    StockLedger.apply_deltas(deltas, company_id=instance.company_id, using=kwargs.get('using'))
+
+
+@receiver(post_delete, sender='core.StockMovement')
+def stock_movement_deleted(sender, instance, **kwargs):
+    """عكس الحركة المحذوفة من المخزون المُجسَّم"""
+    state = getattr(instance, '_ledger_state', None) or _movement_state(instance)
+    StockLedger.apply_deltas(_state_deltas(state, -1), company_id=instance.company_id, using=kwargs.get('using'))
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+حالة الشركة والاشتراك للمستخدم
+
+subscription_required و company_required يتم تنفيذهما مع كل صفحة تقريباً. بدلاً من
+قراءة UserProfile ثم Company في كل طلب يتم حفظ:
+- ربط المستخدم بشركته (بإصدار خاص بالمستخدم)
+- حالة الشركة: الرقم والكود والاسم و subscription_end و is_active (بإصدار خاص بالشركة)
+
+الإصدارات تزيد عند حفظ أو حذف Company أو UserProfile أو CompanySubscription
+(ومنها extend_subscription)، فعند دفء الكاش لا يتم تنفيذ أي استعلام.
+انتهاء الاشتراك لا يحفظ كنتيجة، بل يقارن subscription_end بتاريخ اليوم عند كل
+فحص، لذلك يطبق الانتهاء عند حد التاريخ بالضبط.
+"""
+from datetime import date
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .database_router import get_current_db_alias
+from .versioned_cache import LRUCache, get_versions, bump_version
+
+CACHE_TIMEOUT = 3600
+
+_local = LRUCache(
+    maxsize=getattr(settings, 'TENANT_LOCAL_CACHE_SIZE', 4096),
+    ttl=getattr(settings, 'TENANT_LOCAL_CACHE_TTL', 300)
+)
+
+
+def user_tenant_version_key(alias, user_id):
+    return f"tenant_user_version:{alias}:{user_id}"
+
+
+def company_status_version_key(alias, company_id):
+    return f"tenant_company_version:{alias}:{company_id}"
+
+
+def invalidate_user_tenant(user_id, alias=None):
+    """إبطال ربط المستخدم بالشركة في جميع العمليات"""
+    bump_version(user_tenant_version_key(alias or get_current_db_alias(), user_id))
+
+
+def invalidate_company_status(company_id, alias=None):
+    """إبطال حالة الشركة في جميع العمليات"""
+    bump_version(company_status_version_key(alias or get_current_db_alias(), company_id))
+
+
+class TenantStatus:
+    """حالة الشركة المحفوظة (بدون أي علاقة بقاعدة البيانات)"""
+
+    __slots__ = ('company_id', 'code', 'name', 'subscription_end', 'is_active')
+
+    def __init__(self, company_id, code, name, subscription_end, is_active):
+        self.company_id = company_id
+        self.code = code
+        self.name = name
+        self.subscription_end = subscription_end
+        self.is_active = is_active
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def is_subscription_active(self, today=None):
+        """نفس Company.is_subscription_active مع المقارنة بتاريخ اليوم وقت الفحص"""
+        return self.is_active and self.subscription_end >= (today or date.today())
+
+    @classmethod
+    def load(cls, company_id, alias):
+        from .models import Company
+
+        row = (
+            Company._base_manager.using(alias)
+            .filter(pk=company_id)
+            .values('id', 'code', 'name', 'subscription_end', 'is_active')
+            .first()
+        )
+        if row is None:
+            return None
+        return cls(row['id'], row['code'], row['name'], row['subscription_end'], row['is_active'])
+
+
+def _cached(key, loader):
+    """قراءة قيمة من LRU ثم cache الخاص بـ Django ثم loader (القيم محفوظة داخل tuple)"""
+    entry = _local.get(key)
+    if entry is None:
+        entry = cache.get(key)
+        if entry is None:
+            entry = (loader(),)
+            cache.set(key, entry, CACHE_TIMEOUT)
+        _local.set(key, entry)
+    return entry[0]
+
+
+def get_company_status(company_id, alias=None):
+    """حالة الشركة من الذاكرة أو الكاش أو قاعدة البيانات"""
+    alias = alias or get_current_db_alias()
+    version = get_versions([company_status_version_key(alias, company_id)])[0]
+    if version is None:
+        return TenantStatus.load(company_id, alias)
+    return _cached(
+        f"tenant_company:{alias}:{company_id}:v{version}",
+        lambda: TenantStatus.load(company_id, alias)
+    )
+
+
+def _load_user_company_id(user_id, alias):
+    from .models import UserProfile
+
+    return (
+        UserProfile._base_manager.using(alias)
+        .filter(user_id=user_id)
+        .values_list('company_id', flat=True)
+        .first()
+    )
+
+
+def get_user_tenant(user, alias=None):
+    """حالة شركة المستخدم، أو None إذا لم يكن له ملف مستخدم"""
+    alias = alias or get_current_db_alias()
+    version = get_versions([user_tenant_version_key(alias, user.id)])[0]
+    if version is None:
+        company_id = _load_user_company_id(user.id, alias)
+    else:
+        company_id = _cached(
+            f"tenant_user:{alias}:{user.id}:v{version}",
+            lambda: _load_user_company_id(user.id, alias)
+        )
+    if company_id is None:
+        return None
+    return get_company_status(company_id, alias)
+
+
+def get_request_tenant(request):
+    """حالة شركة المستخدم للطلب الحالي (مرة واحدة لكل طلب)"""
+    if not hasattr(request, '_tenant_status'):
+        request._tenant_status = get_user_tenant(request.user)
+    return request._tenant_status
+
+
+@receiver(post_save, sender='core.Company')
+@receiver(post_delete, sender='core.Company')
+def company_changed(sender, instance, **kwargs):
+    invalidate_company_status(instance.pk, kwargs.get('using'))
+
+
+@receiver(post_save, sender='core.UserProfile')
+@receiver(post_delete, sender='core.UserProfile')
+def user_profile_changed(sender, instance, **kwargs):
+    invalidate_user_tenant(instance.user_id, kwargs.get('using'))
+
+
+@receiver(post_save, sender='core.CompanySubscription')
+@receiver(post_delete, sender='core.CompanySubscription')
+def company_subscription_changed(sender, instance, **kwargs):
+    """تمديد أو تعديل اشتراك (extend_subscription يحفظ عن طريق save)"""
+    invalidate_company_status(instance.company_id, kwargs.get('using'))
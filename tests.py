@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+اختبارات المسارات الحساسة للتزامن والتكرار
+"""
+import datetime
+import threading
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
+
+from .account_ledger import AccountBalanceLedger
+from .models import Account, Branch, Company, DocumentSequence, JournalEntry, JournalEntryLine, POSSale, POSSession, Product, Warehouse
+from .pos_checkout import POSCheckoutService
+from .posting import PostingPipeline
+
+
+def create_company(code='TST'):
+    return Company.objects.create(
+        name='شركة الاختبار',
+        code=code,
+        database_name=f'company_{code.lower()}',
+        subscription_end=datetime.date.today() + datetime.timedelta(days=30),
+    )
+
+
+class DocumentSequenceTests(TestCase):
+    """حجز أرقام المستندات"""
+
+    def test_reserved_blocks_do_not_overlap(self):
+        company = create_company()
+        first = DocumentSequence.reserve('INV', '20260101', company.id, count=5)
+        second = DocumentSequence.reserve('INV', '20260101', company.id, count=3)
+        third = DocumentSequence.reserve('INV', '20260101', company.id)
+
+        self.assertEqual(first, 1)
+        self.assertEqual(second, 6)
+        self.assertEqual(third, 9)
+
+    def test_seed_is_used_only_when_counter_is_created(self):
+        calls = []
+
+        def seed():
+            calls.append(1)
+            return 41
+
+        self.assertEqual(DocumentSequence.reserve('REC', '20260101', seed=seed), 42)
+        self.assertEqual(DocumentSequence.reserve('REC', '20260101', seed=seed), 43)
+        self.assertEqual(len(calls), 1)
+
+
+class DocumentSequenceConcurrencyTests(TransactionTestCase):
+    """حجز الأرقام من عدة كاشيرات في نفس اللحظة"""
+
+    THREADS = 8
+    PER_THREAD = 10
+
+    @skipUnlessDBFeature('test_db_allows_multiple_connections')
+    def test_concurrent_reserve_returns_unique_numbers(self):
+        company = create_company()
+        numbers = []
+        errors = []
+        lock = threading.Lock()
+        start = threading.Barrier(self.THREADS)
+
+        def worker():
+            try:
+                start.wait()
+                reserved = [
+                    DocumentSequence.reserve('POS', '20260101', company.id)
+                    for _ in range(self.PER_THREAD)
+                ]
+                with lock:
+                    numbers.extend(reserved)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        total = self.THREADS * self.PER_THREAD
+        self.assertEqual(sorted(numbers), list(range(1, total + 1)))
+        self.assertEqual(
+            DocumentSequence.objects.get(company=company, prefix='POS', period='20260101').last_value, total
+        )
+
+
+class POSSyncIdempotencyTests(TestCase):
+    """إعادة إرسال دفعة إيصالات من جهاز نقاط البيع"""
+
+    def setUp(self):
+        self.company = create_company()
+        self.user = User.objects.create_user('cashier', password='pass')
+        branch = Branch.objects.create(company=self.company, name='الفرع الرئيسي', code='B1')
+        warehouse = Warehouse.objects.create(company=self.company, branch=branch, name='المخزن الرئيسي', code='W1')
+        self.session = POSSession.objects.create(
+            company=self.company, cashier=self.user, branch=branch, warehouse=warehouse
+        )
+        self.product = Product.objects.create(
+            company=self.company, name='منتج', barcode='1000', category='أغذية',
+            price=Decimal('10'), stock=Decimal('20')
+        )
+
+    def receipt(self, key, quantity=2):
+        return {
+            'idempotency_key': key,
+            'payment_method': 'cash',
+            'cash_amount': '100',
+            'items': [{'product_id': self.product.id, 'quantity': str(quantity), 'unit_price': '10'}],
+        }
+
+    def sync(self, receipts):
+        return POSCheckoutService.checkout_batch(self.session, self.company, self.user, receipts)
+
+    def test_replayed_key_does_not_create_second_sale(self):
+        first = self.sync([self.receipt('till-1-0001')])
+        second = self.sync([self.receipt('till-1-0001')])
+
+        self.assertEqual(first[0]['status'], 'created')
+        self.assertEqual(second[0]['status'], 'duplicate')
+        self.assertEqual(second[0]['sale_id'], first[0]['sale_id'])
+        self.assertEqual(second[0]['receipt_number'], first[0]['receipt_number'])
+        self.assertEqual(POSSale.objects.filter(idempotency_key='till-1-0001').count(), 1)
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, Decimal('18'))
+
+    def test_duplicate_key_inside_batch_is_saved_once(self):
+        results = self.sync([self.receipt('till-1-0002'), self.receipt('till-1-0002')])
+
+        self.assertEqual([result['status'] for result in results], ['created', 'duplicate'])
+        self.assertEqual(results[1]['sale_id'], results[0]['sale_id'])
+        self.assertEqual(POSSale.objects.count(), 1)
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, Decimal('18'))
+
+
+class PostingPipelineTests(TestCase):
+    """ترحيل قيد واحد لكل حدث"""
+
+    def setUp(self):
+        self.company = create_company()
+        self.cash = Account.objects.create(company=self.company, account_code='1101', name='الصندوق', account_type='asset')
+        self.sales = Account.objects.create(company=self.company, account_code='4101', name='المبيعات', account_type='revenue')
+
+    def sale_lines(self, amount):
+        return [
+            {'account': self.cash, 'debit': amount, 'credit': 0},
+            {'account': self.sales, 'debit': 0, 'credit': amount},
+        ]
+
+    def test_posting_same_reference_twice_creates_one_entry(self):
+        first = PostingPipeline.post('sale', 7, 'sale', 'فاتورة بيع 7', self.sale_lines(Decimal('150')))
+        second = PostingPipeline.post('sale', 7, 'sale', 'فاتورة بيع 7', self.sale_lines(Decimal('150')))
+
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(JournalEntry.objects.filter(reference_type='sale', reference_id=7).count(), 1)
+
+        self.cash.refresh_from_db()
+        self.assertEqual(self.cash.balance, Decimal('150'))
+
+    def test_post_many_skips_posted_and_repeated_events(self):
+        PostingPipeline.post('sale', 1, 'sale', 'فاتورة بيع 1', self.sale_lines(Decimal('10')))
+        events = [
+            PostingPipeline.event('sale', 1, 'sale', 'فاتورة بيع 1', self.sale_lines(Decimal('10'))),
+            PostingPipeline.event('sale', 2, 'sale', 'فاتورة بيع 2', self.sale_lines(Decimal('20'))),
+            PostingPipeline.event('sale', 2, 'sale', 'فاتورة بيع 2', self.sale_lines(Decimal('20'))),
+        ]
+        entries = PostingPipeline.post_many(events)
+
+        self.assertEqual(entries[1].pk, entries[2].pk)
+        self.assertEqual(JournalEntry.objects.filter(reference_type='sale').count(), 2)
+
+        self.cash.refresh_from_db()
+        self.assertEqual(self.cash.balance, Decimal('30'))
+
+
+class AccountBalanceLedgerTests(TestCase):
+    """الأرصدة المحدثة تدريجياً يجب أن تطابق إعادة البناء الكاملة"""
+
+    def setUp(self):
+        self.company = create_company()
+        self.cash = Account.objects.create(
+            company=self.company, account_code='1101', name='الصندوق', account_type='asset',
+            opening_balance=Decimal('500'), balance=Decimal('500')
+        )
+        self.sales = Account.objects.create(company=self.company, account_code='4101', name='المبيعات', account_type='revenue')
+        self.expenses = Account.objects.create(company=self.company, account_code='5101', name='المصروفات', account_type='expense')
+
+    def test_rebuild_after_incremental_posting_reports_no_drift(self):
+        # ترحيل مجمع (bulk_create + apply_totals)
+        PostingPipeline.post_many([
+            PostingPipeline.event('sale', index, 'sale', f'فاتورة بيع {index}', [
+                {'account': self.cash, 'debit': Decimal('12.50') * index},
+                {'account': self.sales, 'credit': Decimal('12.50') * index},
+            ])
+            for index in range(1, 6)
+        ])
+
+        # قيد يدوي: الأسطر تضاف كمسودة ثم يرحل القيد ويعدل أحد أسطره ويحذف آخر (إشارات الدفتر)
+        entry = JournalEntry.objects.create(company=self.company, entry_type='expense', description='مصروفات')
+        line = JournalEntryLine.objects.create(
+            company=self.company, journal_entry=entry, account=self.expenses, debit=Decimal('43'), description='مصروف'
+        )
+        JournalEntryLine.objects.create(
+            company=self.company, journal_entry=entry, account=self.cash, credit=Decimal('40'), description='مصروف'
+        )
+        extra = JournalEntryLine.objects.create(
+            company=self.company, journal_entry=entry, account=self.sales, credit=Decimal('3'), description='سطر زائد'
+        )
+        entry.is_posted = True
+        entry.save()
+
+        line.debit = Decimal('40')
+        line.save()
+        extra.delete()
+
+        self.assertEqual(AccountBalanceLedger.rebuild(dry_run=True), [])
+
+        self.cash.refresh_from_db()
+        self.assertEqual(self.cash.balance, Decimal('500') + Decimal('187.50') - Decimal('40'))
+
+    def test_rebuild_reports_and_fixes_drift(self):
+        PostingPipeline.post('sale', 1, 'sale', 'فاتورة بيع 1', [
+            {'account': self.cash, 'debit': Decimal('100')},
+            {'account': self.sales, 'credit': Decimal('100')},
+        ])
+        Account.objects.filter(pk=self.cash.pk).update(balance=Decimal('0'))
+
+        drift = AccountBalanceLedger.rebuild()
+
+        self.assertEqual([row['account_id'] for row in drift], [self.cash.pk])
+        self.assertEqual(drift[0]['difference'], Decimal('600'))
+        self.assertEqual(AccountBalanceLedger.rebuild(dry_run=True), [])
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+البحث السريع (typeahead) في العملاء والموردين والحسابات
+
+لكل قاعدة بيانات شركة ولكل نوع فهرس في ذاكرة العملية: قائمة مرتبة من المفاتيح
+المطبعة (key, id) والبحث بادئة بـ bisect، فكل حرف يكتبه المستخدم لا يصل لقاعدة
+البيانات. المفاتيح:
+- كل كلمة من الاسم بعد التطبيع العربي (نفس تطبيع فهرس المنتجات)
+- الهاتف: الأرقام فقط بدون مفتاح الدولة و 00 و + والصفر، مع كل نهايات الرقم
+  (4 أرقام فأكثر) فيمكن البحث بجزء من الرقم: 99887766 تطابق 9988 و 8776 و 7766
+- رقم الحساب
+
+الفهرس يبنى عند أول بحث باستعلام واحد، ويحدث تدريجياً من إشارات الحفظ والحذف في
+نفس العملية، وإصدار في الكاش المشترك يبلغ العمليات الأخرى بإعادة البناء.
+"""
+import re
+import threading
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .database_router import get_current_db_alias
+from .product_search import normalize_arabic
+from .versioned_cache import get_versions, bump_version
+
+DEFAULT_LIMIT = 10
+MIN_PHONE_SUFFIX = 4
+
+# مفاتيح الدول التي تحذف من بداية الرقم
+COUNTRY_CODES = tuple(getattr(settings, 'PHONE_COUNTRY_CODES', ('965', '966', '971', '973', '974', '968', '20')))
+
+_WORD = re.compile(r'\w+')
+_NON_DIGIT = re.compile(r'\D')
+
+# {(alias, kind): TypeaheadIndex}
+_indexes = {}
+_lock = threading.Lock()
+
+
+def typeahead_version_key(alias, kind):
+    return f"typeahead_version:{alias}:{kind}"
+
+
+def normalize_phone(phone):
+    """الرقم المحلي: أرقام فقط بدون 00 أو + ومفتاح الدولة والصفر في البداية"""
+    digits = _NON_DIGIT.sub('', normalize_arabic(phone))
+    if digits.startswith('00'):
+        digits = digits[2:]
+    for code in COUNTRY_CODES:
+        # مفتاح الدولة فقط إذا بقي بعده رقم محلي كامل
+        if digits.startswith(code) and len(digits) - len(code) >= 7:
+            digits = digits[len(code):]
+            break
+    return digits.lstrip('0')
+
+
+def phone_keys(phone):
+    """الرقم المحلي وجميع نهاياته (للبحث بجزء من الرقم)"""
+    digits = normalize_phone(phone)
+    return {digits[start:] for start in range(0, max(len(digits) - MIN_PHONE_SUFFIX, 0) + 1) if digits[start:]}
+
+
+def name_keys(name):
+    return set(_WORD.findall(normalize_arabic(name)))
+
+
+class TypeaheadIndex:
+    """
+    فهرس بادئات مرتب لنوع واحد
+
+    keys: قائمة مرتبة من (المفتاح، الرقم)، records: الرقم ← البيانات المعروضة،
+    و record_keys: الرقم ← مفاتيحه لحذفها عند التعديل.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.keys = []
+        self.records = {}
+        self.record_keys = {}
+        self.lock = threading.Lock()
+
+    def add(self, record_id, keys, record):
+        with self.lock:
+            self._discard(record_id)
+            self.records[record_id] = record
+            self.record_keys[record_id] = keys
+            for key in keys:
+                insort(self.keys, (key, record_id))
+
+    def discard(self, record_id):
+        with self.lock:
+            self._discard(record_id)
+
+    def _discard(self, record_id):
+        for key in self.record_keys.pop(record_id, ()):
+            position = bisect_left(self.keys, (key, record_id))
+            if position < len(self.keys) and self.keys[position] == (key, record_id):
+                del self.keys[position]
+        self.records.pop(record_id, None)
+
+    def load(self, rows):
+        """تعبئة الفهرس كاملاً مرة واحدة (ترتيب واحد بدلاً من insort لكل مفتاح)"""
+        keys = []
+        for record_id, record_keys, record in rows:
+            self.records[record_id] = record
+            self.record_keys[record_id] = record_keys
+            keys.extend((key, record_id) for key in record_keys)
+        keys.sort()
+        self.keys = keys
+
+    def _prefix(self, prefix, limit):
+        """أرقام السجلات التي لها مفتاح يبدأ بـ prefix (بترتيب المفاتيح)"""
+        found = {}
+        position = bisect_left(self.keys, (prefix,))
+        while position < len(self.keys) and len(found) < limit:
+            key, record_id = self.keys[position]
+            if not key.startswith(prefix):
+                break
+            found.setdefault(record_id, key)
+            position += 1
+        return found
+
+    def search(self, query, limit=DEFAULT_LIMIT, digits=None):
+        """
+        أفضل limit نتيجة: جميع كلمات البحث بادئات لكلمات في السجل
+
+        الترتيب: مطابقة كاملة للكلمة الأولى، ثم الاسم الأقصر. digits: الرقم
+        المطبع للبحث بالهاتف (إذا كان نص البحث أرقاماً).
+        """
+        words = sorted(_WORD.findall(normalize_arabic(query)), key=len, reverse=True)
+        if not words and not digits:
+            return []
+
+        with self.lock:
+            if digits:
+                matches = self._prefix(digits, limit * 20)
+            else:
+                # الكلمة الأطول أقل نتائج، والباقي يطابق من مفاتيح السجل
+                matches = self._prefix(words[0], limit * 20)
+                rest = words[1:]
+                if rest:
+                    matches = {
+                        record_id: key for record_id, key in matches.items()
+                        if all(any(k.startswith(word) for k in self.record_keys[record_id]) for word in rest)
+                    }
+            results = [
+                (key != (digits or words[0]), len(self.records[record_id].get('name') or ''), record_id)
+                for record_id, key in matches.items()
+            ]
+            results.sort()
+            return [self.records[record_id] for _, _, record_id in results[:limit]]
+
+
+class Typeahead:
+    """الفهارس لكل نوع (customer / supplier / account)"""
+
+    KINDS = ('customer', 'supplier', 'account')
+
+    @staticmethod
+    def _model(kind):
+        from django.apps import apps
+        return apps.get_model('core', {'customer': 'Customer', 'supplier': 'Supplier', 'account': 'Account'}[kind])
+
+    @staticmethod
+    def entry(kind, instance):
+        """(الرقم، المفاتيح، البيانات المعروضة) لسجل، أو None إذا لا يظهر في البحث"""
+        if not getattr(instance, 'is_active', True):
+            return None
+        if kind == 'account':
+            keys = name_keys(instance.name) | ({str(instance.account_code)} if instance.account_code else set())
+            record = {
+                'id': instance.pk,
+                'name': instance.name,
+                'code': instance.account_code,
+                'type': instance.get_account_type_display(),
+                'company_id': instance.company_id,
+            }
+        else:
+            keys = name_keys(instance.name) | phone_keys(instance.phone)
+            record = {
+                'id': instance.pk,
+                'name': instance.name,
+                'phone': instance.phone,
+                'balance': float(instance.opening_balance or 0),
+                'company_id': instance.company_id,
+            }
+        return instance.pk, frozenset(keys), record
+
+    @classmethod
+    def build(cls, kind, version, using=None):
+        db = using or get_current_db_alias()
+        index = TypeaheadIndex(version)
+        rows = cls._model(kind)._base_manager.using(db).all()
+        index.load(entry for entry in (cls.entry(kind, instance) for instance in rows.iterator()) if entry)
+        return index
+
+    @classmethod
+    def index(cls, kind, using=None):
+        """فهرس النوع في هذه العملية، يعاد بناؤه إذا تغير الإصدار"""
+        db = using or get_current_db_alias()
+        version = get_versions([typeahead_version_key(db, kind)])[0]
+        index = _indexes.get((db, kind))
+        if index is not None and index.version == version:
+            return index
+        with _lock:
+            index = _indexes.get((db, kind))
+            if index is None or index.version != version:
+                index = cls.build(kind, version, db)
+                _indexes[(db, kind)] = index
+        return index
+
+    @classmethod
+    def search(cls, kind, query, limit=DEFAULT_LIMIT, company_id=None, using=None):
+        """أفضل limit نتيجة للنوع، بدون استعلام إذا كان الفهرس محملاً"""
+        query = (query or '').strip()
+        if not query:
+            return []
+        digits = None
+        compact = re.sub(r'[\s\-+()]', '', normalize_arabic(query))
+        if kind != 'account' and compact.isdigit():
+            # نص البحث رقم هاتف (مع مسافات أو + أو شرطات)
+            digits = normalize_phone(compact) or compact
+
+        index = cls.index(kind, using)
+        results = index.search(query, limit if company_id is None else limit * 5, digits)
+        if company_id is not None:
+            results = [record for record in results if record['company_id'] == company_id][:limit]
+        return results
+
+    @staticmethod
+    def _apply(kind, using, change):
+        """
+        تطبيق تعديل على الفهرس المحمل في هذه العملية وإبلاغ العمليات الأخرى
+
+        إذا كان الإصدار الجديد هو التالي مباشرة لإصدار الفهرس فلا يوجد تعديل آخر
+        فائت ويبقى الفهرس المحلي بدون إعادة بناء.
+        """
+        db = using or get_current_db_alias()
+        key = typeahead_version_key(db, kind)
+        bump_version(key)
+        index = _indexes.get((db, kind))
+        if index is None:
+            return
+        change(index)
+        version = get_versions([key])[0]
+        if isinstance(index.version, int) and version == index.version + 1:
+            index.version = version
+
+    @classmethod
+    def update(cls, kind, instance, using=None):
+        entry = cls.entry(kind, instance)
+
+        def change(index):
+            if entry:
+                index.add(*entry)
+            else:
+                index.discard(instance.pk)
+
+        cls._apply(kind, using, change)
+
+    @classmethod
+    def remove(cls, kind, record_id, using=None):
+        cls._apply(kind, using, lambda index: index.discard(record_id))
+
+
+def _kind(sender):
+    return sender._meta.model_name
+
+
+@receiver(post_save, sender='core.Customer')
+@receiver(post_save, sender='core.Supplier')
+@receiver(post_save, sender='core.Account')
+def party_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        Typeahead.update(_kind(sender), instance, kwargs.get('using'))
+
+
+@receiver(post_delete, sender='core.Customer')
+@receiver(post_delete, sender='core.Supplier')
+@receiver(post_delete, sender='core.Account')
+def party_deleted(sender, instance, **kwargs):
+    Typeahead.remove(_kind(sender), instance.pk, kwargs.get('using'))
@@ -5,6 +5,7 @@ from django.urls import path
 from . import views
 from .balance_sheet_views import balance_sheet
 from . import permission_views
+from . import pos_views
 from .company_setup_views import setup_company
 
 urlpatterns = [
@@ -143,6 +144,7 @@ urlpatterns = [
     path('salaries/pay/<int:salary_id>/', views.pay_salary, name='pay_salary'),
     path('salaries/generate/', views.generate_salaries, name='generate_salaries'),
     path('salaries/bulk-pay/', views.bulk_pay_salaries, name='bulk_pay_salaries'),
+    path('salaries/bulk-confirm/', views.bulk_confirm_salaries, name='bulk_confirm_salaries'),
     path('salaries/print/<int:salary_id>/', views.print_salary_slip, name='print_salary_slip'),
     path('salaries/export/', views.export_salaries, name='export_salaries'),
     
@@ -167,6 +169,9 @@ urlpatterns = [
     path('pos/session-report/<int:session_id>/', views.pos_session_report, name='pos_session_report'),
     path('pos/sale/', views.pos_sale, name='pos_sale'),
     path('pos/sale-screen/<int:session_id>/', views.pos_sale, name='pos_sale_screen'),
+    path('pos/sync/', pos_views.sync_pos_sales, name='pos_sync_sales'),
+    path('pos/barcode/', pos_views.barcode_lookup, name='pos_barcode_lookup'),
+    path('pos/catalog/', pos_views.catalog_feed, name='pos_catalog_feed'),
     
     # APIs
     path('api/search-products/', views.search_products_api, name='search_products_api'),
@@ -179,6 +184,8 @@ urlpatterns = [
     path('api/customer-returns/<int:customer_id>/', views.get_customer_returns, name='get_customer_returns'),
     path('api/customer-payments/<int:customer_id>/', views.get_customer_payments, name='get_customer_payments'),
     path('api/customer-summary/<int:customer_id>/', views.get_customer_summary, name='get_customer_summary'),
+    path('api/aging/', views.aging_report_api, name='aging_report_api'),
+    path('api/accounts-tree/', views.accounts_tree_api, name='accounts_tree_api'),
     path('api/salary-details/<int:salary_id>/', views.salary_details, name='salary_details'),
     path('api/product-movements/<int:product_id>/', views.get_product_movements, name='get_product_movements'),
     path('api/adjust-stock/', views.adjust_stock_api, name='adjust_stock_api'),
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+أدوات الكاش ذي الإصدارات
+
+الإصدار يحفظ في cache الخاص بـ Django (مشترك بين العمليات) ويتم تضمينه في
+مفاتيح الكاش، فزيادة الإصدار من أي عملية تبطل القيم القديمة في جميع العمليات
+دون الحاجة لحذفها. LRUCache ذاكرة محدودة داخل العملية أمام الكاش المشترك.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+
+def _new_version():
+    # قيمة مختلفة في كل مرة حتى لا يعود إصدار قديم بعد حذف المفتاح من الكاش
+    return time.time_ns()
+
+
+def get_versions(keys):
+    """قراءة عدة إصدارات بعملية كاش واحدة، مع تهيئة المفقود منها"""
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, _new_version(), None)
+        versions.update(cache.get_many(missing))
+    return tuple(versions.get(key) for key in keys)
+
+
+def bump_version(key):
+    """زيادة الإصدار لإبطال القيم المحفوظة في جميع العمليات"""
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_version(), None)
+
+
+class LRUCache:
+    """ذاكرة LRU محدودة الحجم مع مدة صلاحية لكل عنصر"""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -204,11 +204,10 @@ from functools import wraps
 from datetime import date, timedelta
 import json
 import time
-import os
-from django.conf import settings
+import threading
 from .models import *
 from .models import Salary
-from .models import POSSession, POSSale, POSSaleItem
+from .models import POSSession, POSSale
 from .decorators import permission_required, subscription_required, branch_required, warehouse_required, company_required
 from .permission_decorators import enhanced_permission_required
 from .permissions_utils import check_user_permission
@@ -216,6 +215,7 @@ from .permissions_system import PermissionSystem
 from .models import Permission
 from .dynamic_settings import DynamicSettingsManager, get_dynamic_setting, set_dynamic_setting
 from .inventory_accounting import InventoryAccountingManager
+from .settings_cache import get_request_settings
 
 # دوال مساعدة
 def get_user_context(request):
@@ -237,11 +237,12 @@ def get_user_context(request):
     if request.user.is_authenticated:
         context['user_permissions'] = get_user_permissions(request.user)
     
-    # إضافة الإعدادات العامة
+    # إضافة الإعدادات العامة (من لقطة إعدادات الطلب)
+    snapshot = get_request_settings(request)
     context['current_settings'] = {
-        'currency_symbol': get_setting('currency_symbol', 'د.ك'),
+        'currency_symbol': snapshot.get('currency_symbol', 'د.ك'),
         'company_name': context.get('company_name', 'شركة ERP'),
-        'theme_color': get_setting('theme_color', 'blue')
+        'theme_color': snapshot.get('theme_color', 'blue')
     }
     
     return context
@@ -369,15 +370,9 @@ def login_view(request):
 def switch_to_company_database(company_code):
     """تبديل قاعدة البيانات حسب الشركة"""
     try:
-        db_name = f"erp_{company_code.lower()}.db"
-        db_path = os.path.join(settings.BASE_DIR, 'databases', db_name)
-        
-        if os.path.exists(db_path):
-            settings.DATABASES['default']['NAME'] = db_path
-            from django.db import connection
-            connection.close()
-            return True
-        return False
+        from .database_router import set_current_company
+        # التبديل يسري على الطلب الحالي فقط، والـ middleware تعيده في نهاية الطلب
+        return set_current_company(company_code) is not None
     except:
         return False
 
@@ -455,9 +450,10 @@ def dashboard(request):
         
         # الحصول على الإعدادات (مع قيم افتراضية)
         try:
-            company_name = get_setting('company_name', 'شركة ERP')
-            currency_symbol = get_setting('currency_symbol', 'ر.س')
-            theme_color = get_setting('theme_color', 'blue')
+            snapshot = get_request_settings(request)
+            company_name = snapshot.get('company_name', 'شركة ERP')
+            currency_symbol = snapshot.get('currency_symbol', 'ر.س')
+            theme_color = snapshot.get('theme_color', 'blue')
         except:
             company_name = 'شركة ERP'
             currency_symbol = 'ر.س'
@@ -573,10 +569,21 @@ def add_product(request):
                         product=product,
                         warehouse=request.current_warehouse,
                         defaults={
-                            'current_stock': request.POST.get('initial_stock', product.stock or 0),
                             'min_stock': request.POST.get('min_stock', 10)
                         }
                     )
+                    
+                    # المخزون الافتتاحي كحركة إدخال حتى يبقى دفتر المخزون مطابقاً للحركات
+                    if product.stock:
+                        StockMovement.objects.create(
+                            company=company,
+                            product=product,
+                            warehouse=request.current_warehouse,
+                            movement_type='in',
+                            quantity=product.stock,
+                            reference='رصيد افتتاحي',
+                            created_by=request.user
+                        )
             except:
                 pass
             
@@ -1364,35 +1371,16 @@ def pos_close_session(request, session_id):
             closing_balance = float(request.POST.get('closing_balance', 0))
             notes = request.POST.get('notes', '')
             
-            # حساب إجماليات الجلسة
-            pos_sales = POSSale.objects.filter(session=session)
-            total_sales = pos_sales.aggregate(Sum('total_amount'))['total_amount__sum'] or 0
-            
-            # حساب المبالغ النقدية والكي نت بشكل صحيح
-            total_cash = 0
-            total_card = 0
-            for sale in pos_sales:
-                if sale.payment_method == 'cash':
-                    total_cash += sale.cash_amount or 0
-                elif sale.payment_method == 'card':
-                    total_card += sale.card_amount or 0
-                elif sale.payment_method == 'mixed':
-                    total_cash += sale.cash_amount or 0
-                    total_card += sale.card_amount or 0
-            
-            # حساب الفرق
-            expected_balance = float(session.opening_balance) + float(total_cash)
+            # حساب الفرق من عدادات الجلسة (يتم تحديثها مع كل بيع)
+            expected_balance = float(session.opening_balance) + float(session.total_cash)
             difference = closing_balance - expected_balance
             
-            # تحديث الجلسة
+            # تحديث الجلسة (بدون حقول العدادات حتى لا يتم الكتابة فوق بيع متزامن)
             session.closing_balance = closing_balance
-            session.total_sales = total_sales
-            session.total_cash = total_cash
-            session.total_card = total_card
             session.status = 'closed'
             session.closed_at = timezone.now()
             session.notes = f"{notes}\nالفرق: {difference:.2f} د.ك" if notes else f"الفرق: {difference:.2f} د.ك"
-            session.save()
+            session.save(update_fields=['closing_balance', 'status', 'closed_at', 'notes'])
             
             messages.success(request, f'تم إغلاق الجلسة #{session.session_number} بنجاح')
             return redirect('pos_session_report', session_id=session.id)
@@ -1400,27 +1388,16 @@ def pos_close_session(request, session_id):
         except Exception as e:
             messages.error(request, f'خطأ في إغلاق الجلسة: {str(e)}')
     
-    # حساب الإحصائيات للعرض
-    pos_sales = POSSale.objects.filter(session=session)
-    total_cash = 0
-    total_card = 0
-    
-    # حساب المبالغ النقدية والكي نت
-    for sale in pos_sales:
-        if sale.payment_method == 'cash':
-            total_cash += float(sale.cash_amount or 0)
-        elif sale.payment_method == 'card':
-            total_card += float(sale.card_amount or 0)
-        elif sale.payment_method == 'mixed':
-            total_cash += float(sale.cash_amount or 0)
-            total_card += float(sale.card_amount or 0)
-    
+    # الإحصائيات من عدادات الجلسة
     stats = {
-        'total_sales': pos_sales.aggregate(Sum('total_amount'))['total_amount__sum'] or 0,
-        'total_cash': total_cash,
-        'total_card': total_card,
-        'sales_count': pos_sales.count(),
-        'expected_balance': float(session.opening_balance) + total_cash
+        'total_sales': session.total_sales,
+        'total_cash': float(session.total_cash),
+        'total_card': float(session.total_card),
+        'cash_sales': session.cash_sales,
+        'knet_sales': session.knet_sales,
+        'mixed_sales': session.mixed_sales,
+        'sales_count': session.sales_count,
+        'expected_balance': float(session.opening_balance) + float(session.total_cash)
     }
     
     context = {
@@ -1437,12 +1414,13 @@ def pos_session_report(request, session_id):
     """تقرير جلسة نقاط البيع"""
     session = get_object_or_404(POSSession, id=session_id)
     
-    # جلب مبيعات الجلسة
-    sales = POSSale.objects.filter(session=session).order_by('-created_at')
+    # صفحة من مبيعات الجلسة، والإحصائيات من عدادات الجلسة
+    from .pos_session_totals import POSSessionTotals
+    sales_page = POSSessionTotals.sales_page(session, request.GET.get('page'))
+    details = POSSessionTotals.report_details(session)
     
-    # إحصائيات المبيعات
-    sales_count = sales.count()
-    items_count = POSSaleItem.objects.filter(pos_sale__session=session).count()
+    sales_count = session.sales_count
+    items_count = details['items_count']
     avg_sale = session.total_sales / sales_count if sales_count > 0 else 0
     
     # حساب مدة الجلسة
@@ -1454,24 +1432,14 @@ def pos_session_report(request, session_id):
     else:
         session_duration = "--:--"
     
-    # أكثر المنتجات مبيعاً
-    top_products = POSSaleItem.objects.filter(
-        pos_sale__session=session
-    ).values(
-        'product__name'
-    ).annotate(
-        total_quantity=Sum('quantity'),
-        total_sales=Sum('total_price')
-    ).order_by('-total_sales')[:5]
-    
     context = {
         'session': session,
-        'sales': sales,
+        **sales_page,
         'sales_count': sales_count,
         'items_count': items_count,
         'avg_sale': avg_sale,
         'session_duration': session_duration,
-        'top_products': top_products,
+        'top_products': details['top_products'],
         'currency_symbol': get_setting('currency_symbol', 'د.ك'),
         'company_name': get_setting('company_name', 'شركة ERP'),
         **get_user_context(request)
@@ -1492,9 +1460,9 @@ def pos_sale(request):
         try:
             customer_name = request.POST.get('customer_name', 'عميل نقدي')
             payment_method = request.POST.get('payment_method', 'cash')
-            cash_amount = float(request.POST.get('cash_amount', 0))
-            card_amount = float(request.POST.get('card_amount', 0))
-            discount_amount = float(request.POST.get('discount_amount', 0))
+            cash_amount = request.POST.get('cash_amount', 0)
+            card_amount = request.POST.get('card_amount', 0)
+            discount_amount = request.POST.get('discount_amount', 0)
             
             # الحصول على الشركة الحالية
             company = getattr(request, 'company', None)
@@ -1510,71 +1478,24 @@ def pos_sale(request):
                         }
                     )
             
-            # إنشاء البيع
-            pos_sale = POSSale.objects.create(
-                company=company,
-                session=active_session,
-                customer_name=customer_name,
-                payment_method=payment_method,
-                cash_amount=cash_amount,
-                card_amount=card_amount,
-                discount_amount=discount_amount,
-                subtotal=0,
-                total_amount=0,
-                created_by=request.user
-            )
-            
-            # إضافة العناصر
+            # إتمام البيع في معاملة واحدة بعدد ثابت من الاستعلامات
+            from .pos_checkout import POSCheckoutService
             items_data = json.loads(request.POST.get('items', '[]'))
-            subtotal = 0
-            
-            for item_data in items_data:
-                product = get_object_or_404(Product, id=item_data['product_id'])
-                quantity = float(item_data['quantity'])
-                unit_price = float(item_data['unit_price'])
-                
-                # خصم الكمية من المخزون
-                if hasattr(product, 'stock'):
-                    if product.stock < quantity:
-                        messages.error(request, f'المخزون غير كافي للمنتج {product.name}')
-                        pos_sale.delete()
-                        return redirect('pos_sale')
-                    
-                    from decimal import Decimal
-                    product.stock = Decimal(str(product.stock)) - Decimal(str(quantity))
-                    product.save()
-                    
-                    # تسجيل حركة المخزون
-                    StockMovement.objects.create(
-                        company=company,
-                        product=product,
-                        movement_type='out',
-                        quantity=quantity,
-                        reference=f'بيع نقاط البيع #{pos_sale.receipt_number}',
-                        created_by=request.user
-                    )
-                
-                # إنشاء عنصر البيع
-                item_total = quantity * unit_price
-                POSSaleItem.objects.create(
+            try:
+                pos_sale = POSCheckoutService.checkout(
+                    session=active_session,
                     company=company,
-                    pos_sale=pos_sale,
-                    product=product,
-                    quantity=quantity,
-                    unit_price=unit_price,
-                    total_price=item_total
+                    user=request.user,
+                    items_data=items_data,
+                    customer_name=customer_name,
+                    payment_method=payment_method,
+                    cash_amount=cash_amount,
+                    card_amount=card_amount,
+                    discount_amount=discount_amount
                 )
-                
-                subtotal += item_total
-            
-            # حساب الإجمالي
-            total_amount = subtotal - discount_amount
-            change_amount = (cash_amount + card_amount) - total_amount
-            
-            pos_sale.subtotal = subtotal
-            pos_sale.total_amount = total_amount
-            pos_sale.change_amount = change_amount
-            pos_sale.save()
+            except ValidationError as e:
+                messages.error(request, ' '.join(e.messages))
+                return redirect('pos_sale')
             
             messages.success(request, f'تم إتمام البيع #{pos_sale.receipt_number} بنجاح')
             return redirect('pos')
@@ -1582,12 +1503,15 @@ def pos_sale(request):
         except Exception as e:
             messages.error(request, f'خطأ في البيع: {str(e)}')
     
-    # جلب المنتجات النشطة
-    products = Product.objects.filter(is_active=True).order_by('name')
+    # منتجات مخزن الجلسة من كتالوج نقطة البيع (السعر والمخزون الفعلي في المخزن)
+    # الصفحة تحمل رقم التغيير لتحديث نسختها المحلية من pos/catalog/?since=
+    from .pos_catalog import POSCatalog
+    catalog = POSCatalog.feed(active_session.warehouse_id)
     
     context = {
         'active_session': active_session,
-        'products': products,
+        'products': catalog['products'],
+        'catalog_version': catalog['version'],
         'currency_symbol': get_setting('currency_symbol', 'د.ك'),
         **get_user_context(request)
     }
@@ -1953,8 +1877,10 @@ from functools import lru_cache
 
 def get_setting(key, default=None, company=None):
     try:
-        from .settings_helper import get_setting as get_file_setting
-        return get_file_setting(key, default)
+        from .settings_cache import get_settings_snapshot
+        if company is None:
+            company = getattr(threading.current_thread(), 'current_company', None)
+        return get_settings_snapshot(company.id if company else None).get(key, default)
     except Exception as e:
         return default
 
@@ -1989,13 +1915,27 @@ def search_products_api(request):
         if not query:
             return JsonResponse({'success': False, 'message': 'يرجى إدخال نص البحث'})
         
-        # البحث في المنتجات
-        products = Product.objects.filter(
-            Q(name__icontains=query) |
-            Q(barcode__icontains=query) |
-            Q(category__icontains=query),
-            is_active=True
-        ).order_by('name')[:20]
+        # كتالوج مخزن الكاشير: السعر والمخزون في نفس الصف (استعلامان للبحث كاملاً)
+        from .pos_catalog import POSCatalog
+        warehouse_id = POSCatalog.warehouse_for(request.user)
+        if warehouse_id:
+            products_data = [POSCatalog.as_dict(item) for item in POSCatalog.search(query, warehouse_id, limit=20)]
+            return JsonResponse({
+                'success': True,
+                'products': products_data,
+                'count': len(products_data)
+            })
+        
+        # البحث في فهرس FTS5 (مرتب حسب bm25)، والبحث العادي إذا لم يكن الفهرس متاحاً
+        from .product_search import ProductSearchIndex
+        products = ProductSearchIndex.search_products(query, limit=20)
+        if products is None:
+            products = Product.objects.filter(
+                Q(name__icontains=query) |
+                Q(barcode__icontains=query) |
+                Q(category__icontains=query),
+                is_active=True
+            ).order_by('name')[:20]
         
         products_data = []
         for product in products:
@@ -2056,6 +1996,24 @@ def search_products_api(request):
 def get_product_details_api(request, product_id):
     """API للحصول على تفاصيل منتج محدد"""
     try:
+        # صف الكتالوج لمخزن الكاشير مع المنتج باستعلام واحد
+        from .pos_catalog import POSCatalog
+        warehouse_id = POSCatalog.warehouse_for(request.user)
+        if warehouse_id:
+            item = POSCatalog.items(warehouse_id).select_related('product').filter(product_id=product_id).first()
+            if item is None:
+                return JsonResponse({'success': False, 'message': 'المنتج غير موجود'})
+            product_data = POSCatalog.as_dict(item)
+            product_data.update({
+                'is_active': item.is_active,
+                'created_at': item.product.created_at.strftime('%Y-%m-%d') if item.product.created_at else '',
+                'bom': getattr(item.product, 'bom', False)
+            })
+            return JsonResponse({
+                'success': True,
+                'product': product_data
+            })
+        
         product = Product.objects.get(id=product_id, is_active=True)
         
         # جمع جميع البيانات
@@ -2360,6 +2318,8 @@ def adjust_stock_api(request):
         elif adjustment_type == 'set':
             new_stock = quantity
             movement_type = 'adjustment'
+            # حركة التسوية تسجل الفرق بإشارته
+            quantity = new_stock - current_stock
         else:
             return JsonResponse({'success': False, 'message': 'نوع تسوية غير صحيح'})
         
@@ -2379,7 +2339,7 @@ def adjust_stock_api(request):
             company=company,
             product=product,
             movement_type=movement_type,
-            quantity=abs(quantity),
+            quantity=quantity if movement_type == 'adjustment' else abs(quantity),
             reference=f'تسوية مخزون - {reason}' if reason else 'تسوية مخزون',
             notes=reason,
             created_by=request.user
@@ -3430,7 +3390,6 @@ def confirm_purchase(request, purchase_id):
             # معالجة شاملة: مخزون + محاسبة
             try:
                 InventoryAccountingManager.process_purchase(purchase.items.all(), request.user)
-                InventoryAccountingManager.update_account_balances()
                 messages.success(request, f'تم تأكيد فاتورة الشراء #{purchase.invoice_number} وتسجيل جميع القيود المحاسبية')
             except Exception as e:
                 messages.warning(request, f'تم تأكيد الفاتورة ولكن حدث خطأ في المحاسبة: {str(e)}')
@@ -4157,7 +4116,6 @@ def confirm_salary(request, salary_id):
         # تسجيل القيد المحاسبي للراتب
         try:
             InventoryAccountingManager.process_salary(salary, request.user)
-            InventoryAccountingManager.update_account_balances()
             message = 'تم تأكيد الراتب وتسجيل القيد المحاسبي بنجاح'
         except Exception as e:
             message = f'تم تأكيد الراتب ولكن حدث خطأ في المحاسبة: {str(e)}'
@@ -4214,6 +4172,59 @@ def bulk_pay_salaries(request):
     except Exception as e:
         return JsonResponse({'success': False, 'message': str(e)})
 
+@login_required
+@subscription_required
+@permission_required('salaries', 'confirm')
+@require_POST
+def bulk_confirm_salaries(request):
+    """
+    تأكيد رواتب شهر محدد المسودة وترحيل قيودها دفعة واحدة
+
+    الرواتب التي لا يمكن ترحيل قيدها (صافي الراتب صفر مثلاً) تبقى مسودة وترجع
+    في skipped مع السبب، ولا تلغي تأكيد باقي الرواتب.
+    """
+    try:
+        data = json.loads(request.body or '{}') if request.content_type == 'application/json' else request.POST
+        month = int(data['month'])
+        year = int(data['year'])
+    except (KeyError, TypeError, ValueError):
+        return JsonResponse({'success': False, 'message': 'يجب تحديد الشهر والسنة'}, status=400)
+    
+    try:
+        from .database_router import company_atomic
+        from .posting import PostingPipeline
+        with company_atomic():
+            salaries = list(
+                Salary.objects.filter(status='draft', month=month, year=year)
+                .select_related('company', 'employee', 'created_by')
+            )
+            events = []
+            skipped = []
+            for salary, event in zip(salaries, PostingPipeline.salary_events(salaries, request.user)):
+                reason = PostingPipeline.invalid_reason(event)
+                if reason:
+                    employee_name = salary.employee.get_full_name() or salary.employee.username
+                    skipped.append({'id': salary.id, 'employee': employee_name, 'error': reason})
+                else:
+                    events.append(event)
+            # update لا يرسل إشارات الحفظ، فيتم ترحيل جميع القيود معاً
+            confirmed_count = Salary.objects.filter(
+                pk__in=[event['reference_id'] for event in events]
+            ).update(status='confirmed')
+            PostingPipeline.post_many(events)
+        
+        message = f'تم تأكيد {confirmed_count} راتب وتسجيل القيود المحاسبية'
+        if skipped:
+            message += f'، ولم يتم تأكيد {len(skipped)} راتب'
+        return JsonResponse({
+            'success': True,
+            'confirmed_count': confirmed_count,
+            'skipped': skipped,
+            'message': message
+        })
+    except Exception as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=500)
+
 @login_required
 def print_salary_slip(request, salary_id):
     salary = get_object_or_404(Salary, id=salary_id)
@@ -4487,83 +4498,66 @@ def employees_list(request):
 @subscription_required
 @permission_required('stock', 'view')
 def stock_list(request):
-    products = Product.objects.all().order_by('name')
+    # المخزون المُجسَّم لكل منتج ومخزن (يتم تحديثه مع كل حركة مخزون)
+    stocks_by_product = {}
+    warehouses_totals = {}
+    for stock in ProductStock.objects.select_related('product', 'warehouse').order_by('warehouse_id'):
+        stocks_by_product.setdefault(stock.product_id, []).append(stock)
+        totals = warehouses_totals.setdefault(stock.warehouse_id, {'products_count': 0, 'total_value': 0})
+        totals['products_count'] += 1
+        totals['total_value'] += stock.current_stock * (stock.product.cost_price or 0)
+    
+    # الكميات المباعة والمشتراة لكل منتج باستعلام مجمع واحد لكل منهما
+    sales_by_product = dict(
+        SaleItem.objects.filter(sale__status='confirmed')
+        .values('product').annotate(total=Sum('quantity')).values_list('product', 'total')
+    )
+    purchases_by_product = dict(
+        PurchaseItem.objects.filter(purchase__status='confirmed')
+        .values('product').annotate(total=Sum('quantity')).values_list('product', 'total')
+    )
+    
     stock_data = []
     total_stock_value = 0
     
-    for product in products:
-        try:
-            # تحديث المخزون من المبيعات والمشتريات
-            confirmed_sales = SaleItem.objects.filter(
-                product=product, 
-                sale__status='confirmed'
-            ).aggregate(Sum('quantity'))['quantity__sum'] or 0
-            
-            confirmed_purchases = PurchaseItem.objects.filter(
-                product=product, 
-                purchase__status='confirmed'
-            ).aggregate(Sum('quantity'))['quantity__sum'] or 0
-            
-            # المخزون الحالي = المشتريات - المبيعات + المخزون الأولي
-            initial_stock = getattr(product, 'stock', 0) or 0
-            current_stock = initial_stock + confirmed_purchases - confirmed_sales
-            
-            # تحديث المخزون في المنتج
-            product.stock = current_stock
-            product.save()
-            
-            # حساب قيمة المخزون
-            cost_price = getattr(product, 'cost_price', 0) or 0
-            stock_value = current_stock * cost_price
-            total_stock_value += stock_value
-            
-            stock = ProductStock.objects.filter(product=product).first()
-            if stock:
-                stock.current_stock = current_stock
-                stock.save()
-                min_stock = stock.min_stock
-                warehouse = stock.warehouse
-            else:
-                min_stock = 10  # الحد الأدنى الافتراضي
-                warehouse = None
-            
-            stock_data.append({
-                'product': product,
-                'current_stock': current_stock,
-                'min_stock': min_stock,
-                'warehouse': warehouse,
-                'is_low_stock': current_stock <= min_stock,
-                'stock_value': stock_value,
-                'sales_count': confirmed_sales,
-                'purchases_count': confirmed_purchases
-            })
-        except:
+    for product in Product.objects.all().order_by('name'):
+        stocks = stocks_by_product.get(product.id)
+        if stocks:
+            current_stock = sum(stock.current_stock for stock in stocks)
+            min_stock = sum(stock.min_stock for stock in stocks)
+            warehouse = stocks[0].warehouse
+        else:
+            # منتج بدون مخزن: المخزون العام للمنتج
             current_stock = getattr(product, 'stock', 0) or 0
-            stock_data.append({
-                'product': product,
-                'current_stock': current_stock,
-                'min_stock': 0,
-                'warehouse': None,
-                'is_low_stock': False,
-                'stock_value': 0,
-                'sales_count': 0,
-                'purchases_count': 0
-            })
+            min_stock = 10  # الحد الأدنى الافتراضي
+            warehouse = None
+        
+        cost_price = getattr(product, 'cost_price', 0) or 0
+        stock_value = current_stock * cost_price
+        total_stock_value += stock_value
+        
+        stock_data.append({
+            'product': product,
+            'current_stock': current_stock,
+            'min_stock': min_stock,
+            'warehouse': warehouse,
+            'is_low_stock': current_stock <= min_stock,
+            'stock_value': stock_value,
+            'sales_count': sales_by_product.get(product.id) or 0,
+            'purchases_count': purchases_by_product.get(product.id) or 0
+        })
     
     recent_movements = StockMovement.objects.select_related('product').order_by('-created_at')[:10]
     
     # إحصائيات المخازن
+    warehouses = list(Warehouse.objects.all())
     warehouses_stats = []
-    for warehouse in Warehouse.objects.all():
-        warehouse_products = ProductStock.objects.filter(warehouse=warehouse).count()
-        warehouse_value = sum(
-            (stock.current_stock * (stock.product.cost_price or 0))
-            for stock in ProductStock.objects.filter(warehouse=warehouse)
-        )
+    for warehouse in warehouses:
+        totals = warehouses_totals.get(warehouse.id, {'products_count': 0, 'total_value': 0})
         warehouses_stats.append({
             'warehouse': warehouse,
-            'products_count': warehouse_products,
-            'total_value': warehouse_value
+            'products_count': totals['products_count'],
+            'total_value': totals['total_value']
         })
     
     context = {
@@ -4572,7 +4566,7 @@ def stock_list(request):
         'total_products': len(stock_data),
         'low_stock_count': sum(1 for item in stock_data if item['is_low_stock']),
         'total_stock_value': total_stock_value,
-        'warehouses': Warehouse.objects.all(),
+        'warehouses': warehouses,
         'warehouses_stats': warehouses_stats,
         **get_user_context(request)
     }
@@ -4833,77 +4827,44 @@ def supplier_accounts(request):
 @login_required
 @subscription_required
 def accounting_tree(request):
+    """عرض شجرة الحسابات - للقراءة فقط، الأرصدة محدثة من دفتر الأرصدة"""
     from django.db.models import Sum
-    
-    accounts_by_type = {
-        'assets': Account.objects.filter(account_type='asset').order_by('account_code'),
-        'liabilities': Account.objects.filter(account_type='liability').order_by('account_code'),
-        'equity': Account.objects.filter(account_type='equity').order_by('account_code'),
-        'revenue': Account.objects.filter(account_type='revenue').order_by('account_code'),
-        'expenses': Account.objects.filter(account_type='expense').order_by('account_code'),
+    from .account_tree import AccountTree
+
+    # الشجرة كاملة باستعلام واحد مرتب بالمسار مع مجموع كل حساب وفروعه
+    # ?root=12 لعرض الحساب 12 وجميع فروعه فقط
+    root = None
+    root_code = request.GET.get('root', '').strip()
+    if root_code:
+        root = AccountTree.find(root_code)
+    nodes = AccountTree.rollup(root=root)
+
+    type_keys = {
+        'asset': 'assets',
+        'liability': 'liabilities',
+        'equity': 'equity',
+        'revenue': 'revenue',
+        'expense': 'expenses',
     }
+    accounts_by_type = {key: [] for key in type_keys.values()}
+    type_totals = {}
+    for node in nodes:
+        key = type_keys.get(node.account_type)
+        if key:
+            accounts_by_type[key].append(node)
+        type_totals[node.account_type] = type_totals.get(node.account_type, 0) + (node.balance or 0)
     
-    # حساب الأرصدة مع تحديث من المبيعات والمشتريات
-    # تحديث أرصدة العملاء
-    for customer in Customer.objects.all():
-        account = get_or_create_customer_account(customer)
-        total_sales = Sale.objects.filter(customer=customer, status='confirmed').aggregate(Sum('total_amount'))['total_amount__sum'] or 0
-        payments = CustomerPayment.objects.filter(customer=customer).aggregate(Sum('amount'))['amount__sum'] or 0
-        account.balance = customer.opening_balance + total_sales - payments
-        account.save()
-    
-    # تحديث أرصدة الموردين
-    for supplier in Supplier.objects.all():
-        account = get_or_create_supplier_account(supplier)
-        total_purchases = Purchase.objects.filter(supplier=supplier, status='confirmed').aggregate(Sum('total_amount'))['total_amount__sum'] or 0
-        payments = SupplierPayment.objects.filter(supplier=supplier).aggregate(Sum('amount'))['amount__sum'] or 0
-        account.balance = supplier.opening_balance + total_purchases - payments
-        account.save()
-    
-    # الحصول على الشركة الحالية
-    company = getattr(request, 'company', None)
-    if not company:
-        try:
-            company = Company.objects.first()
-        except:
-            from datetime import date, timedelta
-            company = Company.objects.create(
-                code='DEFAULT',
-                name='الشركة الافتراضية',
-                database_name='erp_default',
-                subscription_end=date.today() + timedelta(days=365)
-            )
-    
-    # تحديث حساب المبيعات
-    sales_account = get_or_create_account('4001', 'مبيعات', 'revenue', company)
     total_sales = Sale.objects.filter(status='confirmed').aggregate(Sum('total_amount'))['total_amount__sum'] or 0
-    sales_account.balance = total_sales
-    sales_account.save()
-    
-    # تحديث حساب المشتريات
-    purchases_account = get_or_create_account('5001', 'مشتريات', 'expense', company)
     total_purchases = Purchase.objects.filter(status='confirmed').aggregate(Sum('total_amount'))['total_amount__sum'] or 0
-    purchases_account.balance = total_purchases
-    purchases_account.save()
-    
-    # تحديث حساب المخزون
-    inventory_account = get_or_create_account('1301', 'مخزون بضاعة', 'asset', company)
-    total_inventory_value = 0
-    for product in Product.objects.all():
-        stock = getattr(product, 'stock', 0) or 0
-        cost_price = getattr(product, 'cost_price', 0) or 0
-        total_inventory_value += stock * cost_price
-    inventory_account.balance = total_inventory_value
-    inventory_account.save()
     
     # إحصائيات محاسبية
     stats = {
-        'total_accounts': Account.objects.count(),
-        'assets_total': accounts_by_type['assets'].aggregate(Sum('balance'))['balance__sum'] or 0,
-        'liabilities_total': accounts_by_type['liabilities'].aggregate(Sum('balance'))['balance__sum'] or 0,
-        'equity_total': accounts_by_type['equity'].aggregate(Sum('balance'))['balance__sum'] or 0,
-        'revenue_total': accounts_by_type['revenue'].aggregate(Sum('balance'))['balance__sum'] or 0,
-        'expenses_total': accounts_by_type['expenses'].aggregate(Sum('balance'))['balance__sum'] or 0,
+        'total_accounts': len(nodes),
+        'assets_total': type_totals.get('asset', 0),
+        'liabilities_total': type_totals.get('liability', 0),
+        'equity_total': type_totals.get('equity', 0),
+        'revenue_total': type_totals.get('revenue', 0),
+        'expenses_total': type_totals.get('expense', 0),
         'total_sales': total_sales,
         'total_purchases': total_purchases,
         'customers_count': Customer.objects.count(),
@@ -4917,6 +4878,8 @@ def accounting_tree(request):
     
     context = {
         'accounts_by_type': accounts_by_type,
+        'account_nodes': nodes,
+        'root_account': root,
         'stats': stats,
         'recent_entries': recent_entries,
         **get_user_context(request)
@@ -5090,6 +5053,10 @@ def add_voucher(request):
 @permission_required('accounts', 'view')
 def trial_balance(request):
     from django.db.models import Sum
+    from .period_balances import period_account_balances
+    
+    # ?date_to=YYYY-MM-DD (وdate_from اختياري) لميزان مراجعة بتاريخ سابق من الأرصدة الشهرية
+    date_from, date_to, period_balances = period_account_balances(request.GET)
     
     accounts = Account.objects.all().order_by('account_code')
     total_debits = 0
@@ -5097,24 +5064,34 @@ def trial_balance(request):
     
     account_balances = []
     for account in accounts:
+        period = period_balances.get(account.id) if period_balances is not None else None
+        balance = period['closing'] if period else account.balance
+        
         # تحديد المدين والدائن حسب نوع الحساب
         if account.account_type in ['asset', 'expense']:
-            debit_balance = float(account.balance) if account.balance > 0 else 0
+            debit_balance = float(balance) if balance > 0 else 0
             credit_balance = 0
         else:  # liability, equity, revenue
             debit_balance = 0
-            credit_balance = float(account.balance) if account.balance > 0 else 0
+            credit_balance = float(balance) if balance > 0 else 0
         
         total_debits += debit_balance
         total_credits += credit_balance
         
         # إضافة الحساب فقط إذا كان له رصيد
         if debit_balance > 0 or credit_balance > 0:
-            account_balances.append({
+            row = {
                 'account': account,
                 'debit': debit_balance,
                 'credit': credit_balance
-            })
+            }
+            if period:
+                row.update({
+                    'opening': float(period['opening']),
+                    'period_debit': float(period['debit']),
+                    'period_credit': float(period['credit']),
+                })
+            account_balances.append(row)
     
     # فحص التوازن
     is_balanced = abs(total_debits - total_credits) < 0.01
@@ -5130,6 +5107,8 @@ def trial_balance(request):
         'is_balanced': is_balanced,
         'balance_difference': balance_difference,
         'currency_symbol': currency_symbol,
+        'date_from': date_from,
+        'date_to': date_to,
         **get_user_context(request)
     }
     return render(request, 'trial_balance.html', context)
@@ -5149,51 +5128,19 @@ def account_ledger(request, account_id):
 @login_required
 @subscription_required
 def customer_statement(request, customer_id):
-    customer = get_object_or_404(Customer, id=customer_id)
-    
-    # جلب الفواتير والدفعات
-    sales = Sale.objects.filter(customer=customer, status='confirmed').order_by('-created_at')
-    payments = CustomerPayment.objects.filter(customer=customer).order_by('-created_at')
-    
-    # دمج الفواتير والدفعات في قائمة واحدة
-    transactions = []
-    
-    # إضافة الفواتير
-    for sale in sales:
-        transactions.append({
-            'date': sale.created_at.date(),
-            'description': f'فاتورة بيع #{sale.invoice_number}',
-            'debit': sale.total_amount,
-            'credit': 0,
-            'type': 'sale',
-            'payment_method': '-'
-        })
-    
-    # إضافة الدفعات
-    for payment in payments:
-        transactions.append({
-            'date': payment.payment_date,
-            'description': f'دفعة #{payment.payment_number}',
-            'debit': 0,
-            'credit': payment.amount,
-            'type': 'payment',
-            'payment_method': payment.get_payment_method_display()
-        })
+    from .statements import PartyStatement, statement_page
     
-    # ترتيب المعاملات حسب التاريخ
-    transactions.sort(key=lambda x: x['date'], reverse=True)
-    
-    # حساب الرصيد التراكمي
-    running_balance = customer.opening_balance
-    for transaction in reversed(transactions):
-        running_balance += transaction['debit'] - transaction['credit']
-        transaction['balance'] = running_balance
+    customer = get_object_or_404(Customer, id=customer_id)
+    # صفحة واحدة من الكشف (الأحدث أولاً) بالرصيد الجاري من قاعدة البيانات
+    statement = statement_page(request, PartyStatement.for_customer(customer))
     
     context = {
         'customer': customer,
-        'transactions': transactions,
-        'opening_balance': customer.opening_balance,
-        'final_balance': running_balance,
+        'transactions': statement['transactions'],
+        'opening_balance': statement['opening_balance'],
+        'final_balance': statement['final_balance'],
+        'next_cursor': statement['next_cursor'],
+        'has_more': statement['has_more'],
         **get_user_context(request)
     }
     return render(request, 'customer_statement.html', context)
@@ -5201,51 +5148,19 @@ def customer_statement(request, customer_id):
 @login_required
 @subscription_required
 def supplier_statement(request, supplier_id):
-    supplier = get_object_or_404(Supplier, id=supplier_id)
-    
-    # جلب المشتريات والدفعات
-    purchases = Purchase.objects.filter(supplier=supplier, status='confirmed').order_by('-created_at')
-    payments = SupplierPayment.objects.filter(supplier=supplier).order_by('-created_at')
-    
-    # دمج المشتريات والدفعات في قائمة واحدة
-    transactions = []
-    
-    # إضافة المشتريات
-    for purchase in purchases:
-        transactions.append({
-            'date': purchase.created_at.date(),
-            'description': f'فاتورة شراء #{purchase.invoice_number}',
-            'debit': 0,
-            'credit': purchase.total_amount,
-            'type': 'purchase',
-            'payment_method': '-'
-        })
-    
-    # إضافة الدفعات
-    for payment in payments:
-        transactions.append({
-            'date': payment.payment_date,
-            'description': f'دفعة #{payment.payment_number}',
-            'debit': payment.amount,
-            'credit': 0,
-            'type': 'payment',
-            'payment_method': payment.get_payment_method_display()
-        })
+    from .statements import PartyStatement, statement_page
     
-    # ترتيب المعاملات حسب التاريخ
-    transactions.sort(key=lambda x: x['date'], reverse=True)
-    
-    # حساب الرصيد التراكمي
-    running_balance = supplier.opening_balance
-    for transaction in reversed(transactions):
-        running_balance += transaction['credit'] - transaction['debit']
-        transaction['balance'] = running_balance
+    supplier = get_object_or_404(Supplier, id=supplier_id)
+    # صفحة واحدة من الكشف (الأحدث أولاً) بالرصيد الجاري من قاعدة البيانات
+    statement = statement_page(request, PartyStatement.for_supplier(supplier))
     
     context = {
         'supplier': supplier,
-        'transactions': transactions,
-        'opening_balance': supplier.opening_balance,
-        'final_balance': running_balance,
+        'transactions': statement['transactions'],
+        'opening_balance': statement['opening_balance'],
+        'final_balance': statement['final_balance'],
+        'next_cursor': statement['next_cursor'],
+        'has_more': statement['has_more'],
         **get_user_context(request)
     }
     return render(request, 'supplier_statement.html', context)
@@ -5485,26 +5400,23 @@ def get_customer_payments(request, customer_id):
 @login_required
 def get_customer_summary(request, customer_id):
     try:
-        customer = get_object_or_404(Customer, id=customer_id)
-        
-        # حساب الإحصائيات
-        total_invoices = Sale.objects.filter(customer=customer).count()
-        confirmed_sales = Sale.objects.filter(customer=customer, status='confirmed')
-        total_sales = confirmed_sales.aggregate(Sum('total_amount'))['total_amount__sum'] or 0
-        paid_amount = confirmed_sales.aggregate(Sum('paid_amount'))['paid_amount__sum'] or 0
+        from .aging import AgingReport, BUCKETS
         
-        # حساب الدفعات
-        customer_payments = CustomerPayment.objects.filter(customer=customer).aggregate(Sum('amount'))['amount__sum'] or 0
+        customer = get_object_or_404(Customer, id=customer_id)
         
-        due_amount = total_sales - paid_amount - customer_payments
+        # صف العميل من تقرير الأعمار المحفوظ (استعلام واحد لجميع العملاء عند تغير البيانات)
+        row = AgingReport.party('customer', customer.id)
+        if row is None:
+            row = AgingReport.empty_row(customer.id, customer.name, customer.opening_balance)
         
         summary_data = {
-            'total_invoices': total_invoices,
-            'total_sales': float(total_sales),
-            'total_returns': 0,  # مؤقت
-            'total_payments': float(paid_amount + customer_payments),
-            'due_amount': float(due_amount),
-            'current_balance': float(customer.opening_balance + total_sales - paid_amount - customer_payments)
+            'total_invoices': row['invoices_count'],
+            'total_sales': float(row['total_invoiced']),
+            'total_returns': float(row['total_returns']),
+            'total_payments': float(row['paid_amount'] + row['total_payments']),
+            'due_amount': float(row['total_invoiced'] - row['paid_amount'] - row['total_payments']),
+            'current_balance': float(row['balance']),
+            'aging': {bucket: float(row[bucket]) for bucket in BUCKETS},
         }
         
         return JsonResponse({
@@ -5514,6 +5426,72 @@ def get_customer_summary(request, customer_id):
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)})
 
+@login_required
+@subscription_required
+@permission_required('accounts', 'view')
+def aging_report_api(request):
+    """
+    أعمار ديون العملاء (?ledger=customer) أو الموردين (?ledger=supplier)
+    
+    ?overdue=1 لعرض من لديهم متأخرات أكثر من 30 يوماً فقط، و ?min_balance= للحد الأدنى للرصيد.
+    """
+    try:
+        from decimal import Decimal
+        from .aging import AgingReport, BUCKETS
+        
+        ledger = request.GET.get('ledger', 'customer')
+        if ledger not in AgingReport.LEDGERS:
+            return JsonResponse({'success': False, 'error': 'دفتر غير معروف'})
+        
+        rows = list(AgingReport.book(ledger).values())
+        min_balance = request.GET.get('min_balance')
+        if min_balance:
+            rows = [row for row in rows if row['balance'] >= Decimal(min_balance)]
+        if request.GET.get('overdue') == '1':
+            rows = [row for row in rows if any(row[bucket] > 0 for bucket in BUCKETS[1:])]
+        rows.sort(key=lambda row: row['balance'], reverse=True)
+        
+        def serialize(values):
+            return {key: float(value) if isinstance(value, Decimal) else value for key, value in values.items()}
+        
+        return JsonResponse({
+            'success': True,
+            'ledger': ledger,
+            'buckets': list(BUCKETS),
+            'rows': [serialize(row) for row in rows],
+            'totals': serialize(AgingReport.totals(rows)),
+        })
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)})
+
+@login_required
+@subscription_required
+@permission_required('accounts', 'view')
+def accounts_tree_api(request):
+    """
+    شجرة الحسابات مع مجموع كل حساب وفروعه (الأب قبل فروعه)
+    
+    ?root=12 لإرجاع الحساب 12 وجميع الحسابات تحته فقط.
+    """
+    try:
+        from .account_tree import AccountTree
+        
+        root = None
+        root_code = request.GET.get('root', '').strip()
+        if root_code:
+            root = AccountTree.find(root_code)
+            if root is None:
+                return JsonResponse({'success': False, 'error': 'الحساب غير موجود'})
+        
+        nodes = AccountTree.rollup(root=root)
+        return JsonResponse({
+            'success': True,
+            'root': root_code or None,
+            'accounts': [AccountTree.as_dict(node) for node in nodes],
+        })
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)})
+
 @login_required
 @subscription_required
 @permission_required('permissions', 'edit')
@@ -5798,7 +5776,6 @@ def add_customer_payment(request):
             # تسجيل القيد المحاسبي تلقائياً
             try:
                 InventoryAccountingManager.process_customer_payment(payment, request.user)
-                InventoryAccountingManager.update_account_balances()
                 messages.success(request, 'تم تسجيل الدفعة والقيد المحاسبي بنجاح')
             except Exception as e:
                 messages.warning(request, f'تم تسجيل الدفعة ولكن حدث خطأ في المحاسبة: {str(e)}')
@@ -5879,7 +5856,6 @@ def add_supplier_payment(request):
             # تسجيل القيد المحاسبي تلقائياً
             try:
                 InventoryAccountingManager.process_supplier_payment(payment, request.user)
-                InventoryAccountingManager.update_account_balances()
                 messages.success(request, 'تم تسجيل الدفعة والقيد المحاسبي بنجاح')
             except Exception as e:
                 messages.warning(request, f'تم تسجيل الدفعة ولكن حدث خطأ في المحاسبة: {str(e)}')